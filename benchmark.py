@@ -0,0 +1,204 @@
+"""
+Benchmarks of the Recommender on synthetic data, for growing data sizes.
+
+Books, users, authors and publishers are generated as in the original
+class-benchmark.py (books and users chosen with Zipf distributions), from
+a seed, so that runs are comparable. Each (backend, size) runs in a new
+process, with a new Recommender. With --save the results are written as JSON,
+with --compare they are compared with a previous run.
+
+Backends: memory, mongomock (MongoDB stand-in, pip install mongomock) and
+mongo (a real MongoDB at --mongo_host, whose --mongo_db_name is dropped!).
+
+Usage:
+python benchmark.py [--sizes 1000,5000,20000] [--backends memory,mongomock] [--sparse] [--incremental]
+                    [--seed 0] [--save results.json] [--compare previous.json --threshold 0.2]
+"""
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import platform
+import random
+import subprocess
+import sys
+from time import time
+from timeit import default_timer as timer
+import numpy as np
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', default='1000,5000,20000', help="numbers of ratings, comma separated")
+parser.add_argument('--backends', default='memory', help="memory, mongomock, mongo, comma separated")
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--calls', type=int, default=50, help="calls of each fast benchmark")
+parser.add_argument('--mongo_host', default='localhost:27017')
+parser.add_argument('--mongo_db_name', default='csrec_benchmark')
+parser.add_argument('--save', default=None, help="file to write the results in")
+parser.add_argument('--compare', default=None, help="results of a previous run")
+parser.add_argument('--threshold', type=float, default=0.2, help="slowdown reported as regression")
+
+N_AUTHORS = 100
+N_PUBLISHERS = 10
+
+
+def synthetic_data(n_ratings, seed=0):
+    """
+    :param n_ratings: number of ratings. There are n_ratings / 10 books and users
+    :return: [book], [(user_id, item_id, rating)]
+    """
+    rnd = random.Random(seed)
+    rng = np.random.RandomState(seed)
+    n_books = n_users = max(n_ratings // 10, 10)
+    authors = ['A' + str(i) for i in range(1, N_AUTHORS + 1)]
+    publishers = ['P' + str(i) for i in range(1, N_PUBLISHERS + 1)]
+    books = [{'uid': 'b' + str(b), 'author': rnd.choice(authors), 'publisher': rnd.choice(publishers)}
+             for b in range(n_books + 1)]
+    ratings = []
+    while len(ratings) < n_ratings:
+        book_n = rng.zipf(1.05, n_ratings)
+        user_n = rng.zipf(1.5, n_ratings)
+        kept = (book_n <= n_books) & (user_n <= n_users)
+        for b, u in zip(book_n[kept], user_n[kept])[:n_ratings - len(ratings)]:
+            ratings.append(('u' + str(u), 'b' + str(b), rnd.randrange(1, 6)))
+    return books, ratings
+
+
+def measure(calls):
+    """
+    :param calls: list of functions, called (and timed) one by one
+    :return: {'n': .., 'total_s': .., 'min_ms': .., 'median_ms': .., 'mean_ms': .., 'per_second': ..}
+    """
+    times = []
+    for call in calls:
+        start = timer()
+        call()
+        times.append(timer() - start)
+    total = sum(times)
+    return {'n': len(times), 'total_s': total, 'min_ms': 1000 * min(times),
+            'median_ms': 1000 * float(np.median(times)), 'mean_ms': 1000 * total / len(times),
+            'per_second': len(times) / total if total else None}
+
+
+def run_case(case):
+    """
+    Run all benchmarks for one backend and size, with a new Recommender
+    :return: [{'backend': .., 'size': .., 'benchmark': .., stats}]
+    """
+    backend, size, args = case
+    kwargs = {}
+    if backend == 'mongomock':
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    if backend in ('mongo', 'mongomock'):
+        kwargs = {'mongo_host': args.mongo_host, 'mongo_db_name': args.mongo_db_name}
+    from csrec.Recommender import Recommender
+    engine = Recommender(incremental=args.incremental, sparse=args.sparse, log_level=logging.CRITICAL, **kwargs)
+    engine.drop_db()
+    books, ratings = synthetic_data(size, args.seed)
+    rnd = random.Random(args.seed)
+    info = ['author', 'publisher']
+    warm = sorted(set(u for u, _, _ in ratings), key=lambda u: int(u[1:]))[:20]  # most active users
+    cold = ['cold' + str(i) for i in range(args.calls)]
+    anonymous = ['anon' + str(i) for i in range(10)]
+    sessions = ['session' + str(i) for i in range(100)]
+    results = []
+
+    def bench(name, calls):
+        stats = measure(calls)
+        stats.update({'backend': backend, 'size': size, 'benchmark': name})
+        results.append(stats)
+        print "%-10s %8d %-26s %8.3f ms (median, %d calls)" % (backend, size, name, stats['median_ms'], stats['n'])
+        sys.stdout.flush()
+
+    bench('insert_item', [lambda b=b: engine.insert_item(dict(b), _id='uid') for b in books])
+    bench('insert_rating', [lambda r=r: engine.insert_rating(r[0], r[1], r[2], item_info=info) for r in ratings])
+    bench('create_cooccurrence', [engine._create_cooccurrence] * 3)
+    bench('recommend_fast_warm', [lambda u=rnd.choice(warm): engine.get_recommendations(u, fast=True)
+                                  for _ in range(args.calls)])
+    bench('recommend_fast_cold', [lambda u=u: engine.get_recommendations(u, fast=True) for u in cold])
+    bench('recommend_warm', [lambda u=u: engine.get_recommendations(u) for u in warm[:5]])
+    bench('recommend_cold', [lambda u=u: engine.get_recommendations(u) for u in cold[:10]])
+    bench('similar_item', [lambda: engine.get_similar_item(rnd.choice(books)['uid'])] * args.calls)
+    bench('items_by_popularity', [lambda: engine.compute_items_by_popularity(max_items=10)] * args.calls)
+    for user in anonymous + sessions:
+        for _ in range(5):
+            engine.insert_rating(user, rnd.choice(books)['uid'], rnd.randrange(1, 6), item_info=info)
+    bench('reconcile_ids', [lambda a=a, u=u: engine.reconcile_ids(a, u) for a, u in zip(anonymous, warm)])
+    bench('reconcile_many', [lambda: engine.reconcile_many(zip(sessions, warm * 5))])
+    engine.drop_db()
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except Exception:
+        commit = None
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'commit': commit, 'time': time()}
+
+
+def report(results):
+    """
+    Print, for each backend and benchmark, the median times over the sizes, and
+    the exponent of their growth (1 = linear in the data size)
+    """
+    sizes = sorted(set(r['size'] for r in results))
+    print
+    print "%-10s %-26s" % ('backend', 'median ms') + ''.join('%12d' % s for s in sizes) + '    exponent'
+    for backend in sorted(set(r['backend'] for r in results)):
+        for name in [r['benchmark'] for r in results if r['backend'] == backend and r['size'] == sizes[0]]:
+            medians = dict((r['size'], r['median_ms']) for r in results
+                           if r['backend'] == backend and r['benchmark'] == name)
+            line = "%-10s %-26s" % (backend, name) + ''.join('%12.3f' % medians[s] for s in sizes)
+            if len(sizes) > 1 and medians[sizes[0]] > 0 and medians[sizes[-1]] > 0:
+                line += '%12.2f' % (math.log(medians[sizes[-1]] / medians[sizes[0]]) /
+                                    math.log(float(sizes[-1]) / sizes[0]))
+            print line
+
+
+def compare(results, previous, threshold):
+    """
+    Print the ratio of the median times to the ones of previous
+    :return: number of regressions (slower by more than threshold)
+    """
+    before = dict(((r['backend'], r['size'], r['benchmark']), r['median_ms']) for r in previous)
+    regressions = 0
+    print
+    print "%-10s %8s %-26s %12s %12s %8s" % ('backend', 'size', 'benchmark', 'before ms', 'now ms', 'ratio')
+    for r in results:
+        key = (r['backend'], r['size'], r['benchmark'])
+        if not before.get(key):
+            continue
+        ratio = r['median_ms'] / before[key]
+        slower = ratio > 1 + threshold
+        regressions += slower
+        print "%-10s %8d %-26s %12.3f %12.3f %8.2f%s" % (key + (before[key], r['median_ms'], ratio,
+                                                              '  REGRESSION' if slower else ''))
+    return regressions
+
+
+def main():
+    args = parser.parse_args()
+    cases = [(backend, int(size), args) for backend in args.backends.split(',') for size in args.sizes.split(',')]
+    # a new process for each case, as the Recommender is a singleton
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    results = [r for case_results in pool.map(run_case, cases, chunksize=1) for r in case_results]
+    pool.close()
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'options': vars(args), 'results': results}, f, indent=1)
+        print
+        print "Results saved in", args.save
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f)['results'], args.threshold):
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import json
 import webapp2
 from csrec.Recommender import Recommender
 import csrec
@@ -14,6 +15,11 @@ Start a webapp for testing the recommender.
 
 engine = Recommender()
 
+
+def _flag(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
 class MainPage(webapp2.RequestHandler):
     def get(self):
         self.response.headers['Content-Type'] = 'text/plain'
@@ -24,12 +30,15 @@ class InsertRating(webapp2.RequestHandler):
     """
     e.g.:
     curl -X POST  'localhost:8081/insertrating?item=Book1&user=User1&rating=4'
+    With the time of the event (seconds since the epoch), now by default:
+    curl -X POST  'localhost:8081/insertrating?item=Book1&user=User1&rating=4&timestamp=1500000000'
     """
     def post(self):
         user = self.request.get('user')
         item = self.request.get('item')
         rating = self.request.get('rating')
-        engine.insert_rating(user, item, rating)
+        timestamp = self.request.get('timestamp') or None
+        engine.insert_rating(user, item, rating, timestamp=timestamp)
 
 
 class InsertItem(webapp2.RequestHandler):
@@ -48,19 +57,63 @@ class InsertItem(webapp2.RequestHandler):
 class Recommend(webapp2.RequestHandler):
     """
     curl -X GET  'localhost:8081/recommend?user=User1'
+    With trace=1, the recommendations and the duration of each stage, as JSON:
+    curl -X GET  'localhost:8081/recommend?user=User1&trace=1'
     """
     def get(self):
         user = self.request.get('user')
-        max_recs = self.request.get('max_recs', 10)
-        fast = self.request.get('fast', False)
+        max_recs = int(self.request.get('max_recs', 10))
+        fast = _flag(self.request.get('fast', False))
+        if _flag(self.request.get('trace', False)):
+            with engine.metrics.trace() as events:
+                recs = engine.get_recommendations(user, max_recs=max_recs, fast=fast)
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps({'recommendations': recs, 'trace': events}))
+            return
         self.response.write(engine.get_recommendations(user, max_recs=max_recs, fast=fast))
 
 
+class Similar(webapp2.RequestHandler):
+    """
+    Items most rated together with item, as JSON [[item, score], ...]:
+    curl -X GET  'localhost:8081/similar?item=Book1&max_items=10'
+    Weighed with the rating of user, leaving out the items user has rated:
+    curl -X GET  'localhost:8081/similar?item=Book1&user=User1&algorithm=llr'
+    """
+    def get(self):
+        item = self.request.get('item')
+        user = self.request.get('user') or None
+        algorithm = self.request.get('algorithm', 'simple')
+        max_items = int(self.request.get('max_items', 10))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(engine.get_similar_item(item, user_id=user, algorithm=algorithm,
+                                                               max_items=max_items)))
+
+
+class RecommendBatch(webapp2.RequestHandler):
+    """
+    One JSON line {user: [items]} per chunk of users, written as soon as it is ready:
+    curl -X GET  'localhost:8081/recommendbatch?users=User1,User2&max_recs=10'
+    curl -X POST 'localhost:8081/recommendbatch' -d 'users=User1,User2,...'
+    """
+    def get(self):
+        users = [u for u in self.request.get('users').split(',') if u]
+        max_recs = int(self.request.get('max_recs', 10))
+        fast = _flag(self.request.get('fast', False))
+        chunk_size = int(self.request.get('chunk_size', 100))
+        self.response.headers['Content-Type'] = 'application/json'
+        for chunk in engine.get_recommendations_batch(users, max_recs=max_recs, fast=fast, chunk_size=chunk_size):
+            self.response.write(json.dumps(chunk) + "\n")
+
+    def post(self):
+        self.get()
+
+
 class Reconcile(webapp2.RequestHandler):
     def post(self):
         old = self.request.get('old')
         new = self.request.get('new')
-        engine.reconcile(old, new)
+        engine.reconcile_ids(old, new)
 
 
 class Info(webapp2.RequestHandler):
@@ -72,6 +125,36 @@ class Info(webapp2.RequestHandler):
         self.response.write(engine.get_user_info(user))
 
 
+class ModelInfo(webapp2.RequestHandler):
+    """
+    Age and build duration of the co-occurrence:
+    curl -X GET  'localhost:8081/modelinfo'
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(engine.get_model_info()))
+
+
+class CacheInfo(webapp2.RequestHandler):
+    """
+    Size, hits and misses of the caches:
+    curl -X GET  'localhost:8081/cacheinfo'
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(engine.get_cache_info()))
+
+
+class Metrics(webapp2.RequestHandler):
+    """
+    Counters and histograms of durations (see Recommender.get_metrics):
+    curl -X GET  'localhost:8081/metrics'
+    """
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(engine.get_metrics()))
+
+
 class GetItems(webapp2.RequestHandler):
     """
     curl -X GET  'localhost:8081/items?n=10'
@@ -86,14 +169,20 @@ app = webapp2.WSGIApplication([
     ('/insertrating', InsertRating),
     ('/insertitem', InsertItem),
     ('/recommend', Recommend),
+    ('/recommendbatch', RecommendBatch),
+    ('/similar', Similar),
     ('/reconcile', Reconcile),
     ('/info', Info),
     ('/items', GetItems),
+    ('/modelinfo', ModelInfo),
+    ('/cacheinfo', CacheInfo),
+    ('/metrics', Metrics),
 ], debug=False)
 
 
 def main():
     from paste import httpserver
+    engine.start_refresher(interval=1800, n_ratings=1000)
     httpserver.serve(app, host='127.0.0.1', port='8081', use_threadpool=True, threadpool_workers=10)
 
 if __name__ == '__main__':
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen, web
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from csrec.Recommender import Recommender
+import csrec
+
+"""
+Usage:
+python recommender_async_api.py [--port 8081] [--threads 4] [--window 0.005]
+
+Same routes of recommender_api.py, served by an event loop (tornado) which
+can keep thousands of connections open. Scoring and writes run in a pool of
+threads, so the loop is never blocked, and the /recommend requests arriving
+within --window seconds (with the same max_recs and fast) are scored together with one
+get_recommendations_batch, so they get the same results as get_recommendations.
+
+"""
+
+engine = Recommender()
+
+
+def _flag(value):
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+class RecommendCoalescer(object):
+    """
+    Gather the recommendation requests arriving within window seconds (or up to
+    max_batch users) and score them with one get_recommendations_batch in the executor.
+    Requests are gathered by max_recs (popularity fills up to max_recs items, so the first
+    n of a longer list can differ from a list of n) and fast.
+    """
+    def __init__(self, executor, window=0.005, max_batch=200):
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # {(max_recs, fast): {user_id: [future, ...]}}
+
+    def recommend(self, user_id, max_recs=10, fast=False):
+        """
+        :return: Future of the list of recommended items
+        """
+        future = Future()
+        key = (max_recs, fast)
+        batch = self._pending.setdefault(key, OrderedDict())
+        if not batch:
+            IOLoop.current().call_later(self.window, self._score, key)
+        batch.setdefault(str(user_id).replace('.', ''), []).append(future)
+        if len(batch) >= self.max_batch:
+            self._score(key)
+        return future
+
+    @gen.coroutine
+    def _score(self, key):
+        batch = self._pending.pop(key, None)
+        if not batch:  # already scored, because max_batch was reached
+            return
+        max_recs, fast = key
+        try:
+            recs = yield IOLoop.current().run_in_executor(self.executor, self._recommend_batch,
+                                                          list(batch), max_recs, fast)
+        except Exception as e:
+            for waiting in batch.values():
+                for future in waiting:
+                    future.set_exception(e)
+            return
+        for user_id, waiting in batch.items():
+            for future in waiting:
+                future.set_result(list(recs.get(user_id, [])))
+
+    def _recommend_batch(self, user_ids, max_recs, fast):
+        recs = {}
+        for chunk in engine.get_recommendations_batch(user_ids, max_recs=max_recs, fast=fast,
+                                                      chunk_size=len(user_ids)):
+            recs.update(chunk)
+        return recs
+
+
+class Handler(web.RequestHandler):
+    def run(self, method, *args, **kwargs):
+        """
+        :return: Future of method(*args, **kwargs), run in the executor
+        """
+        return IOLoop.current().run_in_executor(self.application.executor, lambda: method(*args, **kwargs))
+
+    def write_json(self, data):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(data))
+
+
+class MainPage(Handler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain')
+        self.write("Cold Start Recommender v. " + str(csrec.__version__) + "\n")
+
+
+class InsertRating(Handler):
+    """
+    e.g.:
+    curl -X POST  'localhost:8081/insertrating?item=Book1&user=User1&rating=4'
+    With the time of the event (seconds since the epoch), now by default:
+    curl -X POST  'localhost:8081/insertrating?item=Book1&user=User1&rating=4&timestamp=1500000000'
+    """
+    @gen.coroutine
+    def post(self):
+        user = self.get_argument('user')
+        item = self.get_argument('item')
+        rating = self.get_argument('rating', engine.default_rating)
+        timestamp = self.get_argument('timestamp', None)
+        yield self.run(engine.insert_rating, user, item, rating, timestamp=timestamp)
+
+
+class InsertItem(Handler):
+    """
+    e.g.:
+    curl -X POST  'localhost:8081/insertitem?id=Book1&author=TheAuthor&cathegory=Horror&tags=scary,terror'
+    """
+    @gen.coroutine
+    def post(self):
+        item = dict((k, self.get_argument(k)) for k in self.request.arguments)
+        yield self.run(engine.insert_item, item, _id='id')
+
+
+class Recommend(Handler):
+    """
+    curl -X GET  'localhost:8081/recommend?user=User1'
+    With trace=1, scored alone, and returned with the duration of each stage:
+    curl -X GET  'localhost:8081/recommend?user=User1&trace=1'
+    """
+    @gen.coroutine
+    def get(self):
+        user = self.get_argument('user')
+        max_recs = int(self.get_argument('max_recs', 10))
+        fast = _flag(self.get_argument('fast', False))
+        if _flag(self.get_argument('trace', False)):
+            result = yield self.run(self.traced, user, max_recs, fast)
+            self.write_json(result)
+            return
+        recs = yield self.application.coalescer.recommend(user, max_recs=max_recs, fast=fast)
+        self.write_json(recs)
+
+    def traced(self, user, max_recs, fast):
+        with engine.metrics.trace() as events:
+            recs = engine.get_recommendations(user, max_recs=max_recs, fast=fast)
+        return {'recommendations': recs, 'trace': events}
+
+
+class RecommendBatch(Handler):
+    """
+    One JSON line {user: [items]} per chunk of users:
+    curl -X GET  'localhost:8081/recommendbatch?users=User1,User2&max_recs=10'
+    """
+    @gen.coroutine
+    def get(self):
+        users = [u for u in self.get_argument('users').split(',') if u]
+        max_recs = int(self.get_argument('max_recs', 10))
+        fast = _flag(self.get_argument('fast', False))
+        chunk_size = int(self.get_argument('chunk_size', 100))
+        self.set_header('Content-Type', 'application/json')
+        chunks = yield self.run(list, engine.get_recommendations_batch(users, max_recs=max_recs, fast=fast,
+                                                                       chunk_size=chunk_size))
+        for chunk in chunks:
+            self.write(json.dumps(chunk) + "\n")
+
+    def post(self):
+        return self.get()
+
+
+class Similar(Handler):
+    """
+    curl -X GET  'localhost:8081/similar?item=Book1&max_items=10'
+    curl -X GET  'localhost:8081/similar?item=Book1&user=User1&algorithm=llr'
+    """
+    @gen.coroutine
+    def get(self):
+        item = self.get_argument('item')
+        user = self.get_argument('user', None)
+        algorithm = self.get_argument('algorithm', 'simple')
+        max_items = int(self.get_argument('max_items', 10))
+        similar = yield self.run(engine.get_similar_item, item, user_id=user, algorithm=algorithm,
+                                 max_items=max_items)
+        self.write_json(similar)
+
+
+class Reconcile(Handler):
+    @gen.coroutine
+    def post(self):
+        old = self.get_argument('old')
+        new = self.get_argument('new')
+        yield self.run(engine.reconcile_ids, old, new)
+
+
+class Info(Handler):
+    """
+    curl -X GET  'localhost:8081/info?user=User1'
+    """
+    @gen.coroutine
+    def get(self):
+        user = self.get_argument('user')
+        info = yield self.run(engine.get_user_info, user)
+        self.write_json(info)
+
+
+class GetItems(Handler):
+    """
+    curl -X GET  'localhost:8081/items?n=10'
+    """
+    @gen.coroutine
+    def get(self):
+        n = int(self.get_argument('n', 10))
+        items = yield self.run(engine.get_items, n)
+        self.write_json(items)
+
+
+class ModelInfo(Handler):
+    """
+    curl -X GET  'localhost:8081/modelinfo'
+    """
+    def get(self):
+        self.write_json(engine.get_model_info())
+
+
+class Metrics(Handler):
+    """
+    curl -X GET  'localhost:8081/metrics'
+    """
+    def get(self):
+        self.write_json(engine.get_metrics())
+
+
+class CacheInfo(Handler):
+    """
+    curl -X GET  'localhost:8081/cacheinfo'
+    """
+    def get(self):
+        self.write_json(engine.get_cache_info())
+
+
+routes = [
+    ('/', MainPage),
+    ('/insertrating', InsertRating),
+    ('/insertitem', InsertItem),
+    ('/recommend', Recommend),
+    ('/recommendbatch', RecommendBatch),
+    ('/similar', Similar),
+    ('/reconcile', Reconcile),
+    ('/info', Info),
+    ('/items', GetItems),
+    ('/modelinfo', ModelInfo),
+    ('/cacheinfo', CacheInfo),
+    ('/metrics', Metrics),
+]
+
+
+def make_app(threads=4, window=0.005, max_batch=200, handlers=None):
+    """
+    :param handlers: {route: handler} replacing the ones of routes
+    """
+    handlers = handlers or {}
+    app = web.Application([(route, handlers.get(route, handler)) for route, handler in routes])
+    app.executor = ThreadPoolExecutor(threads)
+    app.coalescer = RecommendCoalescer(app.executor, window=window, max_batch=max_batch)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--threads', type=int, default=4, help="threads scoring and writing")
+    parser.add_argument('--window', type=float, default=0.005, help="seconds /recommend requests are gathered")
+    parser.add_argument('--max_batch', type=int, default=200, help="max users scored together")
+    args = parser.parse_args()
+    engine.start_refresher(interval=1800, n_ratings=1000)
+    make_app(args.threads, args.window, args.max_batch).listen(args.port, address=args.host)
+    IOLoop.current().start()
+
+if __name__ == '__main__':
+    main()
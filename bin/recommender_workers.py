@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import multiprocessing
+import Queue
+from time import time
+from tornado import gen, netutil, process
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from csrec.Recommender import Recommender
+from tools import Snapshot
+
+"""
+Usage:
+python recommender_workers.py [--workers 4] [--port 8081] [--snapshots /dev/shm/csrec]
+                              [--mongo_host localhost:27017 --mongo_db_name csrec]
+
+Serve the routes of recommender_async_api.py with --workers processes sharing
+the listening socket, so that scoring uses as many cores.
+
+One more process, the writer, applies /insertrating, /insertitem and /reconcile
+(which the workers queue to it) and publishes a new version of the model in
+--snapshots every --publish_seconds seconds or --publish_writes writes. The
+workers load each version memory-mapped: with --snapshots in /dev/shm (shared
+memory) the ids, matrices, ratings and popularity are in RAM once for all of
+them (items' documents, which are pickled, once per worker).
+Writes are visible to the workers from the next version on.
+
+"""
+
+WRITER = 0  # task id of the writer process
+
+
+def make_engine(args):
+    return Recommender(mongo_host=args.mongo_host, mongo_db_name=args.mongo_db_name,
+                       sparse=args.sparse, result_cache_size=args.result_cache_size, log_level=logging.INFO)
+
+
+def writer(writes, args):
+    """
+    Apply the writes queued by the workers, and publish the model
+    """
+    engine = make_engine(args)
+    current = Snapshot.current_version(args.snapshots)
+    if current is not None:  # restarted
+        engine.load_snapshot(current)
+    engine.publish_snapshot(args.snapshots)
+    n_writes, published = 0, time()
+    while True:
+        try:
+            method, method_args, method_kwargs = writes.get(timeout=args.publish_seconds)
+            getattr(engine, method)(*method_args, **method_kwargs)
+            n_writes += 1
+        except Queue.Empty:
+            pass
+        except Exception, e:
+            engine.logger.error("[writer] Write not applied")
+            logging.exception(e)
+        if n_writes and (n_writes >= args.publish_writes or time() - published >= args.publish_seconds):
+            engine.publish_snapshot(args.snapshots)
+            n_writes, published = 0, time()
+
+
+def worker(sockets, writes, args):
+    """
+    Serve the requests, reading the model published by the writer
+    """
+    engine = make_engine(args)
+    engine.follow_snapshots(args.snapshots, interval=args.poll_seconds)
+    import recommender_async_api as api  # its engine is the Recommender just configured
+
+    class QueuedWrites(object):
+        def run(self, method, *method_args, **method_kwargs):
+            writes.put((method.__name__, method_args, method_kwargs))
+            return gen.moment
+
+    handlers = dict((route, type(handler.__name__, (QueuedWrites, handler), {}))
+                    for route, handler in api.routes if route in ('/insertrating', '/insertitem', '/reconcile'))
+    server = HTTPServer(api.make_app(args.threads, args.window, args.max_batch, handlers=handlers))
+    server.add_sockets(sockets)
+    IOLoop.current().start()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--threads', type=int, default=2, help="threads scoring in each worker")
+    parser.add_argument('--window', type=float, default=0.005, help="seconds /recommend requests are gathered")
+    parser.add_argument('--max_batch', type=int, default=200, help="max users scored together")
+    parser.add_argument('--snapshots', default='/dev/shm/csrec', help="directory of the published models")
+    parser.add_argument('--publish_seconds', type=float, default=60)
+    parser.add_argument('--publish_writes', type=int, default=10000)
+    parser.add_argument('--poll_seconds', type=float, default=1.0, help="seconds between checks for a new model")
+    parser.add_argument('--result_cache_size', type=int, default=0, help="users whose results are cached")
+    parser.add_argument('--sparse', action='store_true')
+    parser.add_argument('--mongo_host', default=None)
+    parser.add_argument('--mongo_db_name', default=None)
+    args = parser.parse_args()
+
+    sockets = netutil.bind_sockets(args.port, address=args.host)
+    writes = multiprocessing.Queue()
+    # Recommenders are created after the fork, each process has its own (e.g. MongoClient)
+    if process.fork_processes(args.workers + 1) == WRITER:
+        for s in sockets:
+            s.close()
+        writer(writes, args)
+    else:
+        worker(sockets, writes, args)
+
+if __name__ == '__main__':
+    main()
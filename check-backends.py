@@ -0,0 +1,95 @@
+"""
+Check of the in-memory and MongoDB paths: Recommenders given the same items and ratings
+must give the same user info, co-occurrence and log-likelihood ratios (of items and of
+categories' values) and item_based recommendations, one user at a time and in batch.
+Recommendations with llr are not compared: equal ratios are common, and they are ranked
+by their position in the matrix, which is not the same with MongoDB.
+Each backend runs in a new process, as the Recommender is a singleton.
+
+Backends: memory, mongomock (MongoDB stand-in, pip install mongomock) and
+mongo (a real MongoDB at --mongo_host, whose --mongo_db_name is dropped!).
+
+Usage:
+python check-backends.py [--backends memory,mongomock] [--incremental] [--sparse] [--seed 0]
+                         [--mongo_host localhost:27017 --mongo_db_name csrec_check]
+"""
+import argparse
+import logging
+import multiprocessing
+import random
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backends', default='memory,mongomock', help="memory, mongomock, mongo, comma separated")
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--mongo_host', default='localhost:27017')
+parser.add_argument('--mongo_db_name', default='csrec_check')
+
+
+def entries(matrix, labels):
+    """
+    :return: {(row label, column label): value} of the nonzero entries of matrix
+    """
+    from scipy import sparse
+    coo = sparse.coo_matrix(matrix)
+    return dict(((labels[r], labels[c]), round(float(v), 4)) for r, c, v in zip(coo.row, coo.col, coo.data) if v)
+
+
+def run_case(case):
+    """
+    Insert the items and ratings in a new Recommender
+    :return: {name: {user_id (None or category for matrices): result}}
+    """
+    backend, args = case
+    kwargs = {}
+    if backend == 'mongomock':
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    if backend in ('mongo', 'mongomock'):
+        kwargs = {'mongo_host': args.mongo_host, 'mongo_db_name': args.mongo_db_name}
+    from csrec.Recommender import Recommender
+    engine = Recommender(incremental=args.incremental, sparse=args.sparse, log_level=logging.ERROR, **kwargs)
+    engine.drop_db()
+    rnd = random.Random(args.seed)
+    n_books = 150
+    users = ['u' + str(u) for u in range(100)]
+    for book in range(n_books):
+        engine.insert_item({'uid': 'b' + str(book), 'author': 'A' + str(rnd.randrange(10))}, _id='uid')
+    for _ in range(1200):
+        book = min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)
+        engine.insert_rating(rnd.choice(users), 'b' + str(book), rnd.randrange(1, 6), item_info=['author'])
+    users.append('nobody')
+    out = {'info': dict((user, engine.get_user_info(user)) for user in users)}
+    out['item_based'] = dict((user, engine.get_recommendations(user, max_recs=10)) for user in users)
+    out['item_based batch'] = {}
+    for chunk in engine.get_recommendations_batch(users, max_recs=10):
+        out['item_based batch'].update(chunk)
+    engine.get_recommendations(users[0], algorithm='llr')  # the model, if incremental
+    out['cooccurrence'], out['llr'] = {}, {}
+    for k in (None, 'author'):
+        out['cooccurrence'][k] = entries(*engine._cooccurrence_view(k))
+        out['llr'][k] = entries(*engine._llr_matrix(k))
+    if backend != 'memory':
+        engine.drop_db()
+    return out
+
+
+def main():
+    args = parser.parse_args()
+    backends = args.backends.split(',')
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    results = pool.map(run_case, [(backend, args) for backend in backends], chunksize=1)
+    pool.close()
+    different = 0
+    for backend, other in zip(backends[1:], results[1:]):
+        for name in sorted(results[0]):
+            n = sum(results[0][name][key] != other[name][key] for key in results[0][name])
+            print "%-10s %-16s %s of %s different from %s" % (backend, name, n, len(results[0][name]), backends[0])
+            different += n
+    assert not different
+    print "OK"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+Check of bulk ingestion: items and ratings given to insert_items_bulk and
+insert_ratings_bulk, or streamed from CSV and JSON lines files by load_items and
+load_ratings, must give the same user info, co-occurrence (of items and of categories'
+values) and recommendations as insert_item and insert_rating called one at a time.
+Chunks are small, and users rate some items again (also within a chunk), so the last
+rating must win. Each Recommender runs in a new process, as it is a singleton.
+
+Backends: memory, mongomock (MongoDB stand-in, pip install mongomock) and
+mongo (a real MongoDB at --mongo_host, whose --mongo_db_name is dropped!).
+
+Usage:
+python check-bulk.py [--backend memory] [--incremental] [--sparse] [--seed 0]
+                     [--mongo_host localhost:27017 --mongo_db_name csrec_check]
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='memory', help="memory, mongomock or mongo")
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--mongo_host', default='localhost:27017')
+parser.add_argument('--mongo_db_name', default='csrec_check')
+
+chunk_size = 97
+
+
+def entries(matrix, labels):
+    """
+    :return: {(row label, column label): value} of the nonzero entries of matrix
+    """
+    from scipy import sparse
+    coo = sparse.coo_matrix(matrix)
+    return dict(((labels[r], labels[c]), round(float(v), 4)) for r, c, v in zip(coo.row, coo.col, coo.data) if v)
+
+
+def run_case(case):
+    """
+    Insert the items and ratings in a new Recommender, one at a time or in bulk
+    :return: {name: {user_id (None or category for matrices): result}}
+    """
+    how, items, ratings, path, args = case
+    kwargs = {}
+    if args.backend == 'mongomock':
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    if args.backend in ('mongo', 'mongomock'):
+        kwargs = {'mongo_host': args.mongo_host, 'mongo_db_name': args.mongo_db_name}
+    from csrec.Recommender import Recommender
+    engine = Recommender(incremental=args.incremental, sparse=args.sparse, log_level=logging.ERROR, **kwargs)
+    engine.drop_db()
+    if how == 'one at a time':
+        for item in items:
+            engine.insert_item(dict(item), _id='uid')
+        for user, book, rating, t in ratings:
+            engine.insert_rating(user, book, rating, item_info=['author'], timestamp=t)
+    elif how == 'bulk':
+        assert engine.insert_items_bulk((dict(item) for item in items), _id='uid', chunk_size=chunk_size) == len(items)
+        assert engine.insert_ratings_bulk(iter(ratings), item_info=['author'], chunk_size=chunk_size) == len(ratings)
+    else:
+        extension = '.csv' if how == 'csv' else '.jsonl'
+        assert engine.load_items(os.path.join(path, 'items' + extension), _id='uid',
+                                 chunk_size=chunk_size) == len(items)
+        assert engine.load_ratings(os.path.join(path, 'ratings' + extension), item_info=['author'],
+                                   chunk_size=chunk_size) == len(ratings)
+    users = sorted(set(user for user, _, _, _ in ratings)) + ['nobody']
+    out = {'info': dict((user, engine.get_user_info(user)) for user in users)}
+    out['item_based'] = dict((user, engine.get_recommendations(user, max_recs=10)) for user in users)
+    engine.get_recommendations(users[0], algorithm='llr')  # the model, if incremental
+    out['cooccurrence'] = dict((k, entries(*engine._cooccurrence_view(k))) for k in (None, 'author'))
+    if args.backend != 'memory':
+        engine.drop_db()
+    return out
+
+
+def main():
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    n_books = 120
+    items = [{'uid': 'b' + str(book), 'author': 'A' + str(rnd.randrange(10))} for book in range(n_books)]
+    users = ['u' + str(u) for u in range(80)]
+    ratings = []
+    for n in range(1000):
+        if ratings and rnd.random() < 0.05:  # rated again, maybe in the same chunk
+            user, book, _, _ = ratings[-rnd.randrange(1, min(len(ratings), 150) + 1)]
+        else:
+            user, book = rnd.choice(users), 'b' + str(min(int(rnd.paretovariate(1.2)) - 1, n_books - 1))
+        ratings.append((user, book, rnd.randrange(1, 6), 1500000000. + n))
+    path = tempfile.mkdtemp()
+    try:
+        for name, rows, fields in (('items', items, ['uid', 'author']),
+                                   ('ratings', [dict(zip(('user_id', 'item_id', 'rating', 'timestamp'), r))
+                                                for r in ratings], ['user_id', 'item_id', 'rating', 'timestamp'])):
+            with open(os.path.join(path, name + '.csv'), 'wb') as f:
+                writer = csv.DictWriter(f, fields)
+                writer.writeheader()
+                writer.writerows(rows)
+            with open(os.path.join(path, name + '.jsonl'), 'w') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+        ways = ('one at a time', 'bulk', 'csv', 'jsonl')
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        results = pool.map(run_case, [(how, items, ratings, path, args) for how in ways], chunksize=1)
+        pool.close()
+    finally:
+        shutil.rmtree(path)
+    different = 0
+    for how, other in zip(ways[1:], results[1:]):
+        for name in sorted(results[0]):
+            n = sum(results[0][name][key] != other[name][key] for key in results[0][name])
+            print "%-6s %-16s %s of %s different from %s" % (how, name, n, len(results[0][name]), ways[0])
+            different += n
+    assert not different
+    print "OK"
+
+if __name__ == '__main__':
+    main()
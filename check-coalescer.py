@@ -0,0 +1,73 @@
+"""
+Check of the /recommend requests of recommender_async_api.py: gathered by the
+RecommendCoalescer and scored with one get_recommendations_batch, they must get
+the same results as get_recommendations, user by user. Checked again after more
+ratings are inserted, as a model (or incremental counts) out of date would show.
+
+Usage:
+python check-coalescer.py [--incremental] [--sparse] [--result_cache_size 1000]
+                          [--mongo_host localhost:27017 --mongo_db_name csrec_check]
+"""
+import argparse
+import logging
+import os
+import random
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
+from tornado.ioloop import IOLoop
+from csrec.Recommender import Recommender
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--result_cache_size', type=int, default=0)
+parser.add_argument('--mongo_host', default=None)
+parser.add_argument('--mongo_db_name', default='csrec_check')
+args = parser.parse_args()
+
+# the Recommender is a singleton: the server's engine is this one
+engine = Recommender(mongo_host=args.mongo_host, mongo_db_name=args.mongo_db_name,
+                     incremental=args.incremental, sparse=args.sparse,
+                     result_cache_size=args.result_cache_size, log_level=logging.ERROR)
+engine.drop_db()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin'))
+from recommender_async_api import RecommendCoalescer
+
+rnd = random.Random(0)
+n_books = 200
+authors = ['A' + str(i) for i in range(15)]
+books = ['b' + str(b) for b in range(n_books)]
+users = ['u' + str(u) for u in range(150)]
+for book in books:
+    engine.insert_item({'uid': book, 'author': rnd.choice(authors)}, _id='uid')
+
+
+def insert_ratings(n):
+    for _ in range(n):
+        book = books[min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)]
+        engine.insert_rating(rnd.choice(users), book, rnd.randrange(1, 6), item_info=['author'])
+
+coalescer = RecommendCoalescer(ThreadPoolExecutor(4), window=0.01, max_batch=50)
+
+
+@gen.coroutine
+def coalesced(requests):
+    recs = yield [coalescer.recommend(user, max_recs=max_recs, fast=fast) for user, max_recs, fast in requests]
+    raise gen.Return(recs)
+
+insert_ratings(1500)
+different = 0
+for round in range(3):
+    # not fast first: with fast, the model used is the one left by the previous requests
+    for fast in (False, True):
+        requests = [(user, max_recs, fast) for user in users + ['nobody'] for max_recs in (5, 10)]
+        recs = IOLoop.current().run_sync(lambda: coalesced(requests))
+        for (user, max_recs, _), coalesced_recs in zip(requests, recs):
+            if coalesced_recs != engine.get_recommendations(user, max_recs=max_recs, fast=fast):
+                different += 1
+        print "round %s, fast=%s: %s requests, %s different from get_recommendations so far" \
+            % (round, fast, len(requests), different)
+    insert_ratings(500)
+assert not different
+print "OK"
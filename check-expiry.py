@@ -0,0 +1,117 @@
+"""
+Check of the eviction of old ratings (rating_window): a Recommender whose ratings expire
+must end up as one given only the ratings still in the window, with the same user info,
+co-occurrence (of items and of categories' values) and recommendations (item_based and llr,
+one user at a time and in batch), popular items included. Ratings are evicted twice, with
+more ratings inserted in between. Each Recommender runs in a new process, as it is a singleton.
+Users rate each item once: a rating of an item rated before adds to the categories (see
+_insert_categories), and eviction only takes the rating kept out of them.
+
+Backends: memory, mongomock (MongoDB stand-in, pip install mongomock) and
+mongo (a real MongoDB at --mongo_host, whose --mongo_db_name is dropped!).
+
+Usage:
+python check-expiry.py [--backend memory] [--incremental] [--sparse] [--seed 0]
+                       [--mongo_host localhost:27017 --mongo_db_name csrec_check]
+"""
+import argparse
+import logging
+import multiprocessing
+import random
+from time import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='memory', help="memory, mongomock or mongo")
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--mongo_host', default='localhost:27017')
+parser.add_argument('--mongo_db_name', default='csrec_check')
+
+window = 1000.
+
+
+def entries(matrix, labels):
+    """
+    :return: {(row label, column label): value} of the nonzero entries of matrix
+    """
+    from scipy import sparse
+    coo = sparse.coo_matrix(matrix)
+    return dict(((labels[r], labels[c]), round(float(v), 4)) for r, c, v in zip(coo.row, coo.col, coo.data) if v)
+
+
+def run_case(case):
+    """
+    Insert the ratings in a new Recommender: all of them, evicting the old ones
+    at the given times, or only the ones still in the window at the end
+    :return: {name: {user_id (None or category for matrices): result}}
+    """
+    stage, books, users, ratings, expiries, args = case
+    kwargs = {}
+    if args.backend == 'mongomock':
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    if args.backend in ('mongo', 'mongomock'):
+        kwargs = {'mongo_host': args.mongo_host, 'mongo_db_name': args.mongo_db_name}
+    from csrec.Recommender import Recommender
+    engine = Recommender(incremental=args.incremental, sparse=args.sparse, log_level=logging.ERROR,
+                         rating_window=window if stage == 'expire' else None, **kwargs)
+    engine.drop_db()
+    for book, author in books:
+        engine.insert_item({'uid': book, 'author': author}, _id='uid')
+    evicted = 0
+    for user, book, rating, t in ratings:
+        if stage == 'expire':
+            while expiries and expiries[0] <= t:
+                evicted += engine.expire_ratings(expiries.pop(0))
+        if stage == 'expire' or t >= expiries[-1] - window:
+            engine.insert_rating(user, book, rating, item_info=['author'], timestamp=t)
+    for now in expiries if stage == 'expire' else []:
+        evicted += engine.expire_ratings(now)
+    users = users + ['nobody']
+    out = {'info': dict((user, engine.get_user_info(user)) for user in users)}
+    for algorithm in ('item_based', 'llr'):
+        out[algorithm] = dict((user, engine.get_recommendations(user, max_recs=10, algorithm=algorithm))
+                              for user in users)
+        out[algorithm + ' batch'] = {}
+        for chunk in engine.get_recommendations_batch(users, max_recs=10, algorithm=algorithm):
+            out[algorithm + ' batch'].update(chunk)
+    out['cooccurrence'] = dict((k, entries(*engine._cooccurrence_view(k))) for k in (None, 'author'))
+    if args.backend != 'memory':
+        engine.drop_db()
+    print "%s: %s ratings evicted" % (stage, evicted)
+    return out
+
+
+def main():
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    n_books = 150
+    books = [('b' + str(book), 'A' + str(rnd.randrange(10))) for book in range(n_books)]
+    users = ['u' + str(u) for u in range(100)]
+    # in the future, so that insert_rating evicts none of them itself
+    start = time() + 100 * window
+    pairs = set()
+    while len(pairs) < 2000:
+        book = books[min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)][0]
+        pairs.add((rnd.choice(users), book))
+    pairs = sorted(pairs)
+    rnd.shuffle(pairs)
+    ratings = [(user, book, rnd.randrange(1, 6), start + n * 3 * window / len(pairs))
+               for n, (user, book) in enumerate(pairs)]
+    expiries = [start + 2 * window, start + 3 * window]
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    evicting, remaining = pool.map(run_case, [(stage, books, users, ratings, list(expiries), args)
+                                              for stage in ('expire', 'remaining')], chunksize=1)
+    pool.close()
+    different = 0
+    for name in sorted(evicting):
+        n = sum(evicting[name][key] != remaining[name][key] for key in evicting[name])
+        print "%-16s %s of %s different" % (name, n, len(evicting[name]))
+        different += n
+    assert not different
+    print "OK"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Check of check_user_item_ratings (MongoDB only): item_ratings is drifted from
+user_ratings in one way at a time (a rating missing, one more, one changed, two
+swapped, a whole item missing). check_user_item_ratings(repair=False) must find it
+and write nothing, then check_user_item_ratings() must rebuild item_ratings as
+user_ratings transposed, and find them aligned afterwards. The rebuild is also run
+with chunks smaller than the collection.
+
+Backends: mongomock (MongoDB stand-in, pip install mongomock) and
+mongo (a real MongoDB at --mongo_host, whose --mongo_db_name is dropped!).
+
+Usage:
+python check-item-ratings.py [--backend mongomock] [--seed 0]
+                             [--mongo_host localhost:27017 --mongo_db_name csrec_check]
+"""
+import argparse
+import logging
+import random
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='mongomock', help="mongomock or mongo")
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--mongo_host', default='localhost:27017')
+parser.add_argument('--mongo_db_name', default='csrec_check')
+args = parser.parse_args()
+
+if args.backend == 'mongomock':
+    import mongomock
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+from csrec.Recommender import Recommender
+
+engine = Recommender(mongo_host=args.mongo_host, mongo_db_name=args.mongo_db_name, log_level=logging.CRITICAL)
+engine.drop_db()
+rnd = random.Random(args.seed)
+n_books = 60
+users = ['u' + str(u) for u in range(40)]
+for _ in range(500):
+    book = min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)
+    engine.insert_rating(rnd.choice(users), 'b' + str(book), rnd.randrange(1, 6))
+
+
+def documents(coll_name):
+    """
+    :return: {_id: {key: value}} of the documents with any key but _id
+    """
+    return dict((d['_id'], dict((k, v) for k, v in d.items() if k != '_id'))
+                for d in engine.db[coll_name].find() if len(d) > 1)
+
+
+def transposed():
+    """
+    :return: user_ratings as item_ratings should be, {item_id: {user_id: rating}}
+    """
+    items = {}
+    for user, ratings in documents('user_ratings').items():
+        for item, rating in ratings.items():
+            items.setdefault(item, {})[user] = rating
+    return items
+
+
+def drift(how):
+    """
+    Change item_ratings (not user_ratings) as how says
+    """
+    items = documents('item_ratings')
+    item = rnd.choice(sorted(items))
+    user = rnd.choice(sorted(items[item]))
+    coll = engine.db['item_ratings']
+    if how == 'missing rating':
+        coll.update({'_id': item}, {'$unset': {user: ''}})
+    elif how == 'one more rating':
+        other = rnd.choice(sorted(set(users) - set(items[item])))
+        coll.update({'_id': item}, {'$set': {other: 3.}})
+    elif how == 'changed rating':
+        coll.update({'_id': item}, {'$set': {user: items[item][user] % 5 + 1.}})
+    elif how == 'swapped ratings':  # same number and sum of ratings
+        other = rnd.choice(sorted(i for i in items if i != item and user not in items[i]))
+        coll.update({'_id': item}, {'$unset': {user: ''}})
+        coll.update({'_id': other}, {'$set': {user: items[item][user]}})
+    elif how == 'missing item':
+        coll.remove({'_id': item})
+
+
+assert engine.check_user_item_ratings(repair=False)
+assert documents('item_ratings') == transposed()
+for how in ('missing rating', 'one more rating', 'changed rating', 'swapped ratings', 'missing item'):
+    drift(how)
+    drifted = documents('item_ratings')
+    assert drifted != transposed()
+    assert not engine.check_user_item_ratings(repair=False), how
+    assert documents('item_ratings') == drifted, "written with repair=False"
+    assert not engine.check_user_item_ratings(), how
+    assert documents('item_ratings') == transposed(), how
+    assert engine.check_user_item_ratings(), how
+    print "%s: found and repaired" % how
+drift('changed rating')
+engine._sync_user_item_ratings(chunk_size=7)
+assert documents('item_ratings') == transposed()
+assert engine.check_user_item_ratings(repair=False)
+print "%s ratings of %s items aligned, also rebuilt in chunks" % (
+    sum(len(ratings) for ratings in transposed().values()), len(transposed()))
+engine.drop_db()
+print "OK"
@@ -0,0 +1,76 @@
+"""
+Check of the vectorized log-likelihood ratio: LogLikelihoodRatios and tools.SparseMatrix.llr
+must give the ratios of the scalar LogLikelihoodRatio, table by table and pair by pair,
+and llr must keep exactly the pairs above min_llr (the max_per_row highest of each row).
+
+Usage:
+python check-llr.py [--items 60] [--users 300] [--seed 0]
+"""
+import argparse
+import numpy as np
+from scipy import sparse
+from tools.Functions import LogLikelihoodRatio, LogLikelihoodRatios
+from tools.SparseMatrix import llr
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--items', type=int, default=60)
+parser.add_argument('--users', type=int, default=300)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+rnd = np.random.RandomState(args.seed)
+
+
+def close(a, b):
+    return abs(a - b) <= 1e-9 * max(1., abs(b))
+
+# random tables, with zeros
+tables = rnd.randint(0, 50, size=(2000, 4)) * (rnd.rand(2000, 4) > 0.1)
+ratios = LogLikelihoodRatios(tables[:, 0], tables[:, 1], tables[:, 2], tables[:, 3])
+scalar = np.array([max(LogLikelihoodRatio(list(t)), 0) for t in tables.astype(np.float64)])
+print "tables: max difference %.3g" % np.abs(ratios - scalar).max()
+assert all(close(a, b) for a, b in zip(ratios, scalar))
+
+# co-occurrence of binarized ratings, items with Zipf popularity
+popularity = 1. / np.arange(1, args.items + 1)
+rated = rnd.rand(args.users, args.items) < 0.3 * popularity / popularity.mean()
+rated = rated[rated.any(axis=1)]
+n_users = len(rated)
+cooccurrence = rated.T.astype(int).dot(rated.astype(int))
+n = cooccurrence.diagonal()
+
+
+def expected(min_llr):
+    """
+    {(row, col): scalar ratio} of the pairs co-occurring more than expected, above min_llr
+    """
+    pairs = {}
+    for r in range(args.items):
+        for c in range(args.items):
+            k11 = cooccurrence[r, c]
+            if r != c and k11 > 0 and k11 * n_users > n[r] * n[c]:
+                ratio = LogLikelihoodRatio([k11, n[r] - k11, n[c] - k11, n_users - n[r] - n[c] + k11])
+                if ratio >= min_llr:
+                    pairs[(r, c)] = ratio
+    return pairs
+
+for min_llr in (0., 3.84):
+    reference = expected(min_llr)
+    for matrix in (cooccurrence, sparse.csr_matrix(cooccurrence)):
+        ratios = llr(matrix, n_users, min_llr).tocoo()
+        got = dict(((r, c), v) for r, c, v in zip(ratios.row, ratios.col, ratios.data))
+        assert set(got) == set(reference)
+        # ratios are float32
+        assert all(abs(got[pair] - ratio) <= 1e-6 * max(1., ratio) for pair, ratio in reference.items())
+    print "min_llr %s: %s pairs" % (min_llr, len(reference))
+
+reference = expected(3.84)
+for max_per_row in (1, 2):
+    got = llr(cooccurrence, n_users, 3.84, max_per_row).tocsr()
+    for r in range(args.items):
+        row = sorted([ratio for (rr, _), ratio in reference.items() if rr == r], reverse=True)
+        kept = sorted(got.getrow(r).data, reverse=True)
+        assert len(kept) == min(len(row), max_per_row)
+        # the highest ones (ties can be kept either way)
+        assert all(abs(a - b) <= 1e-6 * max(1., b) for a, b in zip(kept, row))
+    print "max_per_row %s: %s pairs" % (max_per_row, got.nnz)
+print "OK"
@@ -0,0 +1,101 @@
+"""
+Check of reconcile_many: merging many sessions into users at once must give the same
+user info, co-occurrence (of items and of categories' values) and recommendations as
+reconcile_ids called for each pair in turn. Pairs include new users and chains (a
+session merged into another one, then into a user). If incremental, the counts must
+also be those of a full rebuild (see check_cooccurrence). Each Recommender runs in a
+new process, as it is a singleton.
+
+Backends: memory, mongomock (MongoDB stand-in, pip install mongomock) and
+mongo (a real MongoDB at --mongo_host, whose --mongo_db_name is dropped!).
+
+Usage:
+python check-reconcile.py [--backend memory] [--incremental] [--sparse] [--seed 0]
+                          [--mongo_host localhost:27017 --mongo_db_name csrec_check]
+"""
+import argparse
+import logging
+import multiprocessing
+import random
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='memory', help="memory, mongomock or mongo")
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--mongo_host', default='localhost:27017')
+parser.add_argument('--mongo_db_name', default='csrec_check')
+
+
+def entries(matrix, labels):
+    """
+    :return: {(row label, column label): value} of the nonzero entries of matrix
+    """
+    from scipy import sparse
+    coo = sparse.coo_matrix(matrix)
+    return dict(((labels[r], labels[c]), round(float(v), 4)) for r, c, v in zip(coo.row, coo.col, coo.data) if v)
+
+
+def run_case(case):
+    """
+    Insert the ratings in a new Recommender, and reconcile the pairs
+    :return: {name: {user_id (None or category for matrices): result}}
+    """
+    how, pairs, args = case
+    kwargs = {}
+    if args.backend == 'mongomock':
+        import mongomock
+        import pymongo
+        pymongo.MongoClient = mongomock.MongoClient
+    if args.backend in ('mongo', 'mongomock'):
+        kwargs = {'mongo_host': args.mongo_host, 'mongo_db_name': args.mongo_db_name}
+    from csrec.Recommender import Recommender
+    engine = Recommender(incremental=args.incremental, sparse=args.sparse, log_level=logging.ERROR, **kwargs)
+    engine.drop_db()
+    rnd = random.Random(args.seed)
+    n_books = 120
+    users = ['u' + str(u) for u in range(60)] + ['s' + str(s) for s in range(40)]
+    for book in range(n_books):
+        engine.insert_item({'uid': 'b' + str(book), 'author': 'A' + str(rnd.randrange(10))}, _id='uid')
+    for _ in range(1000):
+        book = min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)
+        engine.insert_rating(rnd.choice(users), 'b' + str(book), rnd.randrange(1, 6), item_info=['author'])
+    if how == 'many':
+        assert engine.reconcile_many(pairs) == len(pairs)
+    else:
+        for id_old, id_new in pairs:
+            engine.reconcile_ids(id_old, id_new)
+    users += sorted(set(id_new for _, id_new in pairs))
+    out = {'info': dict((user, engine.get_user_info(user)) for user in users)}
+    out['item_based'] = dict((user, engine.get_recommendations(user, max_recs=10)) for user in users)
+    engine.get_recommendations(users[0], algorithm='llr')  # the model, if incremental
+    out['cooccurrence'] = dict((k, entries(*engine._cooccurrence_view(k))) for k in (None, 'author'))
+    if args.incremental:
+        out['consistent'] = {None: engine.check_cooccurrence()}
+    if args.backend != 'memory':
+        engine.drop_db()
+    return out
+
+
+def main():
+    args = parser.parse_args()
+    pairs = [('s' + str(s), 'u' + str(s)) for s in range(30)]
+    pairs += [('s' + str(s), 'new' + str(s)) for s in range(30, 35)]
+    pairs += [('s35', 's36'), ('s36', 'u40'), ('s37', 's38'), ('s38', 'new38')]  # chains
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    many, one_by_one = pool.map(run_case, [(how, pairs, args) for how in ('many', 'one by one')], chunksize=1)
+    pool.close()
+    for id_old, _ in pairs:
+        assert many['info'][id_old] == {}
+    if args.incremental:
+        assert many['consistent'][None] and one_by_one['consistent'][None]
+    different = 0
+    for name in sorted(many):
+        n = sum(many[name][key] != one_by_one[name][key] for key in many[name])
+        print "%-16s %s of %s different" % (name, n, len(many[name]))
+        different += n
+    assert not different
+    print "OK"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Check of the result cache with get_recommendations_batch: a rating inserted while a
+chunk is being scored must not leave the results scored before it in the cache.
+The rating is inserted from another thread right after the chunk is scored, and it
+is the first item recommended to the user, so their results must change.
+
+Usage:
+python check-result-cache.py [--sparse] [--seed 0]
+"""
+import argparse
+import logging
+import random
+import threading
+from csrec.Recommender import Recommender
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+engine = Recommender(sparse=args.sparse, result_cache_size=1000, log_level=logging.ERROR)
+engine.drop_db()
+rnd = random.Random(args.seed)
+n_books = 100
+users = ['u' + str(u) for u in range(80)]
+for book in range(n_books):
+    engine.insert_item({'uid': 'b' + str(book), 'author': 'A' + str(rnd.randrange(10))}, _id='uid')
+for _ in range(800):
+    book = min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)
+    engine.insert_rating(rnd.choice(users), 'b' + str(book), rnd.randrange(1, 6), item_info=['author'])
+engine.insert_rating('target', 'b1', 4, item_info=['author'])
+before = engine.get_recommendations('target', max_recs=5)  # builds the model
+writers = []
+score_chunk = engine._recommend_block
+
+
+def racing_block(user_ids, max_recs, batch_model=None):
+    recs = score_chunk(user_ids, max_recs, batch_model)
+    writer = threading.Thread(target=engine.insert_rating, args=('target', before[0], 5, ['author']))
+    writer.start()
+    writer.join(0.5)  # done, unless the chunk holds the lock until its results are cached
+    writers.append(writer)
+    return recs
+
+engine._recommend_block = racing_block
+for chunk in engine.get_recommendations_batch(users + ['target'], max_recs=5, fast=True, chunk_size=100):
+    pass
+del engine._recommend_block
+for writer in writers:
+    writer.join()
+
+cached = engine.get_recommendations('target', max_recs=5, fast=True)
+scored = engine._recommend('target', 5, True, 'item_based')
+print "before the rating:", before
+print "cached:", cached
+print "scored:", scored
+assert before[0] not in scored
+assert cached == scored
+print "OK"
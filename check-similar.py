@@ -0,0 +1,69 @@
+"""
+Check of get_similar_item against a brute-force top-K: for each item, the similar
+items must have the highest scores of its row of the co-occurrence (or of the
+log-likelihood ratios), computed here from the ratings inserted, highest first.
+Equal scores can be returned in any order. With user_id, the user's rated items
+must be left out and the scores weighed by the user's rating of the item.
+
+Usage:
+python check-similar.py [--incremental] [--sparse] [--seed 0]
+"""
+import argparse
+import logging
+import random
+import numpy as np
+from csrec.Recommender import Recommender
+from tools.Functions import LogLikelihoodRatio
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+k = 10
+engine = Recommender(incremental=args.incremental, sparse=args.sparse, similar_items=k,
+                     llr_neighbors=None, log_level=logging.ERROR)
+engine.drop_db()
+rnd = random.Random(args.seed)
+n_books = 80
+books = ['b' + str(b) for b in range(n_books)]
+users = ['u' + str(u) for u in range(120)]
+ratings = {}
+for _ in range(1000):
+    user, book = rnd.choice(users), books[min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)]
+    ratings[(user, book)] = rnd.randrange(1, 6)
+    engine.insert_rating(user, book, ratings[(user, book)])
+
+# brute force: co-occurrence of the users' rated items, and its log-likelihood ratios
+rated = np.zeros((len(users), n_books), dtype=int)
+for (user, book), rating in ratings.items():
+    rated[users.index(user), books.index(book)] = 1
+cooccurrence = rated.T.dot(rated)
+n, n_users = cooccurrence.diagonal(), int(rated.any(axis=1).sum())
+ratios = np.zeros(cooccurrence.shape)
+for r in range(n_books):
+    for c in range(n_books):
+        k11 = cooccurrence[r, c]
+        if r != c and k11 > 0 and k11 * n_users > n[r] * n[c]:
+            ratio = LogLikelihoodRatio([k11, n[r] - k11, n[c] - k11, n_users - n[r] - n[c] + k11])
+            ratios[r, c] = ratio if ratio >= engine.llr_threshold else 0
+
+for algorithm, scores in (('simple', cooccurrence), ('llr', ratios)):
+    checked = 0
+    for b, book in enumerate(books):
+        row = [(float(scores[b, c]), other) for c, other in enumerate(books) if c != b and scores[b, c] > 0]
+        expected = sorted([score for score, _ in row], reverse=True)[:k]
+        similar = engine.get_similar_item(book, algorithm=algorithm, max_items=k)
+        # the highest scores, each the score of its item
+        assert len(similar) == len(expected), (algorithm, book)
+        assert np.allclose([score for _, score in similar], expected, rtol=1e-5), (algorithm, book)
+        assert all(np.isclose(score, scores[b, books.index(other)], rtol=1e-5) for other, score in similar)
+        for user in users[:10]:
+            weight = ratings.get((user, book), 1)
+            for other, score in engine.get_similar_item(book, user_id=user, algorithm=algorithm, max_items=k):
+                assert (user, other) not in ratings
+                assert np.isclose(score, scores[b, books.index(other)] * weight, rtol=1e-5)
+        checked += len(similar) > 0
+    print "%s: %s items with similar items" % (algorithm, checked)
+print "OK"
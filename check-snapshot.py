@@ -0,0 +1,89 @@
+"""
+Check of save_snapshot and load_snapshot: a Recommender loading the snapshot saved by
+another one must give the same user info and recommendations (item_based and llr, one
+user at a time and in batch), also after the same ratings (of new users and items too)
+are inserted in both. Each Recommender runs in a new process, as it is a singleton.
+
+Usage:
+python check-snapshot.py [--incremental] [--sparse] [--seed 0]
+"""
+import argparse
+import logging
+import multiprocessing
+import random
+import shutil
+import tempfile
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+
+
+def results(engine, users):
+    """
+    :return: {name: {user_id: result}}
+    """
+    out = {'info': dict((user, engine.get_user_info(user)) for user in users)}
+    for algorithm in ('item_based', 'llr'):
+        out[algorithm] = dict((user, engine.get_recommendations(user, max_recs=10, fast=True, algorithm=algorithm))
+                              for user in users)
+        out[algorithm + ' batch'] = {}
+        for chunk in engine.get_recommendations_batch(users, max_recs=10, fast=True, algorithm=algorithm):
+            out[algorithm + ' batch'].update(chunk)
+    return out
+
+
+def run_case(case):
+    """
+    Save the snapshot of a new Recommender, or load it in a new Recommender
+    :return: results of the Recommender
+    """
+    stage, path, args = case
+    from csrec.Recommender import Recommender
+    engine = Recommender(incremental=args.incremental, sparse=args.sparse, log_level=logging.ERROR)
+    rnd = random.Random(args.seed)
+    n_books = 150
+    users = ['u' + str(u) for u in range(100)] + ['nobody']
+    if stage == 'save':
+        for book in range(n_books):
+            engine.insert_item({'uid': 'b' + str(book), 'author': 'A' + str(rnd.randrange(10))}, _id='uid')
+        for _ in range(1200):
+            book = min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)
+            engine.insert_rating(rnd.choice(users[:-1]), 'b' + str(book), rnd.randrange(1, 6), item_info=['author'])
+        engine.get_recommendations(users[0])  # builds the model
+        engine.save_snapshot(path)
+    else:
+        engine.load_snapshot(path)
+        assert type(engine.user_ids).__name__ == type(engine.item_ids).__name__ == 'MappedIdRegistry'
+    out = results(engine, users)
+    rnd = random.Random(args.seed + 1)
+    for _ in range(200):
+        book = min(int(rnd.paretovariate(1.2)) - 1, n_books + 9)
+        engine.insert_rating(rnd.choice(users[:-1] + ['new' + str(u) for u in range(10)]), 'b' + str(book),
+                             rnd.randrange(1, 6), item_info=['author'])
+    users += ['new' + str(u) for u in range(10)]
+    for name, result in results(engine, users).items():
+        out[name + ' after writes'] = result
+    return out
+
+
+def main():
+    args = parser.parse_args()
+    path = tempfile.mkdtemp()
+    try:
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        saved, loaded = pool.map(run_case, [('save', path, args), ('load', path, args)], chunksize=1)
+        pool.close()
+    finally:
+        shutil.rmtree(path)
+    different = 0
+    for name in sorted(saved):
+        n = sum(saved[name][user] != loaded[name][user] for user in saved[name])
+        print "%-30s %s users, %s different" % (name, len(saved[name]), n)
+        different += n
+    assert not different
+    print "OK"
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+"""
+Check of _top_k, which get_recommendations and get_recommendations_batch rank with:
+for any k, with or without candidates and ties, it must give the first k positions
+of a full sort by score (highest first), then ties (highest first), then position.
+Scores are drawn from few values, so that many of them are equal.
+
+Usage:
+python check-top-k.py [--rounds 500] [--seed 0]
+"""
+import argparse
+import numpy as np
+from csrec.Recommender import _top_k
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rounds', type=int, default=500)
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+rnd = np.random.RandomState(args.seed)
+
+checked = 0
+for _ in range(args.rounds):
+    n = rnd.randint(0, 60)
+    scores = rnd.randint(0, rnd.randint(1, 10), size=n) / 2.
+    ties = rnd.randint(0, 3, size=n).astype(np.float64) if rnd.rand() < 0.5 else None
+    candidates = rnd.rand(n) < 0.7 if rnd.rand() < 0.5 else None
+    positions = np.arange(n) if candidates is None else np.flatnonzero(candidates)
+    secondary = np.zeros(n) if ties is None else ties
+    ranked = positions[np.lexsort((positions, -secondary[positions], -scores[positions]))]
+    for k in range(-1, n + 2):
+        top = _top_k(scores, k, candidates, ties)
+        assert top.tolist() == ranked[:max(k, 0)].tolist(), (scores, ties, candidates, k)
+        checked += 1
+print "%s rankings checked" % checked
+print "OK"
@@ -0,0 +1,117 @@
+"""
+Check of write_behind (MongoDB only): ratings kept in memory must not be in the db
+until write_behind of them are pending, a read comes (which must see them), or
+write_behind_seconds pass, and then the timer must write them with no other call.
+In the end the db must hold what insert_rating writes without write_behind: the last
+rating of each user and item in user_ratings and, transposed, in item_ratings, and
+the sum and number of all the ratings of each author by each user.
+
+Backends: mongomock (MongoDB stand-in, pip install mongomock) and
+mongo (a real MongoDB at --mongo_host, whose --mongo_db_name is dropped!).
+
+Usage:
+python check-write-behind.py [--backend mongomock] [--incremental] [--seed 0]
+                             [--mongo_host localhost:27017 --mongo_db_name csrec_check]
+"""
+import argparse
+import logging
+import random
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--backend', default='mongomock', help="mongomock or mongo")
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--mongo_host', default='localhost:27017')
+parser.add_argument('--mongo_db_name', default='csrec_check')
+args = parser.parse_args()
+
+if args.backend == 'mongomock':
+    import mongomock
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+from csrec.Recommender import Recommender
+
+size, seconds = 50, 2.0
+engine = Recommender(mongo_host=args.mongo_host, mongo_db_name=args.mongo_db_name, incremental=args.incremental,
+                     write_behind=size, write_behind_seconds=seconds, log_level=logging.ERROR)
+engine.drop_db()
+rnd = random.Random(args.seed)
+n_books = 60
+authors = dict(('b' + str(book), 'A' + str(rnd.randrange(8))) for book in range(n_books))
+for book, author in sorted(authors.items()):
+    engine.insert_item({'_id': book, 'author': author})
+users = ['u' + str(u) for u in range(30)]
+expected, categories = {}, {}
+
+
+def stored():
+    """
+    :return: {(user_id, item_id): rating} read from the db, not through the Recommender
+    """
+    return dict(((doc['_id'], item), rating) for doc in engine.db['user_ratings'].find()
+                for item, rating in doc.items() if item != '_id')
+
+
+def insert(n):
+    """
+    Insert n ratings (some of them again, also while pending), and check they are not written yet
+    """
+    started = time.time()
+    before = stored()
+    for _ in range(n):
+        if expected and rnd.random() < 0.2:
+            user, book = rnd.choice(sorted(expected))
+        else:
+            user, book = rnd.choice(users), 'b' + str(min(int(rnd.paretovariate(1.2)) - 1, n_books - 1))
+        rating = rnd.randrange(1, 6)
+        engine.insert_rating(user, book, rating, item_info=['author'])
+        expected[(user, book)] = float(rating)
+        t, count = categories.get((user, authors[book]), (0., 0))
+        categories[(user, authors[book])] = (t + rating, count + 1)
+    assert time.time() - started < seconds, "too slow to check the timer"
+    assert stored() == before, "written before a threshold"
+    assert len(engine._pending_ratings) == n
+
+
+# size: the size-th rating writes them all
+insert(size - 1)
+engine.insert_rating('u0', 'b0', 3, item_info=['author'])
+expected[('u0', 'b0')] = 3.
+t, count = categories.get(('u0', authors['b0']), (0., 0))
+categories[('u0', authors['b0'])] = (t + 3, count + 1)
+assert not engine._pending_ratings and stored() == expected
+print "size: %s ratings written at once" % size
+
+# read: any other call writes them first, and sees them
+insert(size / 2)
+user = rnd.choice(sorted(set(pending[0] for pending in engine._pending_ratings)))
+info = engine.get_user_info(user)
+assert not engine._pending_ratings and stored() == expected
+assert dict((book, rating) for book, rating in info.items() if book != '_id') == \
+    dict((book, rating) for (other, book), rating in expected.items() if other == user)
+print "read: %s ratings written before get_user_info" % (size / 2)
+
+# timer: written write_behind_seconds after the oldest one, with no other call
+insert(size / 2)
+deadline = time.time() + 3 * seconds
+while engine._pending_ratings and time.time() < deadline:
+    time.sleep(0.05)
+assert not engine._pending_ratings, "not written by the timer"
+with engine._lock.read():  # taken by the timer until written
+    pass
+assert stored() == expected
+print "timer: %s ratings written by the timer" % (size / 2)
+
+items = {}
+for (user, book), rating in expected.items():
+    items.setdefault(book, {})[user] = rating
+assert dict((doc['_id'], dict((k, v) for k, v in doc.items() if k != '_id'))
+            for doc in engine.db['item_ratings'].find() if len(doc) > 1) == items
+assert dict(((doc['_id'], value), (c['t'], c['n'])) for doc in engine.db['user_author_ratings'].find()
+            for value, c in doc.items() if value != '_id') == categories
+if args.incremental:
+    assert engine.check_cooccurrence()
+print "%s ratings in user_ratings, item_ratings and user_author_ratings" % len(expected)
+engine.drop_db()
+print "OK"
@@ -0,0 +1,151 @@
+from array import array
+import numpy as np
+from tools.IdRegistry import IdRegistry
+
+
+class CategoryStore(object):
+    """
+    Ratings of the values of one category (e.g. author) by each user: the sum and the
+    number of the ratings given to items with the value. Entries (user, value, sum, count)
+    are kept once, in growable typed arrays, users being the integer indices given by an
+    IdRegistry, values interned in the store's own. As in RatingStore, each user keeps
+    the slots of their entries; the users x values view is derived from the arrays
+    when needed (see entries), not kept.
+    """
+    def __init__(self, capacity=1024):
+        self.values = IdRegistry()  # value of each value index
+        self._users = np.empty(capacity, dtype=np.int32)  # -1 for removed entries
+        self._values = np.empty(capacity, dtype=np.int32)
+        self._tot = np.empty(capacity, dtype=np.float64)  # sum of the ratings
+        self._n = np.empty(capacity, dtype=np.int32)  # number of the ratings
+        self._size = 0  # slots used so far
+        self._free = []  # slots of removed entries, to be reused
+        self._user_slots = []  # for each user, array of the slots of their entries
+
+    def _grow(self):
+        capacity = max(2 * len(self._users), 1024)
+        for name in ('_users', '_values', '_tot', '_n'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _slots(self, user):
+        if user < len(self._user_slots) and len(self._user_slots[user]) > 0:
+            return np.frombuffer(self._user_slots[user], dtype=np.int32)
+        return np.empty(0, dtype=np.int32)
+
+    def _find(self, user, value):
+        v = self.values.get(value)
+        if v is None:
+            return None
+        slots = self._slots(user)
+        found = slots[self._values[slots] == v]
+        return int(found[0]) if len(found) > 0 else None
+
+    def _new_slot(self, user, value):
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._size == len(self._users):
+                self._grow()
+            slot = self._size
+            self._size += 1
+        self._users[slot] = user
+        self._values[slot] = self.values.intern(value)
+        self._tot[slot] = 0
+        self._n[slot] = 0
+        while len(self._user_slots) <= user:
+            self._user_slots.append(array('i'))
+        self._user_slots[user].append(slot)
+        return slot
+
+    def _remove_slot(self, slot):
+        self._user_slots[self._users[slot]].remove(slot)
+        self._users[slot] = -1
+        self._free.append(slot)
+
+    def add(self, user, value, rating, n=1):
+        """
+        Add n ratings summing to rating (e.g. -rating, -1 to take one away).
+        The entry is removed when its count reaches 0
+        :param user: user index
+        :param value: e.g. the author
+        :return: number of ratings of value by user after the change
+        """
+        slot = self._find(user, value)
+        if slot is None:
+            slot = self._new_slot(user, value)
+        self._tot[slot] += rating
+        self._n[slot] += n
+        count = int(self._n[slot])
+        if count <= 0:
+            self._remove_slot(slot)
+        return count
+
+    def set(self, user, value, tot, n):
+        """
+        Replace the sum and the number of ratings of value by user
+        """
+        slot = self._find(user, value)
+        if slot is None:
+            slot = self._new_slot(user, value)
+        self._tot[slot] = tot
+        self._n[slot] = n
+
+    def get(self, user, value):
+        """
+        :return: sum and number of the ratings of value by user, (0., 0) if none
+        """
+        slot = self._find(user, value)
+        return (0., 0) if slot is None else (float(self._tot[slot]), int(self._n[slot]))
+
+    def user_values(self, user):
+        """
+        :return: values rated by user (list), sums and numbers of their ratings (arrays)
+        """
+        slots = self._slots(user)
+        return self.values.ids(self._values[slots]), self._tot[slots], self._n[slots]
+
+    def remove_user(self, user):
+        """
+        Remove all the entries of user
+        :return: as user_values, for the removed entries
+        """
+        removed = self.user_values(user)
+        for slot in self._slots(user):
+            self._users[slot] = -1
+            self._free.append(int(slot))
+        if user < len(self._user_slots):
+            self._user_slots[user] = array('i')
+        return removed
+
+    def entries(self):
+        """
+        :return: users, value indices, sums, numbers (arrays) of all the entries
+        """
+        valid = self._users[:self._size] >= 0
+        return self._users[:self._size][valid], self._values[:self._size][valid], \
+            self._tot[:self._size][valid], self._n[:self._size][valid]
+
+    @classmethod
+    def from_entries(cls, values, users, value_indices, tots, ns):
+        """
+        Store holding the given entries, arrays used as they are (e.g. memory-mapped)
+        until the store needs to grow.
+        :param values: value of each value index
+        :return: CategoryStore
+        """
+        store = cls(capacity=0)
+        store.values = IdRegistry(values)
+        store._users, store._values, store._tot, store._n = users, value_indices, tots, ns
+        store._size = len(users)
+        if len(users) > 0:
+            slots = np.argsort(users, kind='mergesort').astype(np.int32)
+            bounds = np.searchsorted(users[slots], np.arange(users.max() + 2))
+            store._user_slots = [array('i', slots[bounds[u]:bounds[u + 1]].tobytes())
+                                 for u in range(len(bounds) - 1)]
+        return store
+
+    def __len__(self):
+        return self._size - len(self._free)
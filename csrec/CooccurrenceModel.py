@@ -0,0 +1,48 @@
+from time import time
+
+
+class CooccurrenceModel(object):
+    """
+    Co-occurrence matrices of items and categories, as built at a given time.
+    A model is never changed once built: a rebuild creates a new one, which the
+    Recommender publishes by replacing its reference, so readers holding the
+    previous one keep a consistent (if older) view. Only what is derived from
+    its own matrices (e.g. LLR, neighbors of the items) is added to it later.
+    """
+    def __init__(self, items=None, items_labels=None, categories=None, categories_labels=None,
+                 updated=0.0, build_seconds=0.0, n_ratings=0, n_users=None):
+        """
+        :param items: co-occurrence of items (ndarray, or csr if sparse)
+        :param items_labels: IdRegistry of the item_id of each row/column
+        :param categories: {cat: co-occurrence of the values of cat}
+        :param categories_labels: {cat: IdRegistry of values}
+        :param updated: time of the build
+        :param build_seconds: duration of the build
+        :param n_ratings: ratings inserted (see Recommender) when the build started
+        :param n_users: {None for items, otherwise the category: number of users in the matrix}
+        """
+        self.items = items
+        self.items_labels = items_labels
+        self.categories = categories or {}
+        self.categories_labels = categories_labels or {}
+        self.updated = updated
+        self.build_seconds = build_seconds
+        self.n_ratings = n_ratings
+        self.n_users = n_users or {}
+        self.llr = {}  # {None or category: (LLR matrix, labels)}, see Recommender._llr_matrix
+        self.neighbors = {}  # {algorithm: NeighborIndex of the items}, see Recommender._neighbor_index
+
+    def matrix(self, k=None):
+        """
+        :param k: None for items, otherwise the category
+        :return: co-occurrence matrix and the labels of its rows/columns (IdRegistry)
+        """
+        if k is None:
+            return self.items, self.items_labels
+        return self.categories.get(k), self.categories_labels.get(k)
+
+    def age(self):
+        """
+        :return: seconds since the build, None if the model was never built
+        """
+        return time() - self.updated if self.updated else None
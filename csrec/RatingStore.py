@@ -0,0 +1,264 @@
+from array import array
+import numpy as np
+
+
+class RatingStore(object):
+    """
+    Ratings kept as (user, item, rating) triplets in growable typed arrays,
+    users and items being the integer indices given by an IdRegistry, with
+    the time of each rating. Each user also keeps the positions (slots) of
+    their ratings, so that their history is read without scanning the whole store.
+    If expiring, slots are also queued by the time they are set to, so that the
+    oldest ratings are found without scanning the store either (see expire).
+    """
+    def __init__(self, capacity=1024, expiring=False):
+        self._users = np.empty(capacity, dtype=np.int32)  # -1 for removed ratings
+        self._items = np.empty(capacity, dtype=np.int32)
+        self._ratings = np.empty(capacity, dtype=np.float32)
+        self._times = np.empty(capacity, dtype=np.float64)  # time of the rating (e.g. time())
+        self._size = 0  # slots used so far
+        self._free = []  # slots of removed ratings, to be reused
+        self._user_slots = []  # for each user, array of the slots of their ratings
+        self.expiring = expiring
+        self._queue_slots = array('i')  # slots, in time order (sorted again when needed)
+        self._queue_times = array('d')  # ...with the time they were set to
+        self._queue_head = 0  # first entry of the queue not yet expired
+        self._queue_sorted = True  # False if a time was older than the ones queued before it
+
+    def _grow(self):
+        capacity = max(2 * len(self._users), 1024)
+        for name in ('_users', '_items', '_ratings', '_times'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+
+    def _slots(self, user):
+        if user < len(self._user_slots) and len(self._user_slots[user]) > 0:
+            return np.frombuffer(self._user_slots[user], dtype=np.int32)
+        return np.empty(0, dtype=np.int32)
+
+    def _find(self, user, item):
+        slots = self._slots(user)
+        found = slots[self._items[slots] == item]
+        return found[0] if len(found) > 0 else None
+
+    def _enqueue(self, slots, times):
+        if not self.expiring or not len(slots):
+            return
+        if len(times) > 1:
+            order = np.argsort(times, kind='mergesort')
+            slots, times = np.asarray(slots)[order].tolist(), np.asarray(times, dtype=np.float64)[order].tolist()
+        if len(self._queue_times) > self._queue_head and times[0] < self._queue_times[-1]:
+            self._queue_sorted = False
+        self._queue_slots.extend(slots)
+        self._queue_times.extend(times)
+
+    def _sort_queue(self):
+        slots = np.frombuffer(self._queue_slots, dtype=np.int32)[self._queue_head:]
+        times = np.frombuffer(self._queue_times, dtype=np.float64)[self._queue_head:]
+        order = np.argsort(times, kind='mergesort')
+        self._queue_slots = array('i', slots[order].tobytes())
+        self._queue_times = array('d', times[order].tobytes())
+        self._queue_head = 0
+        self._queue_sorted = True
+
+    def set(self, user, item, rating, t=0.):
+        """
+        Insert or update the rating of user for item
+        :param t: time of the rating
+        :return: True if the user had not rated the item before
+        """
+        slot = self._find(user, item)
+        if slot is not None:
+            self._ratings[slot] = rating
+            self._times[slot] = t
+            self._enqueue([int(slot)], [t])
+            return False
+        if self._free:
+            slot = self._free.pop()
+        else:
+            if self._size == len(self._users):
+                self._grow()
+            slot = self._size
+            self._size += 1
+        self._users[slot] = user
+        self._items[slot] = item
+        self._ratings[slot] = rating
+        self._times[slot] = t
+        self._enqueue([slot], [t])
+        while len(self._user_slots) <= user:
+            self._user_slots.append(array('i'))
+        self._user_slots[user].append(slot)
+        return True
+
+    def set_many(self, users, items, ratings, times=None):
+        """
+        As set, for arrays of ratings (on duplicates the last one wins).
+        New ratings are appended to the arrays in one go.
+        :param times: times of the ratings, 0 if None
+        :return: boolean array, True for the ratings which are new
+        """
+        if times is None:
+            times = [0.] * len(users)
+        new = np.zeros(len(users), dtype=bool)
+        pending = {}  # {(user, item): position of its value} for new ratings
+        values = []
+        value_times = []
+        for n, (user, item, rating, t) in enumerate(zip(users, items, ratings, times)):
+            key = (user, item)
+            if key in pending:
+                values[pending[key]] = rating
+                value_times[pending[key]] = t
+                continue
+            slot = self._find(user, item)
+            if slot is not None:
+                self._ratings[slot] = rating
+                self._times[slot] = t
+                self._enqueue([int(slot)], [t])
+            else:
+                pending[key] = len(values)
+                values.append(rating)
+                value_times.append(t)
+                new[n] = True
+        if not pending:
+            return new
+        reused = [self._free.pop() for _ in range(min(len(self._free), len(pending)))]
+        while self._size + len(pending) - len(reused) > len(self._users):
+            self._grow()
+        slots = np.concatenate([np.array(reused, dtype=np.int64),
+                                np.arange(self._size, self._size + len(pending) - len(reused))])
+        self._size += len(pending) - len(reused)
+        keys = sorted(pending, key=pending.get)
+        self._users[slots] = [user for user, _ in keys]
+        self._items[slots] = [item for _, item in keys]
+        self._ratings[slots] = values
+        self._times[slots] = value_times
+        self._enqueue(slots.tolist(), value_times)
+        for (user, _), slot in zip(keys, slots.tolist()):
+            while len(self._user_slots) <= user:
+                self._user_slots.append(array('i'))
+            self._user_slots[user].append(slot)
+        return new
+
+    def get(self, user, item, default=None):
+        slot = self._find(user, item)
+        return default if slot is None else float(self._ratings[slot])
+
+    def remove(self, user, item):
+        """
+        :return: the removed rating, None if the user had not rated the item
+        """
+        slot = self._find(user, item)
+        if slot is None:
+            return None
+        self._user_slots[user].remove(int(slot))
+        self._users[slot] = -1
+        self._free.append(int(slot))
+        return float(self._ratings[slot])
+
+    def remove_user(self, user):
+        """
+        Remove all the ratings of user
+        :return: items, ratings removed (arrays)
+        """
+        items, ratings = self.user_items(user)
+        for slot in self._slots(user):
+            self._users[slot] = -1
+            self._free.append(int(slot))
+        if user < len(self._user_slots):
+            self._user_slots[user] = array('i')
+        return items, ratings
+
+    def user_items(self, user):
+        """
+        :return: items rated by user, and the ratings (arrays)
+        """
+        slots = self._slots(user)
+        return self._items[slots], self._ratings[slots]
+
+    def user_times(self, user):
+        """
+        :return: times of the ratings of user (array), in the order of user_items
+        """
+        return self._times[self._slots(user)]
+
+    def expire(self, before):
+        """
+        Remove the ratings set before the given time, reading only the head of the queue.
+        The queue is sorted again first if ratings were set out of time order (e.g. loading
+        old ratings after new ones), which is rare in a stream of events.
+        :param before: e.g. time() - window
+        :return: users, items, ratings removed (lists)
+        """
+        users, items, ratings = [], [], []
+        if not self._queue_sorted:
+            self._sort_queue()
+        head, n = self._queue_head, len(self._queue_slots)
+        while head < n and self._queue_times[head] < before:
+            slot, t = self._queue_slots[head], self._queue_times[head]
+            head += 1
+            # the slot can have been set again (or removed, and reused) after being queued
+            if self._users[slot] >= 0 and self._times[slot] == t:
+                user = int(self._users[slot])
+                users.append(user)
+                items.append(int(self._items[slot]))
+                ratings.append(float(self._ratings[slot]))
+                self._user_slots[user].remove(slot)
+                self._users[slot] = -1
+                self._free.append(slot)
+        self._queue_head = head
+        if head > 1024 and head > n // 2:  # drop the expired part of the queue
+            self._queue_slots = self._queue_slots[head:]
+            self._queue_times = self._queue_times[head:]
+            self._queue_head = 0
+        return users, items, ratings
+
+    def triplets(self):
+        """
+        :return: users, items, ratings (arrays) of all the ratings in the store
+        """
+        valid = self._users[:self._size] >= 0
+        return self._users[:self._size][valid], self._items[:self._size][valid], self._ratings[:self._size][valid]
+
+    def times(self):
+        """
+        :return: times of the ratings (array), in the order of triplets
+        """
+        return self._times[:self._size][self._users[:self._size] >= 0]
+
+    @classmethod
+    def from_triplets(cls, users, items, ratings, times=None, expiring=False):
+        """
+        Store holding the given ratings. The arrays are used as they are (e.g. memory-mapped)
+        until the store needs to grow.
+        :param users: array of user indices
+        :param items: array of item indices
+        :param ratings: array of ratings
+        :param times: array of the times of the ratings, 0 if None
+        :param expiring: see RatingStore
+        :return: RatingStore
+        """
+        store = cls(capacity=0, expiring=expiring)
+        if times is None:
+            times = np.zeros(len(users))
+        store._users, store._items, store._ratings, store._times = users, items, ratings, times
+        store._size = len(users)
+        if expiring:
+            store._enqueue(range(len(users)), times)
+        if len(users) > 0:
+            slots = np.argsort(users, kind='mergesort').astype(np.int32)
+            bounds = np.searchsorted(users[slots], np.arange(users.max() + 2))
+            store._user_slots = [array('i', slots[bounds[u]:bounds[u + 1]].tobytes())
+                                 for u in range(len(bounds) - 1)]
+        return store
+
+    def item_totals(self, n_items):
+        """
+        :return: sum of the ratings of each item
+        """
+        _, items, ratings = self.triplets()
+        return np.bincount(items, weights=ratings, minlength=n_items)
+
+    def __len__(self):
+        return self._size - len(self._free)
@@ -1,36 +1,175 @@
 from collections import defaultdict
-import pandas as pd
+import heapq
 import numpy as np
 from time import time
 import logging
 import json
+import atexit
+import os
+import threading
+import zlib
 from tools.Singleton import Singleton
+from tools.IdRegistry import IdRegistry
+from tools.LRUCache import LRUCache
+from tools.RWLock import RWLock
+from tools.PopularityRanking import PopularityRanking
+from tools.NeighborIndex import NeighborIndex
+from tools.Metrics import Metrics, InstrumentedDatabase
+from csrec.RatingStore import RatingStore
+from csrec.CategoryStore import CategoryStore
+from csrec.UpdateBuffer import UpdateBuffer
+from csrec.CooccurrenceModel import CooccurrenceModel
+from tools.Streams import chunks, read_records
+from tools import Snapshot
+from functools import wraps
+
+
+def _reads(method):
+    """
+    Run method holding the lock of the Recommender for reading (many threads at once),
+    after writing the pending ratings (write_behind). Its duration (waiting for the lock
+    included) and MongoDB calls are observed in the metrics as method's name
+    """
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.metrics.timer(method.__name__, per_call='mongo.calls' if self.db else None):
+            self.flush()
+            with self._lock.read():
+                return method(self, *args, **kwargs)
+    return locked
+
+
+def _writes(method):
+    """
+    Run method holding the lock of the Recommender for writing (one thread only).
+    Metrics as in _reads
+    """
+    @wraps(method)
+    def locked(self, *args, **kwargs):
+        with self.metrics.timer(method.__name__, per_call='mongo.calls' if self.db else None):
+            with self._lock.write():
+                return method(self, *args, **kwargs)
+    return locked
+
+
+def _top_k(scores, k, candidates=None, ties=None):
+    """
+    Positions of the k highest scores, highest first. They are selected with argpartition,
+    in O(n), and only those k are sorted. Equal scores are ranked by the highest ties,
+    if given, then by position.
+    :param scores: ndarray
+    :param k: number of positions
+    :param candidates: boolean ndarray, if given only its True positions are selected
+    :param ties: ndarray, secondary score for equal scores
+    :return: ndarray of positions
+    """
+    positions = np.arange(len(scores)) if candidates is None else np.flatnonzero(candidates)
+    if ties is None:
+        ties = np.zeros(len(scores))
+    if k <= 0:
+        return positions[:0]
+    if k < len(positions):
+        candidate_scores = scores[positions]
+        threshold = -np.partition(-candidate_scores, k - 1)[k - 1]
+        above = positions[candidate_scores > threshold]
+        at = positions[candidate_scores == threshold]  # some of them only, as ranked
+        at = at[np.lexsort((at, -ties[at]))][:k - len(above)]
+        positions = np.concatenate([above, at])
+    return positions[np.lexsort((positions, -ties[positions], -scores[positions]))]
+
 
 class Recommender(Singleton):
     """
     Cold Start Recommender
     """
     def __init__(self, mongo_host=None, mongo_db_name=None, mongo_replica_set=None,
-                 default_rating=3, max_rating=5,
+                 default_rating=3, max_rating=5, incremental=False, sparse=False,
+                 write_behind=0, write_behind_seconds=5.0, item_cache_size=10000,
+                 result_cache_size=0, metrics=True, llr_threshold=3.84, llr_neighbors=100,
+                 similar_items=20, rating_window=None, rating_half_life=None, min_rating_weight=0.05,
                  log_level=logging.DEBUG):
 
         self.info_used = set() # Info used in addition to item_id. Only for in-memory testing, otherwise there is utils collection in the MongoDB
         self.default_rating = default_rating  # Rating inserted by default
         self.max_rating = max_rating
-        self._items_cooccurrence = pd.DataFrame  # cooccurrence of items
-        self._categories_cooccurrence = {} # cooccurrence of categories
-        self.cooccurrence_updated = 0.0  # Time of update
-        self.item_ratings = defaultdict(dict)  # matrix of ratings for a item (inmemory testing)
-        self.user_ratings = defaultdict(dict)  # matrix of ratings for a user (inmemory testing)
-        self.items = defaultdict(dict)  # matrix of item's information {item_id: {"Author": "AA. VV."....}
+        # co-occurrence of items and categories. Rebuilds publish a new model, never change it
+        self._model = CooccurrenceModel()
+        # Methods changing the data hold the lock for writing, the others for reading:
+        # many threads can read (e.g. get_recommendations) while no one is writing
+        self._lock = RWLock()
+        self._n_ratings = 0  # ratings inserted so far, to know how many a model is missing
+        self._refresher = None  # background rebuilds, see start_refresher
+        self._refresh_interval = 1800
+        self._refresh_ratings = None
+        self._refresh_now = threading.Event()
+        self._refresh_woken = 0.0  # last time a request woke the refresher up, see _model_for
+        self._refresher_stop = threading.Event()
+        self._follower = None  # loads the snapshots published by another process, see follow_snapshots
+        self._follower_stop = threading.Event()
+        self._snapshot = None  # directory of the last snapshot loaded
+        # If incremental, co-occurrence counts are updated by insert_rating, remove_rating
+        # and reconcile_ids, and a full rebuild is only a consistency check (see check_cooccurrence)
+        self.incremental = incremental
+        self._items_cooccurrence_counts = defaultdict(lambda: defaultdict(int))  # {item_id: {item_id: n_users}} (inmemory testing)
+        self._categories_cooccurrence_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))  # {cat: {value: {value: n_users}}} (inmemory testing)
+        # If sparse, ratings and co-occurrence are scipy CSR matrices instead of dense ndarrays.
+        # The labels of their rows/columns are kept separately, in IdRegistries
+        self.sparse = sparse
+        # If write_behind > 0 (MongoDB only), insert_rating keeps the ratings in memory and writes
+        # them with bulk operations once write_behind ratings or write_behind_seconds are reached
+        # (see flush). Any other method flushes them first, so reads see all the ratings.
+        self.write_behind = write_behind
+        self.write_behind_seconds = write_behind_seconds
+        self._pending_ratings = []  # [(user_id, item_id, rating, time, item_info, only_info), ...]
+        self._pending_since = 0.0  # Time of the oldest pending rating
+        self._flush_timer = None  # flushes write_behind_seconds after the oldest pending rating, see _schedule_flush
+        self._flush_timer_lock = threading.Lock()
+        # Items' documents and values of the categories, so that db.items is not read for
+        # each rating and each recommended item. Both are kept up to date by insert_item etc.
+        self._items_cache = LRUCache(item_cache_size)  # {item_id: item document or None} (MongoDB)
+        self._items_incidence = {}  # {cat: IncidenceMatrix item_id x values}, see _category_incidence
+        # Results of get_recommendations of result_cache_size users, for the model they were
+        # computed with. A user's ones are dropped when the user's ratings change, and all
+        # of them by insert_item etc. (see _cached_recommendations)
+        self._results_cache = LRUCache(result_cache_size)  # {user_id: (model version, {(max_recs, algorithm): recs})}
+        self._results_lock = threading.Lock()  # readers share the cache, writers drop from it
+        self._results_hits = 0
+        self._results_misses = 0
+        # Durations of methods and of their stages, rebuilds, MongoDB calls... (see get_metrics)
+        self.metrics = Metrics(enabled=metrics)
+        # algorithm='llr' scores with the log-likelihood ratio of the co-occurrences, keeping
+        # for each item the llr_neighbors highest ratios above llr_threshold (see _llr_matrix)
+        self.llr_threshold = llr_threshold
+        self.llr_neighbors = llr_neighbors
+        # get_similar_item reads the similar_items neighbors of each item, built for the model
+        # by its first call (see _neighbor_index). If incremental, they are read from the counts
+        # of the item instead, and cached until they change
+        self.similar_items = similar_items
+        self._neighbors_cache = LRUCache(item_cache_size)  # {key of the counts: [(item_id, n_users)]}
+        self._neighbors_lock = threading.Lock()  # readers share the cache
+        # Ratings are kept rating_window seconds after their time (see insert_rating). With
+        # rating_half_life instead, they weigh half every rating_half_life seconds when
+        # recommending, and are kept until they weigh less than min_rating_weight.
+        # Older ones are evicted from the ratings, popularity, categories and counts as new
+        # ones arrive (see expire_ratings), so that memory stays flat in steady state
+        self.rating_window = rating_window
+        self.rating_half_life = rating_half_life
+        self.min_rating_weight = min_rating_weight
+        self._expired_at = 0.0  # time of the last eviction (MongoDB)
+        # user and item ids are interned once as integer indices, which index the rating store
+        self.user_ids = IdRegistry()  # (inmemory testing)
+        self.item_ids = IdRegistry()  # (inmemory testing)
+        self.ratings = RatingStore(expiring=self._retention() is not None)  # (user index, item index, rating) (inmemory testing)
+        self.items = []  # item's information, by item index [{"Author": "AA. VV."....}, ...] (inmemory testing)
         self.item_id_key = 'id'
-        # categories --same as above, but separated as they are not always available
-        self.tot_categories_user_ratings = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))  # sum of all ratings  (inmemory testing)
-        self.tot_categories_item_ratings = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))  # ditto
-        self.n_categories_user_ratings = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))  # number of ratings  (inmemory testing)
-        self.n_categories_item_ratings = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))  # ditto
+        # categories --same as above, but separated as they are not always available:
+        # sum and number of the ratings of each value by each user, keyed by user index
+        self.categories = {}  # {cat: CategoryStore} (inmemory testing)
         self.items_by_popularity = []
         self.items_by_popularity_updated = 0.0  # Time of update
+        # Items ranked by sum of their ratings. Read from the ratings when first needed,
+        # then kept up to date by insert_rating, remove_rating etc. (see _popularity_ranking)
+        self._popularity = None
         # Loggin stuff
         self.logger = logging.getLogger("csrc")
         self.logger.setLevel(log_level)
@@ -53,7 +192,7 @@ class Recommender(Singleton):
                 self.mongo_db_name = mongo_db_name
                 self.mongo_client = MongoReplicaSetClient(self.mongo_host,
                                                           replicaSet=self.mongo_replica_set)
-                self.db = self.mongo_client[self.mongo_db_name]
+                self.db = InstrumentedDatabase(self.mongo_client[self.mongo_db_name], self.metrics)
                 # reading --for producing recommendations-- could be even out of sync.
                 # this can be added if most replicas are in-memory
                 # self.db.read_preference = ReadPreference.SECONDARY_PREFERRED
@@ -63,12 +202,36 @@ class Recommender(Singleton):
                 self.mongo_replica_set = mongo_replica_set
                 self.mongo_db_name = mongo_db_name
                 self.mongo_client = MongoClient(self.mongo_host)
-                self.db = self.mongo_client[self.mongo_db_name]
+                self.db = InstrumentedDatabase(self.mongo_client[self.mongo_db_name], self.metrics)
             # If these tables do not exist, it might create problems
             if not self.db['user_ratings'].find_one():
                 self.db['user_ratings'].insert({})
             if not self.db['item_ratings'].find_one():
                 self.db['item_ratings'].insert({})
+            self._upgrade_categories()
+            if self._retention() is not None:
+                # {_id: [user_id, item_id] as JSON, u: user_id, i: item_id, t: time of the rating}
+                self.db['rating_times'].create_index('u')
+                self.db['rating_times'].create_index('t')
+            if self.write_behind:
+                atexit.register(self._stop_write_behind)
+
+    def _retention(self):
+        """
+        :return: seconds a rating is kept (see rating_window), None if forever
+        """
+        if self.rating_window is not None:
+            return float(self.rating_window)
+        if self.rating_half_life is not None:
+            return self.rating_half_life * np.log2(1. / self.min_rating_weight)
+        return None
+
+    @property
+    def cooccurrence_updated(self):
+        """
+        Time of the last build of the co-occurrence matrices
+        """
+        return self._model.updated
 
     def _coll_name(self, k, typ):
         """
@@ -76,241 +239,1014 @@ class Recommender(Singleton):
         """
         return str(typ) + '_' + str(k) + '_ratings'
 
+    def _cooccurrence_coll_name(self, k=None):
+        """
+        e.g. cooccurrence (items) or cooccurrence_author
+        """
+        return 'cooccurrence' if k is None else 'cooccurrence_' + str(k)
+
+    def _update_cooccurrence_counts(self, key, history, step=1, k=None, buffer=None):
+        """
+        Add (step=1) or remove (step=-1) key to/from a user's history in the
+        co-occurrence counts, touching only the rows and columns of that history.
+        :param key: item_id, or value of the category k
+        :param history: items (or values of k) already in the user's history, key excluded
+        :param step: 1 or -1
+        :param k: None for items, otherwise the category (e.g. 'author')
+        :param buffer: UpdateBuffer where MongoDB updates are coalesced, instead of being written
+        :return: None
+        """
+        history = [h for h in history if h != key]
+        if k is None:
+            for h in [key] + history:
+                self._neighbors_cache.pop(h)
+        if not self.db:
+            if k is None:
+                counts = self._items_cooccurrence_counts
+            else:
+                counts = self._categories_cooccurrence_counts[k]
+            for a, b in [(key, key)] + [(key, h) for h in history] + [(h, key) for h in history]:
+                counts[a][b] += step
+                if counts[a][b] == 0:
+                    counts[a].pop(b)
+                    if not counts[a]:
+                        counts.pop(a)
+        elif buffer is not None:
+            coll_name = self._cooccurrence_coll_name(k)
+            buffer.inc(coll_name, key, key, step)
+            for h in history:
+                buffer.inc(coll_name, key, h, step)
+                buffer.inc(coll_name, h, key, step)
+        else:
+            coll = self.db[self._cooccurrence_coll_name(k)]
+            inc = dict((h, step) for h in history)
+            inc[key] = step
+            coll.update({"_id": key}, {"$inc": inc}, upsert=True)
+            if history:
+                coll.update({"_id": {"$in": history}}, {"$inc": {key: step}}, multi=True)
+
+    def _merge_cooccurrence_counts(self, old_history, new_history, k=None, buffer=None):
+        """
+        Move the history of a user into the one of another user (see reconcile_ids)
+        updating the co-occurrence counts.
+        :param old_history: items (or values of k) of the user which is removed
+        :param new_history: items (or values of k) of the user which is kept
+        :param k: None for items, otherwise the category
+        :param buffer: UpdateBuffer where MongoDB updates are coalesced, instead of being written
+        :return: None
+        """
+        remaining = list(old_history)
+        while remaining:
+            key = remaining.pop()
+            self._update_cooccurrence_counts(key, remaining, step=-1, k=k, buffer=buffer)
+        merged = list(new_history)
+        seen = set(merged)
+        for key in old_history:
+            if key not in seen:
+                self._update_cooccurrence_counts(key, merged, step=1, k=k, buffer=buffer)
+                merged.append(key)
+                seen.add(key)
+
+    def _cooccurrence_scores(self, user_vec, k=None):
+        """
+        Co-occurrence.T dot user_vec, computed summing only the rows of the
+        co-occurrence counts corresponding to the user's history.
+        :param user_vec: {item_id: rating} or, for categories, {value: average rating}
+        :param k: None for items, otherwise the category
+        :return: item_ids (or values), ndarray of their scores, only non-zero scores. Keys are
+                 in the order of the counts' keys, as in get_recommendations_batch (for ties)
+        """
+        scores = defaultdict(float)
+        for key, row in self._cooccurrence_rows(user_vec, k):
+            weight = user_vec[key]
+            for other, n in row.iteritems():
+                scores[other] += n * weight
+        keys = sorted(other for other, score in scores.iteritems() if score != 0)
+        values = np.array([scores[other] for other in keys], dtype=np.float64)
+        if not self.db and k is None:  # in memory, counts of items are by item index
+            keys = self.item_ids.ids(keys)
+        return keys, values
+
+    def _cooccurrence_rows(self, keys, k=None):
+        """
+        Only for incremental: rows of the co-occurrence counts
+        :param keys: item_ids or, for categories, values
+        :param k: None for items, otherwise the category
+        :return: [(key, {other: n_users})], others being item indices for items in memory
+        """
+        if not self.db:
+            if k is None:
+                counts = self._items_cooccurrence_counts
+                return [(key, counts.get(self.item_ids.get(key), {})) for key in keys]
+            counts = self._categories_cooccurrence_counts.get(k, {})
+            return [(key, counts.get(key, {})) for key in keys]
+        return [(d.pop("_id"), d) for d in
+                self.db[self._cooccurrence_coll_name(k)].find({"_id": {"$in": list(keys)}})]
+
+    def _counts_scores(self, vecs, k=None):
+        """
+        Only for incremental: as _cooccurrence_scores, for a block of users. The counts are read
+        once, for the items (or values) in the histories of all the users of the block
+        :param vecs: [{item_id: rating}, ...] (or {value: average rating} for categories)
+        :param k: None for items, otherwise the category
+        :return: users x labels ndarray of scores, IdRegistry of the labels (item_ids or values)
+        """
+        rows = self._cooccurrence_rows(set(key for vec in vecs for key in vec), k)
+        cols = sorted(set(other for _, row in rows for other, n in row.iteritems() if n != 0))
+        positions = dict((other, c) for c, other in enumerate(cols))
+        matrix = np.zeros((len(rows), len(cols)))
+        for r, (_, row) in enumerate(rows):
+            for other, n in row.iteritems():
+                if n != 0:
+                    matrix[r, positions[other]] = n
+        if not self.db and k is None:  # in memory, counts of items are by item index
+            cols = self.item_ids.ids(cols)
+        scores = self._users_block(vecs, IdRegistry([key for key, _ in rows])).dot(matrix)
+        return np.asarray(scores), IdRegistry(cols)
+
+    def _cooccurrence_as_dict(self, k=None, model=None):
+        """
+        :param k: None for items, otherwise the category
+        :param model: CooccurrenceModel, the current one if None
+        :return: the co-occurrence matrix as {key: {key: n_users}}, without zeros,
+                 keyed as the incremental counts
+        """
+        result = defaultdict(dict)
+        matrix, labels = self._cooccurrence_matrix(k, model)
+        if matrix is not None:
+            if self.sparse:
+                coo = matrix.tocoo()
+                rows, cols, counts = coo.row, coo.col, coo.data
+            else:
+                rows, cols = np.nonzero(matrix)
+                counts = matrix[rows, cols]
+            for r, c, n in zip(rows.tolist(), cols.tolist(), counts.tolist()):
+                if n != 0:
+                    result[labels[r]][labels[c]] = int(n)
+        if not self.db and k is None:  # in memory, counts of items are by item index
+            index = self.item_ids.get
+            return dict((index(key), dict((index(other), n) for other, n in row.items()))
+                        for key, row in result.items())
+        return dict(result)
+
+    @_writes
+    def check_cooccurrence(self):
+        """
+        Only for incremental: rebuild the co-occurrence from scratch and compare it with the
+        counts maintained by insert_rating etc. If they differ, the rebuilt ones are kept.
+        Meant to be run once in a while, not on the request path.
+        :return: True if the counts were consistent
+        """
+        self.flush()
+        model = self._create_cooccurrence()
+        consistent = True
+        for k in [None] + list(model.categories):
+            expected = self._cooccurrence_as_dict(k, model)
+            if not self.db:
+                if k is None:
+                    counts = self._items_cooccurrence_counts
+                else:
+                    counts = self._categories_cooccurrence_counts[k]
+                current = dict((key, dict(row)) for key, row in counts.items())
+            else:
+                coll = self.db[self._cooccurrence_coll_name(k)]
+                current = {}
+                for d in coll.find():
+                    row = dict((other, int(n)) for other, n in d.items() if other != "_id" and n != 0)
+                    if row:
+                        current[d["_id"]] = row
+            if current != expected:
+                consistent = False
+                self.logger.warning("[check_cooccurrence] co-occurrence counts for %s not consistent, replacing them",
+                                    k if k is not None else 'items')
+                self._neighbors_cache.clear()
+                if not self.db:
+                    counts.clear()
+                    for key, row in expected.items():
+                        counts[key].update(row)
+                else:
+                    coll.drop()
+                    for key, row in expected.items():
+                        row["_id"] = key
+                        coll.insert(row)
+        return consistent
+
 
     def _create_cooccurrence(self):
         """
-        Create or update the co-occurrence matrix
-        :return:
+        Create or update the co-occurrence matrix. The new matrices are published
+        all together, replacing the model: readers never see a half-built one.
+        The lock is held for reading only while the ratings are copied (see
+        _cooccurrence_inputs): the matrices are built from the copy without it, so
+        that a writer waiting meanwhile does not hold back the readers for the whole build.
+        :return: the new CooccurrenceModel
+        """
+        start = time()
+        self.metrics.count('cooccurrence.rebuilds')
+        with self.metrics.timer('create_cooccurrence'):
+            with self._lock.read():
+                n_ratings = self._n_ratings
+                inputs = self._cooccurrence_inputs()
+            model = CooccurrenceModel()
+            for k, (rows, cols, values, shape, labels) in inputs.items():
+                if k is not None and shape[1] == 0:
+                    continue
+                if self.sparse:
+                    matrix, n_users = self._sparse_cooccurrence(rows, cols, values, shape)
+                else:
+                    matrix, n_users = self._dense_cooccurrence(rows, cols, values, shape)
+                if k is None:
+                    model.items, model.items_labels = matrix, labels
+                else:
+                    model.categories[k], model.categories_labels[k] = matrix, labels
+                model.n_users[k] = n_users
+        model.updated = time()
+        model.build_seconds = model.updated - start
+        model.n_ratings = n_ratings
+        self._model = model
+        self.logger.debug("[_create_cooccurrence] Co-occurrence built in %.3f s", model.build_seconds)
+        return model
+
+    def _cooccurrence_inputs(self):
+        """
+        Copy of the ratings the co-occurrence is built from, for items and for each category used
+        :return: {None for items, otherwise the category: (rows, cols, values, shape, labels)}: the
+                 (users x items, or users x values) matrix as arrays of its entries, with
+                 the IdRegistry of the labels of its columns (it can be the live one, longer than shape)
         """
-        df_tot_cat_item = {}
+        inputs = {}
         if not self.db:
-            # Items' vectors
-            df_item = pd.DataFrame(self.item_ratings).fillna(0).astype(int)
-            # Categories' vectors
-            info_used = self.info_used
-            if len(info_used) > 0:
-                for i in info_used:
-                    df_tot_cat_item[i] = pd.DataFrame(self.tot_categories_item_ratings[i]).fillna(0).astype(int)
-        else:  # read if from Mongodb
-            # here we *must* use user_ratings, so indexes are the users, columns the items...
-            df_item = pd.DataFrame.from_records(list(self.db['user_ratings'].find())).set_index('_id').fillna(0).astype(int)
+            users, items, ratings = self.ratings.triplets()
+            inputs[None] = users, items, ratings, (len(self.user_ids), len(self.item_ids)), self.item_ids
+            for k in self._get_info_used():
+                store = self._category_store(k)
+                users, values, tots, _ = store.entries()
+                inputs[k] = users, values, tots, (len(self.user_ids), len(store.values)), store.values
+        else:
+            inputs[None] = self._records_entries(self.db['user_ratings'].find())
+            for k in self._get_info_used():
+                inputs[k] = self._records_entries(self._category_records(k))
+        return inputs
+
+    @staticmethod
+    def _records_entries(records):
+        """
+        Documents as stored in MongoDB, one row per document (e.g. user_ratings
+        [{_id: user_id, item_id: rating, ...}] gives users x items), as arrays of entries.
+        Column labels are sorted, so that equal scores are ranked the same however the
+        documents were written (e.g. fields removed by expire_ratings and set again)
+        :return: rows, cols, values (arrays), shape, IdRegistry of the column labels
+        """
+        row_labels = IdRegistry()
+        rows, keys, data = [], [], []
+        for record in records:
+            entries = [(col, value) for col, value in record.items() if col != "_id" and value]
+            if not entries:
+                continue
+            r = row_labels.intern(record["_id"])
+            for col, value in entries:
+                rows.append(r)
+                keys.append(col)
+                data.append(value)
+        col_labels = IdRegistry(sorted(set(keys)))
+        cols = [col_labels.get(col) for col in keys]
+        return np.array(rows, dtype=np.int32), np.array(cols, dtype=np.int32), np.array(data, dtype=np.float64), \
+            (len(row_labels), len(col_labels)), col_labels
+
+    @staticmethod
+    def _dense_cooccurrence(rows, cols, values, shape):
+        """
+        Co-occurrence of the columns of a matrix, as dense ndarrays
+        :param rows, cols, values, shape: the matrix, see _cooccurrence_inputs
+        :return: co-occurrence matrix, number of rows with some entry
+        """
+        matrix = np.zeros(shape)
+        matrix[rows, cols] = values
+        binary = (matrix.astype(int) != 0).astype(np.float32)  # normalize to one to build the co-occurrence
+        # float32 uses BLAS (NumPy multiplies integers without it), and counts exactly up to 2**24 users
+        return binary.T.dot(binary).astype(int), int(binary.any(axis=1).sum())
+
+    @staticmethod
+    def _sparse_cooccurrence(rows, cols, values, shape):
+        """
+        As _dense_cooccurrence, with sparse matrices
+        """
+        from scipy import sparse
+        from tools.SparseMatrix import binarize, cooccurrence
+        binary = binarize(sparse.csr_matrix((np.asarray(values, dtype=np.float32), (rows, cols)), shape=shape))
+        return cooccurrence(binary), int((np.diff(binary.indptr) > 0).sum())
+
+    def _model_for(self, user_vec=None, k=None, rebuild=False):
+        """
+        Co-occurrence model to score user_vec with. It is rebuilt first if rebuild, or if
+        items (or values) of user_vec are not in it, unless the refresher is running:
+        then rebuild is ignored (staleness is left to its interval and n_ratings), the
+        refresher is only woken up for missing items, at most once every interval/10 (so
+        that a stream of new items does not keep it rebuilding), and the current model is
+        used meanwhile.
+        :param user_vec: {item_id: rating} or, for categories, {value: average rating}
+        :param k: None for items, otherwise the category
+        :param rebuild: True to rebuild anyway
+        :return: CooccurrenceModel
+        """
+        model = self._model
+        missing = user_vec is not None and not self._in_cooccurrence(user_vec, k, model)
+        if self._follower is not None:  # the model is built by the process publishing it
+            return model
+        if self._refresher is not None and model.updated:
+            if missing and time() - max(model.updated, self._refresh_woken) >= self._refresh_interval / 10.:
+                self._refresh_woken = time()
+                self._refresh_now.set()
+            return model
+        if rebuild or missing:
+            return self._create_cooccurrence()
+        return model
+
+    def _count_ratings(self, n=1):
+        """
+        Count inserted ratings, and wake the refresher up if the model misses refresh_ratings of them
+        """
+        self._n_ratings += n
+        if self._refresher is not None and self._refresh_ratings and \
+                self._n_ratings - self._model.n_ratings >= self._refresh_ratings:
+            self._refresh_now.set()
+
+    def start_refresher(self, interval=1800, n_ratings=None):
+        """
+        Rebuild the co-occurrence in a background thread, every interval seconds and as soon
+        as n_ratings ratings have been inserted since the last build. The new model replaces
+        the current one when complete. While the refresher runs, requests never rebuild the
+        co-occurrence themselves (whatever fast is).
+        :param interval: max age of the co-occurrence, in seconds
+        :param n_ratings: max number of ratings inserted after the build, None for no limit
+        :return: None
+        """
+        if self._refresher is not None:
+            return
+        self._refresh_interval = interval
+        self._refresh_ratings = n_ratings
+        self._refresher_stop.clear()
+        self._refresher = threading.Thread(target=self._refresh_loop, name='csrec-refresher')
+        self._refresher.daemon = True
+        self._refresher.start()
+        atexit.register(self.stop_refresher)
+
+    def stop_refresher(self):
+        """
+        Stop the background rebuilds (waiting for the current one, if any)
+        """
+        refresher = self._refresher
+        if refresher is None:
+            return
+        self._refresher_stop.set()
+        self._refresh_now.set()
+        refresher.join()
+        self._refresher = None
+
+    def _refresh_loop(self):
+        while True:
+            age = self._model.age()
+            self._refresh_now.wait(0 if age is None else max(self._refresh_interval - age, 0))
+            self._refresh_now.clear()
+            if self._refresher_stop.is_set():
+                return
             try:
-                info_used = self.db['utils'].find_one({"_id": 1}, {'info_used': 1, "_id": 0}).get('info_used', [])
-                self.logger.info("[_create_cooccurrence] Found info_used already in db.utils: %s", info_used)
-            except:
-                info_used = []
-                self.logger.info("[_create_cooccurrence] No info_used in db.utils, setting = []")
-
-            if len(info_used) > 0:
-                for i in info_used:
-                    user_coll_name = self._coll_name(i, 'user')
-                    if self.db['tot_' + user_coll_name].find_one():
-                        df_tot_cat_item[i] = pd.DataFrame.from_records(list(self.db['tot_' + user_coll_name].find())).set_index('_id').fillna(0).astype(int)
-        df_item = (df_item / df_item).replace(np.inf, 0)  # normalize to one to build the co-occurrence
-        self._items_cooccurrence = df_item.T.dot(df_item)
-        if len(info_used) > 0:
-            for i in info_used:
-                if type(df_tot_cat_item.get(i)) == pd.DataFrame:
-                    df_tot_cat_item[i] = (df_tot_cat_item[i] / df_tot_cat_item[i]).replace(np.inf, 0)
-                    self._categories_cooccurrence[i] = df_tot_cat_item[i].T.dot(df_tot_cat_item[i])
-        self.cooccurrence_updated = time()
+                self._create_cooccurrence()  # takes the lock only to copy the ratings
+            except Exception, e:
+                self.logger.error("[_refresh_loop] Co-occurrence not rebuilt")
+                logging.exception(e)
+                self._refresher_stop.wait(min(self._refresh_interval, 60))
+
+    def publish_snapshot(self, path, keep=2):
+        """
+        Rebuild the co-occurrence, save it (see save_snapshot) as a new version of the
+        snapshot in path, and make it the current one, for the processes following path.
+        :param path: directory of the versions, created if not there
+        :param keep: number of versions kept (older ones are deleted)
+        :return: directory of the new version
+        """
+        self.flush()
+        version = Snapshot.new_version(path)
+        self._create_cooccurrence()  # takes the lock only to copy the ratings
+        with self._lock.read():
+            self.save_snapshot(version)
+        Snapshot.set_current_version(path, version, keep=keep)
+        self.logger.debug("[publish_snapshot] Published %s", version)
+        return version
+
+    def follow_snapshots(self, path, interval=1.0):
+        """
+        Load, in a background thread, each new version of the snapshot published in path
+        by another process (see publish_snapshot). Arrays are memory-mapped, so all the
+        processes following the same path share them. While following, the co-occurrence
+        is never rebuilt by this process.
+        :param path: directory of the versions
+        :param interval: seconds between checks for a new version
+        :return: None
+        """
+        if self._follower is not None:
+            return
+        self._follower_stop.clear()
+        self._follower = threading.Thread(target=self._follow_loop, args=(path, interval), name='csrec-follower')
+        self._follower.daemon = True
+        self._follower.start()
+        atexit.register(self.stop_following)
+
+    def stop_following(self):
+        """
+        Stop loading new versions of the snapshot
+        """
+        follower = self._follower
+        if follower is None:
+            return
+        self._follower_stop.set()
+        follower.join()
+        self._follower = None
+
+    def _follow_loop(self, path, interval):
+        while True:
+            try:
+                version = Snapshot.current_version(path)
+                if version is not None and version != self._snapshot:
+                    self.load_snapshot(version)
+                    self._snapshot = version
+            except Exception, e:
+                self.logger.error("[_follow_loop] Snapshot not loaded")
+                logging.exception(e)
+            if self._follower_stop.wait(interval):
+                return
 
+    def get_model_info(self):
+        """
+        :return: {'updated': time of the last build of the co-occurrence, 'age': its age in seconds,
+                  'build_seconds': duration of the last build, 'ratings_behind': ratings inserted
+                  after the build, 'refresher': True if background rebuilds are running,
+                  'snapshot': last snapshot loaded by follow_snapshots}
+        """
+        model = self._model
+        return {'updated': model.updated, 'age': model.age(), 'build_seconds': model.build_seconds,
+                'ratings_behind': self._n_ratings - model.n_ratings, 'refresher': self._refresher is not None,
+                'snapshot': self._snapshot}
 
-    def _sync_user_item_ratings(self):
+    def _get_info_used(self):
+        """
+        :return: info used in addition to item_id (e.g. author, tags...)
+        """
+        if not self.db:
+            return self.info_used
+        try:
+            return self.db['utils'].find_one({"_id": 1}, {'info_used': 1, "_id": 0}).get('info_used', [])
+        except:
+            return []
+
+    def _category_store(self, k):
+        """
+        :param k: category, e.g. 'author'
+        :return: CategoryStore of k, created if not there (inmemory testing)
+        """
+        if k not in self.categories:
+            self.categories[k] = CategoryStore()
+        return self.categories[k]
+
+    def _upgrade_categories(self, chunk_size=10000):
+        """
+        Copy the categories written by older versions, with sum and number of ratings in
+        separate collections (tot_user_author_ratings, n_user_author_ratings), into the
+        collection of each category. The old collections are left as they are (MongoDB)
+        """
+        collection_names = self.db.collection_names()
+        for k in self._get_info_used():
+            coll_name = self._coll_name(k, 'user')
+            if 'n_' + coll_name not in collection_names or coll_name in collection_names:
+                continue
+            self.logger.warning("[_upgrade_categories] Copying tot_%s and n_%s into %s", coll_name, coll_name, coll_name)
+            for chunk in chunks(self.db['n_' + coll_name].find(batch_size=chunk_size), chunk_size):
+                tots = dict((d.pop("_id"), d) for d in
+                            self.db['tot_' + coll_name].find({"_id": {"$in": [d["_id"] for d in chunk]}}))
+                buffer = UpdateBuffer(self.db)
+                for d in chunk:
+                    user_id = d.pop("_id")
+                    for value, n in d.items():
+                        if n > 0:
+                            buffer.set(coll_name, user_id, value, {'t': tots.get(user_id, {}).get(value, 0), 'n': n})
+                buffer.flush()
+
+    def _category_records(self, k):
+        """
+        Documents of the category k with the sum of the ratings of each value, as
+        _records_entries reads them: {_id: user_id, value: sum, ...} (MongoDB)
+        """
+        for d in self.db[self._coll_name(k, 'user')].find():
+            record = dict((value, counts.get('t', 0)) for value, counts in d.items() if value != "_id")
+            record["_id"] = d["_id"]
+            yield record
+
+    def _intern_item(self, item_id):
+        """
+        :return: index of item_id, registering it if new (inmemory testing)
+        """
+        index = self.item_ids.intern(item_id)
+        while len(self.items) <= index:
+            self.items.append({})
+            self._update_popularity(item_id)
+        return index
+
+    def _item_info(self, item_id):
+        """
+        :return: item's information, {} if unknown (inmemory testing)
+        """
+        index = self.item_ids.get(item_id)
+        return self.items[index] if index is not None else {}
+
+    def _get_items(self, item_ids):
+        """
+        Items' documents from the cache, db.items is read (once) only for the ones not cached
+        :param item_ids: iterable of item_id
+        :return: {item_id: document}, for the items which are stored (MongoDB)
+        """
+        items = {}
+        missing = []
+        for item_id in item_ids:
+            item = self._items_cache.get(item_id, missing)
+            if item is missing:
+                missing.append(item_id)
+            elif item is not None:
+                items[item_id] = item
+        if missing:
+            found = dict((d["_id"], d) for d in self.db['items'].find({"_id": {"$in": missing}}))
+            for item_id in missing:
+                self._items_cache.put(item_id, found.get(item_id))
+            items.update(found)
+        return items
+
+    def _set_item_value(self, item_id, k, value):
+        """
+        Keep cache and category index coherent with a {"$set": {k: value}} on db.items
+        """
+        item = self._items_cache.pop(item_id)
+        if item is not None:
+            item[k] = value
+            self._items_cache.put(item_id, item)
+        if k in self._items_incidence:
+            self._items_incidence[k].set_row(item_id, self._category_values(value))
+
+    def _cooccurrence_matrix(self, k=None, model=None):
+        """
+        :param k: None for items, otherwise the category
+        :param model: CooccurrenceModel, the current one if None
+        :return: co-occurrence matrix and the labels of its rows/columns (IdRegistry)
+        """
+        return (model or self._model).matrix(k)
+
+    def _in_cooccurrence(self, user_vec, k=None, model=None):
+        """
+        :param user_vec: {item_id: rating} or, for categories, {value: average rating}
+        :param k: None for items, otherwise the category
+        :param model: CooccurrenceModel, the current one if None
+        :return: True if all items (or values) in user_vec are in the co-occurrence matrix
+        """
+        matrix, labels = self._cooccurrence_view(k, model, copy=False)
+        if matrix is None:
+            return False
+        positions = labels.indices(user_vec)
+        return all(n is not None and n < matrix.shape[0] for n in positions)
+
+    def _llr_matrix(self, k=None, model=None):
+        """
+        Log-likelihood ratio of the co-occurrences (see tools.SparseMatrix.llr): for each item
+        (or value), only the llr_neighbors highest ratios above llr_threshold are kept.
+        Computed once per model, when first needed.
+        :param k: None for items, otherwise the category
+        :param model: CooccurrenceModel, the current one if None
+        :return: csr matrix, IdRegistry of the labels of its rows/columns. None, IdRegistry() if there's no matrix
+        """
+        model = model or self._model
+        if k not in model.llr:
+            from tools.SparseMatrix import llr
+            matrix, labels = self._cooccurrence_view(k, model)
+            if matrix is not None:
+                n_users = model.n_users.get(k) or int(matrix.diagonal().max())
+                matrix = llr(matrix, n_users, self.llr_threshold, self.llr_neighbors)
+            model.llr[k] = matrix, labels
+        return model.llr[k]
+
+    def _neighbor_index(self, model=None, algorithm='simple'):
+        """
+        The similar_items neighbors of each item, by co-occurrence (simple) or by
+        log-likelihood ratio (llr, see _llr_matrix). Computed once per model, when first
+        needed, so that rebuilds do not pay for it if get_similar_item is not called.
+        :param model: CooccurrenceModel, the current one if None
+        :param algorithm: simple or llr
+        :return: NeighborIndex
+        """
+        model = model or self._model
+        if algorithm not in model.neighbors:
+            if algorithm == 'llr':
+                matrix, labels = self._llr_matrix(model=model)
+            else:
+                matrix, labels = self._cooccurrence_view(model=model)
+            if matrix is None:
+                matrix = np.zeros((0, 0))
+            model.neighbors[algorithm] = NeighborIndex(matrix, labels, self.similar_items)
+        return model.neighbors[algorithm]
+
+    def _counts_neighbors(self, item_id):
+        """
+        Only for incremental: the similar_items neighbors of item_id by co-occurrence,
+        from its row of the counts. Cached until insert_rating etc. change the row.
+        :return: [(item_id, n_users), ...], highest first
+        """
+        key = item_id if self.db else self.item_ids.get(item_id)
+        with self._neighbors_lock:
+            neighbors = self._neighbors_cache.get(key)
+        if neighbors is not None or key is None:
+            return neighbors or []
+        if not self.db:
+            row = self._items_cooccurrence_counts.get(key, {})
+        else:
+            row = self.db[self._cooccurrence_coll_name()].find_one({"_id": key}) or {}
+        top = heapq.nlargest(self.similar_items, ((n, other) for other, n in row.items()
+                                                  if other != key and other != "_id" and n > 0))
+        neighbors = [(other, n) for n, other in top]
+        if not self.db:  # in memory, counts of items are by item index
+            neighbors = zip(self.item_ids.ids([other for other, _ in neighbors]), [n for _, n in neighbors])
+        with self._neighbors_lock:
+            self._neighbors_cache.put(key, neighbors)
+        return neighbors
+
+    def _matrix_scores(self, user_vec, k=None, model=None, algorithm='item_based'):
+        """
+        Co-occurrence.T dot user_vec, summing only the rows of the (symmetric) co-occurrence
+        matrix corresponding to the items (or values) in user_vec. The cost depends
+        on the length of the user's history, not on users x items.
+        Items (or values) which are not in the matrix yet are ignored.
+        :param user_vec: {item_id: rating} or, for categories, {value: average rating}
+        :param k: None for items, otherwise the category
+        :param model: CooccurrenceModel, the current one if None
+        :param algorithm: item_based (co-occurrence) or llr (log-likelihood ratio, see _llr_matrix)
+        :return: item_ids (or values), ndarray of their scores, only non-zero scores
+        """
+        if algorithm == 'llr':
+            matrix, labels = self._llr_matrix(k, model)
+        else:
+            matrix, labels = self._cooccurrence_view(k, model, copy=False)
+        if matrix is None:
+            return [], np.empty(0)
+        # labels can be the live registry, which grows after the matrix is built
+        positions, weights = [], []
+        for key, rating in user_vec.items():
+            n = labels.get(key)
+            if n is not None and n < matrix.shape[0]:
+                positions.append(n)
+                weights.append(rating)
+        if not positions:
+            return [], np.empty(0)
+        scores = np.asarray(matrix[positions].T.dot(np.array(weights, dtype=np.float64))).ravel()
+        nonzero = np.flatnonzero(scores)
+        return labels.ids(nonzero), scores[nonzero]
+
+    def _user_item_collections(self):
+        """
+        :return: [(user collection, item collection)], the item one being the user one transposed,
+                 i.e. [('user_ratings', 'item_ratings')] (categories are kept by user only)
+        """
+        return [('user_ratings', 'item_ratings')]
+
+    def _ratings_digest(self, coll_name, transposed=False):
+        """
+        Number and checksum of the (user, item, value) of a collection, read as a stream.
+        The checksum does not depend on the order of documents and fields, so that a
+        collection and its transposed one have the same digest when they are aligned.
+        :param coll_name: e.g. user_ratings
+        :param transposed: True if the documents are items, e.g. item_ratings
+        :return: (number of ratings, checksum)
+        """
+        n, checksum = 0, 0
+        for d in self.db[coll_name].find():
+            for key, value in d.items():
+                if key != "_id":
+                    user, item = (key, d["_id"]) if transposed else (d["_id"], key)
+                    rating = (u"%s\0%s\0%r" % (user, item, float(value))).encode('utf-8')
+                    checksum += zlib.crc32(rating) & 0xffffffff
+                    n += 1
+        return n, checksum % 2 ** 64
+
+    @_writes
+    def check_user_item_ratings(self, repair=True):
+        """
+        Only for MongoDB: compare number and checksum of the ratings in user_ratings and
+        item_ratings, which should hold the same data transposed. If they differ and repair, the item ones are rebuilt (see
+        _sync_user_item_ratings). Reads each collection once, writes nothing if they are
+        aligned. Meant to be run once in a while, not on the request path.
+        :param repair: rebuild the collections which are not aligned
+        :return: True if all the collections were aligned
+        """
+        if not self.db:
+            return True
+        self.flush()
+        drifted = []
+        for user_coll, item_coll in self._user_item_collections():
+            expected = self._ratings_digest(user_coll)
+            current = self._ratings_digest(item_coll, transposed=True)
+            if current != expected:
+                self.logger.warning("[check_user_item_ratings] %s not aligned with %s: %s ratings, %s expected",
+                                    item_coll, user_coll, current[0], expected[0])
+                drifted.append((user_coll, item_coll))
+        if drifted and repair:
+            self._sync_user_item_ratings(drifted)
+        return not drifted
+
+    def _sync_user_item_ratings(self, collections=None, chunk_size=10000):
         """
         It might happen that the user_ratings and the item_ratings
         are not aligned. It shouldn't, but with users can be profiled,
         then reconciled with session_id etc, it happened...
-        :return:
+        The user collection is read as a stream, chunk_size documents at a time, and
+        transposed into a shadow collection with bulk operations, which then replaces
+        the item collection: readers see the old one until the rebuild is complete.
+        :param collections: [(user collection, item collection)], all if None (see _user_item_collections)
+        :param chunk_size: user documents transposed and written together
+        :return: None
         """
         #Doing that only for the mongodb case..
+        if not self.db:
+            return
+        self.metrics.count('sync_user_item_ratings')
         self.logger.warning("[_sync_user_item_ratings] Syncronyzing item_ratings with user_ratings data")
-        if self.db:
-            self.db['item_ratings'].drop()
-            for user_date in self.db['user_ratings'].find():  # don't put {_id: 0!}
-                for item_id, rating in user_date.iteritems():
-                    if item_id != "_id":
-                        self.db['item_ratings'].update(
-                            {"_id": item_id},
-                            {"$set": {user_date["_id"]: rating}},
-                            upsert=True
-                        )
-            for coll in self.db.collection_names():
-                if '_item_' in coll:
-                    user_coll = coll.replace('_item_', '_user_')
-                    self.db[coll].drop()
-                    for user_date in self.db[user_coll].find():  # don't put {_id: 0!}
-                        for info_id, value in user_date.iteritems():
-                            if info_id != "_id":
-                                self.db[coll].update(
-                                    {"_id": info_id},
-                                    {"$set": {user_date["_id"]: value}},
-                                    upsert=True
-                                )
+        for user_coll, item_coll in collections or self._user_item_collections():
+            shadow = item_coll + '_rebuild'
+            self.db[shadow].drop()
+            for chunk in chunks(self.db[user_coll].find(batch_size=chunk_size), chunk_size):
+                buffer = UpdateBuffer(self.db)
+                for user_data in chunk:  # don't put {_id: 0!}
+                    for item_id, rating in user_data.items():
+                        if item_id != "_id":
+                            buffer.set(shadow, item_id, user_data["_id"], rating)
+                buffer.flush()
+            if shadow in self.db.collection_names():
+                self.db[shadow].rename(item_coll, dropTarget=True)
+            else:  # no ratings
+                self.db[item_coll].drop()
+            self.logger.info("[_sync_user_item_ratings] %s rebuilt from %s", item_coll, user_coll)
 
 
+    @_writes
     def insert_item(self, item, _id="_id"):
         """
         Insert the whole document either in self.items or in db.items.
-        self.items is a nested dict {_id: dict(item), ....}
+        self.items is a list [dict(item), ....] indexed by self.item_ids
         :param item: {_id: item_id, cat1: ...} or {item_id_key: item_id, cat1: ....}
         :return: None
         """
+        self.flush()
         self.item_id_key = _id
+        self._update_popularity(item[_id])
+        if any(k != _id for k in item):  # values used by the boosting of any user
+            self._invalidate_results()
         if not self.db:
-            self.items[item[_id]] = item
+            self.items[self._intern_item(item[_id])] = item
+            for k, incidence in self._items_incidence.items():
+                incidence.set_row(item[_id], self._category_values(item.get(k)))
         else:
             for k, v in item.items():
                 if k is not "_id":
                     self.db["items"].update({"_id": item[_id]},
                                             {"$set": {k: str(v)}},
                                             upsert=True)
+                    self._set_item_value(item[_id], k, str(v))
 
 
+    @_writes
     def reconcile_ids(self, id_old, id_new):
         """
         Create id_new if not there, add data of id_old into id_new.
-        Compute the co-occurrence matrix.
+        Compute the co-occurrence matrix (or update its counts if incremental).
         NB id_old is removed!
         :param id_new:
         :param id_old:
         :return: None
         """
-        id_new = str(id_new).replace(".", "")
-        id_old = str(id_old).replace(".", "")
-        if not self.db:
-            # user-item
-            for key, value in self.user_ratings[id_old].items():
-                self.user_ratings[id_new][key] = self.user_ratings[id_old][key]
-            self.user_ratings.pop(id_old)
-
-            for k, v in self.item_ratings.items():
-                if v.has_key(id_old):
-                    v[id_new] = v.pop(id_old)
-            # user-categories
-            if len(self.info_used) > 0:
-                for i in self.info_used:
-                    for key, value in self.tot_categories_user_ratings[i][id_old].items():
-                        self.tot_categories_user_ratings[i][id_new][key] = self.tot_categories_user_ratings[i][id_old][key]
-                    self.tot_categories_user_ratings[i].pop(id_old)
-
-                    for k, v in self.tot_categories_item_ratings[i].items():
-                        if v.has_key(id_old):
-                            v[id_new] = v.pop(id_old)
-
-                    for key, value in self.n_categories_user_ratings[i][id_old].items():
-                        self.n_categories_user_ratings[i][id_new][key] = self.n_categories_user_ratings[i][id_old][key]
-                    self.n_categories_user_ratings[i].pop(id_old)
-
-                    for k, v in self.n_categories_item_ratings[i].items():
-                        if v.has_key(id_old):
-                            v[id_new] = v.pop(id_old)
-        else:  # work on mongo...
-            user_ratings = self.db['user_ratings'].find_one({"_id": id_old}, {"_id": 0})
-            if user_ratings:
-                for key, value in user_ratings.items():
-                    self.db['user_ratings'].update(
-                        {"_id": id_new},
-                        {"$set": {key: value}},
-                        upsert=True
-                    )
-                    self.logger.info("[reconcile_ids] %s : %s for new user_id %s", key, value, id_new)
-                self.logger.info("[reconcile_ids] Removing %s from user_rating", id_old)
-                self.db['user_ratings'].remove({"_id": id_old})
+        self._reconcile_many([(id_old, id_new)])
 
-            self.db['item_ratings'].update(
-                {id_old: {"$exists": True}},
-                {"$rename": {id_old: id_new}},
-                multi=True
-            )
+    @_writes
+    def reconcile_many(self, pairs):
+        """
+        As reconcile_ids, for many users at once (e.g. the sessions of the users who
+        logged in since the last call). Only the data of the users are touched, with
+        MongoDB written with bulk operations, and the co-occurrence is computed once
+        (or its counts updated, if incremental).
+        :param pairs: iterable of (id_old, id_new)
+        :return: number of users reconciled
+        """
+        return self._reconcile_many(pairs)
 
-            try:
-                info_used = self.db['utils'].find_one({"_id": 1}, {'info_used': 1, "_id": 0}).get('info_used', [])
-                self.logger.debug("[reconcile_ids] info_used %s", info_used)
-            except:
-                info_used = []
-                self.logger.debug("[reconcile_ids] info_used not found, setting []", info_used)
-            if len(info_used) > 0:
-                for k in info_used:
-                    users_coll_name = self._coll_name(k, 'user')
-                    items_coll_name = self._coll_name(k, 'item')
-                    # tot and n user ratings....
-                    tot_user_ratings = self.db['tot_' + users_coll_name].find_one({"_id": id_old}, {"_id": 0})
-                    if tot_user_ratings:
-                        for key, value in tot_user_ratings.items():
-                            self.db['tot_' + users_coll_name].update(
-                                {"_id": id_new},
-                                {"$set": {key: value}},
-                                upsert=True
-                            )
-                        self.db['tot_' + users_coll_name].remove({"_id": id_old})
-                    n_user_ratings = self.db['n_' + users_coll_name].find_one({"_id": id_old}, {"_id": 0})
-                    if n_user_ratings:
-                        for key, value in n_user_ratings.items():
-                            self.db['n_' + users_coll_name].update(
-                                {"_id": id_new},
-                                {"$set": {key: value}},
-                                upsert=True
-                            )
-                        self.db['n_' + users_coll_name].remove({"_id": id_old})
-
-                    self.db['tot_' + items_coll_name].update(
-                        {id_old: {"$exists": True}},
-                        {"$rename": {"id_new": "id_old"}},
-                        multi=True
-                    )
+    def _reconcile_many(self, pairs):
+        """
+        See reconcile_many
+        """
+        self.flush()
+        pairs = [(str(id_old).replace(".", ""), str(id_new).replace(".", "")) for id_old, id_new in pairs]
+        pairs = [(id_old, id_new) for id_old, id_new in pairs if id_old != id_new]
+        self._invalidate_results(set(user_id for pair in pairs for user_id in pair))
+        if not self.db:
+            for id_old, id_new in pairs:
+                self._reconcile_memory(id_old, id_new)
+        else:
+            self._reconcile_mongo(pairs)
+        if pairs and not self.incremental:
+            self._model_for(rebuild=True)
+        return len(pairs)
 
-                    self.db['n_' + items_coll_name].update(
-                        {id_old: {"$exists": True}},
-                        {"$rename": {"id_new": "id_old"}},
-                        multi=True
-                    )
-        self._create_cooccurrence()
+    def _reconcile_memory(self, id_old, id_new):
+        """
+        Move the data of id_old into id_new, reading only their own entries: the user's
+        slots in the rating store and in the stores of the categories (inmemory testing)
+        """
+        old = self.user_ids.get(id_old)
+        if old is None:
+            return
+        new = self.user_ids.intern(id_new)
+        # user-item
+        old_times = self.ratings.user_times(old).tolist()
+        old_items, old_ratings = self.ratings.remove_user(old)
+        if self.incremental:
+            self._merge_cooccurrence_counts(old_items.tolist(), self.ratings.user_items(new)[0].tolist())
+        if self._popularity is not None:
+            # ratings of id_new for the same items are overwritten
+            for item in old_items:
+                self._update_popularity(self.item_ids[item], -self.ratings.get(new, item, 0.))
+        for item, rating, t in zip(old_items, old_ratings, old_times):
+            self.ratings.set(new, item, rating, t)
+        # user-categories
+        for i in self.info_used:
+            store = self._category_store(i)
+            values, tots, ns = store.remove_user(old)
+            if self.incremental:
+                self._merge_cooccurrence_counts(values, store.user_values(new)[0], k=i)
+            for value, tot, n in zip(values, tots.tolist(), ns.tolist()):
+                store.set(new, value, tot, n)
 
+    def _reconcile_mongo(self, pairs):
+        """
+        Move the data of each id_old into its id_new. Only the documents of the users are
+        read, with one query per collection for each run of pairs not sharing users: their
+        keys are the items (or values) whose documents have to be changed.
+        The updates of each run are coalesced and written with bulk operations.
+        """
+        try:
+            info_used = self.db['utils'].find_one({"_id": 1}, {'info_used': 1, "_id": 0}).get('info_used', [])
+            self.logger.debug("[reconcile_ids] info_used %s", info_used)
+        except:
+            info_used = []
+            self.logger.debug("[reconcile_ids] info_used not found, setting []")
+        run, users = [], set()
+        for pair in pairs:
+            if pair[0] in users or pair[1] in users:  # its documents are changed by the run
+                self._reconcile_mongo_run(run, info_used)
+                run, users = [], set()
+            run.append(pair)
+            users.update(pair)
+        if run:
+            self._reconcile_mongo_run(run, info_used)
 
-    def compute_items_by_popularity(self, max_items=10, fast=False):
+    def _reconcile_mongo_run(self, pairs, info_used):
         """
-        As per name, get self.
-        :return: list of popular items, 0=most popular
+        See _reconcile_mongo. Each user appears once in pairs
         """
-        if fast and (time() - self.items_by_popularity_updated) < 1800:
-            return self.items_by_popularity
-        else:
-            self.items_by_popularity_updated = time()
+        buffer = UpdateBuffer(self.db)
+        removed = defaultdict(list)  # {collection: [_id]}
+        old_ids = [id_old for id_old, _ in pairs]
+        new_ids = [id_new for _, id_new in pairs]
 
-        if not self.db:
-            df_item = pd.DataFrame(self.item_ratings).fillna(0).astype(int).sum()
-        else:  # Mongodb
-            df_item = pd.DataFrame.from_records(list(self.db['user_ratings'].find())).set_index('_id').sum()
-
-        df_item.sort(ascending=False)
-        pop_items = list(df_item.index)
-        if len(pop_items) >= max_items:
-            self.items_by_popularity = pop_items
-        else:
+        def documents(coll_name, user_ids):
+            return dict((d.pop("_id"), d) for d in self.db[coll_name].find({"_id": {"$in": user_ids}}))
+
+        def move(coll_name, items_coll_name, id_old, id_new, doc):
+            # doc: document of id_old in coll_name, without _id
+            for key, value in doc.items():
+                buffer.set(coll_name, id_new, key, value)
+                buffer.unset(items_coll_name, key, id_old)
+                buffer.set(items_coll_name, key, id_new, value)
+            removed[coll_name].append(id_old)
+
+        user_ratings = documents('user_ratings', old_ids)
+        if user_ratings and (self.incremental or self._popularity is not None):
+            new_user_ratings = documents('user_ratings', new_ids)
+        for id_old, id_new in pairs:
+            if id_old not in user_ratings:
+                continue
+            old_ratings = user_ratings[id_old]
+            if self.incremental or self._popularity is not None:
+                new_ratings = new_user_ratings.get(id_new, {})
+                if self.incremental:
+                    self._merge_cooccurrence_counts(old_ratings.keys(), new_ratings.keys(), buffer=buffer)
+                # ratings of id_new for the same items are overwritten
+                for key in old_ratings:
+                    self._update_popularity(key, -new_ratings.get(key, 0.))
+            self.logger.info("[reconcile_ids] Moving %s ratings of %s to %s", len(old_ratings), id_old, id_new)
+            move('user_ratings', 'item_ratings', id_old, id_new, old_ratings)
+        if user_ratings and self._retention() is not None:
+            # the times of the ratings go with them
+            new_id = dict(pairs)
+            times = list(self.db['rating_times'].find({'u': {"$in": user_ratings.keys()}}))
+            for d in times:
+                _id = json.dumps([new_id[d['u']], d['i']])
+                for field, value in (('u', new_id[d['u']]), ('i', d['i']), ('t', d['t'])):
+                    buffer.set('rating_times', _id, field, value)
+            if times:
+                removed['rating_times'] = [d['_id'] for d in times]
+        for k in info_used:
+            users_coll_name = self._coll_name(k, 'user')
+            # sum and number of ratings of each value
+            old_counts = documents(users_coll_name, old_ids)
+            if self.incremental and old_counts:
+                new_counts = documents(users_coll_name, new_ids)
+            for id_old, id_new in pairs:
+                if id_old not in old_counts:
+                    continue
+                if self.incremental:
+                    self._merge_cooccurrence_counts(
+                        [v for v, c in old_counts[id_old].items() if c.get('n', 0) > 0],
+                        [v for v, c in new_counts.get(id_new, {}).items() if c.get('n', 0) > 0],
+                        k=k, buffer=buffer)
+                for value, counts in old_counts[id_old].items():
+                    buffer.set(users_coll_name, id_new, value, counts)
+                removed[users_coll_name].append(id_old)
+        buffer.flush()
+        for coll_name, user_ids in removed.items():
+            self.db[coll_name].remove({"_id": {"$in": user_ids}})
+
+
+    def _popularity_ranking(self):
+        """
+        Items ranked by sum of ratings, read from all the ratings only the first time
+        :return: PopularityRanking
+        """
+        if self._popularity is None:
             if not self.db:
-                all_items = set(self.items.keys())
+                tot_ratings = self.ratings.item_totals(len(self.item_ids))
+                order = np.argsort(-tot_ratings, kind='mergesort')
+                scores = zip(self.item_ids.ids(order), tot_ratings[order].tolist())
             else:
-                all_items = set([ d["_id"] for d in self.db['items'].find({}, {"_id": 1})])
-            self.items_by_popularity = pop_items + list( all_items - set(pop_items) )
+                tot_ratings = defaultdict(float)
+                for d in self.db['user_ratings'].find({}, {"_id": 0}):
+                    for item_id, rating in d.items():
+                        tot_ratings[item_id] += rating
+                scores = sorted(tot_ratings.items(), key=lambda x: -x[1])
+                scores += [(d["_id"], 0.) for d in self.db['items'].find({}, {"_id": 1})]
+            self._popularity = PopularityRanking(scores)
+        return self._popularity
+
+    def _update_popularity(self, item_id, delta=0.):
+        """
+        Add delta to the popularity of item_id (inserted if new), if the ranking is there
+        """
+        if self._popularity is not None:
+            self._popularity.add(item_id, delta)
+
+    @_reads
+    def compute_items_by_popularity(self, max_items=10, fast=False):
+        """
+        As per name, get self. The ranking is kept up to date by insert_rating etc.,
+        therefore there is no computation (fast and max_items are only kept for compatibility).
+        :return: list of popular items, 0=most popular
+        """
+        self.items_by_popularity = self._popularity_ranking().top()
+        self.items_by_popularity_updated = time()
+        return self.items_by_popularity
 
 
-    def get_similar_item(self, item_id, user_id=None, algorithm='simple'):
+    @_reads
+    def get_similar_item(self, item_id, user_id=None, algorithm='simple', max_items=10):
         """
-        TODO
-        Simple: return the row of the co-occurrence matrix ordered by score or,
-        if user_id is not None, multiplied times the user_id rating
-        (not transposed!) so to weigh the similarity score with the
-        rating of the user
+        Items most rated together with item_id ("customers also bought"), read from
+        the similar_items neighbors of each item (see _neighbor_index).
+        Simple: the row of the co-occurrence matrix ordered by score or,
+        if user_id is not None, multiplied times the user_id rating of item_id
+        (if rated) so to weigh the similarity score with the rating of the user.
+        Items the user has already rated are left out.
+        Items newer than the model have no similar items until it is rebuilt.
         :param item_id: Id of the item
         :param user_id: Id of the user
-        :param algorithm: keep it simple...
-        :return:
+        :param algorithm: simple (co-occurrence) or llr (log-likelihood ratio)
+        :param max_items: max number of items returned, at most similar_items
+        :return: [(item_id, score), ...], highest scores first
         """
-        user_id = str(user_id).replace('.', '')
-        pass
+        if algorithm not in ('simple', 'llr'):
+            raise ValueError("Unknown algorithm %s, use simple or llr" % algorithm)
+        if self.incremental and algorithm == 'simple':
+            neighbors = self._counts_neighbors(item_id)
+        else:
+            model = self._model_for(rebuild=not self._model.updated)
+            neighbors = self._neighbor_index(model, algorithm).neighbors(item_id)
+        if user_id is not None:
+            rated = self.get_user_info(str(user_id).replace('.', ''))
+            weight = float(rated.get(item_id) or 1)
+            neighbors = [(other, score * weight) for other, score in neighbors if not rated.get(other)]
+        return neighbors[:max_items]
 
 
+    @_writes
     def remove_rating(self, user_id, item_id):
         """
         Remove ratings from item and user. This cannot be undone for categories
@@ -319,20 +1255,238 @@ class Recommender(Singleton):
         :param item_id:
         :return:
         """
+        self.flush()
         user_id = str(user_id).replace('.', '')
+        self._invalidate_results([user_id])
         if not self.db:
-            self.user_ratings[user_id].pop(item_id, None)
-            self.item_ratings[item_id].pop(user_id, None)
-            self.items[item_id] = {}  # just insert the bare id. quite useless because it is a defaultdict, but in case .keys() we can count the # of items
+            user = self.user_ids.get(user_id)
+            item = self._intern_item(item_id)  # keep the item, so that we can count the # of items
+            removed = self.ratings.remove(user, item) if user is not None else None
+            if removed is not None:
+                self._update_popularity(item_id, -removed)
+                if self.incremental:
+                    self._update_cooccurrence_counts(item, self.ratings.user_items(user)[0].tolist(), step=-1)
         else:
-            self.db['user_ratings'].remove(
-                {"_id": user_id, item_id: {"$exists": True}})
+            previous = self.db['user_ratings'].find_and_modify(
+                {"_id": user_id, item_id: {"$exists": True}},
+                {"$unset": {item_id: ""}})
+            if previous:
+                self._update_popularity(item_id, -previous[item_id])
+                if self.incremental:
+                    self._update_cooccurrence_counts(item_id, [i for i in previous if i != "_id"], step=-1)
+
+            self.db['item_ratings'].update(
+                {"_id": item_id, user_id: {"$exists": True}},
+                {"$unset": {user_id: ""}})
+
+
+    @_writes
+    def expire_ratings(self, now=None):
+        """
+        Evict the ratings older than the retention (rating_window, or the time rating_half_life
+        takes to weigh min_rating_weight) from the ratings, the popularity, the categories
+        and, if incremental, the co-occurrence counts. insert_rating etc. do it already,
+        with MongoDB in a thread of their own every 1/100 of the retention at most.
+        :param now: time the age of the ratings is computed from, time() if None
+        :return: number of ratings evicted
+        """
+        self.flush()
+        return self._expire_ratings(now, force=True)
+
+    def _expire_ratings(self, now=None, force=False):
+        """
+        See expire_ratings. In memory only the head of the queue of the ratings is read,
+        so it is done on every insert_rating. With MongoDB, unless force, it is done every
+        1/100 of the retention at most, and not by the caller (see _expire_in_background)
+        :return: number of ratings evicted (0 if in the background)
+        """
+        retention = self._retention()
+        if retention is None:
+            return 0
+        now = time() if now is None else float(now)
+        if not self.db:
+            return self._expire_memory(now - retention)
+        if force:
+            self._expired_at = now
+            return self._expire_mongo(now - retention)
+        if now - self._expired_at >= retention / 100.:
+            self._expired_at = now
+            expirer = threading.Thread(target=self._expire_in_background, args=(now - retention,),
+                                       name='csrec-expirer')
+            expirer.daemon = True
+            expirer.start()
+        return 0
+
+    def _expire_in_background(self, before):
+        """
+        Run by the thread started by _expire_ratings: evict the ratings older than before
+        one chunk at a time, each with the lock for writing, so that the insert which
+        started it does not wait for it, and other calls are served between chunks.
+        """
+        try:
+            self.flush()
+            n_evicted = 0
+            while True:
+                with self._lock.write():
+                    if not self.db['rating_times'].find_one({'t': {'$lt': before}}):
+                        break
+                    n_evicted += self._expire_mongo(before, max_chunks=1)
+            self.logger.debug("[_expire_in_background] %s ratings evicted", n_evicted)
+        except Exception, e:
+            self.logger.error("[_expire_in_background] Old ratings not evicted")
+            logging.exception(e)
+
+    def _expire_memory(self, before):
+        """
+        See expire_ratings (inmemory testing)
+        """
+        users, items, ratings = self.ratings.expire(before)
+        evicted = defaultdict(list)  # {user: [(item, rating), ...]}
+        for user, item, rating in zip(users, items, ratings):
+            evicted[user].append((item, rating))
+        for user, user_ratings in evicted.items():
+            user_id = self.user_ids[user]
+            history = self.ratings.user_items(user)[0].tolist()
+            for n, (item, rating) in enumerate(user_ratings):
+                item_id = self.item_ids[item]
+                self._update_popularity(item_id, -rating)
+                if self.incremental:
+                    # the ones evicted after it are still in the history
+                    self._update_cooccurrence_counts(item, history + [i for i, _ in user_ratings[n + 1:]], step=-1)
+                item_info = self._item_info(item_id)
+                if item_info:
+                    self._remove_categories(user_id, item_info, rating)
+            self._invalidate_results([user_id])
+        if users:
+            self.logger.debug("[expire_ratings] %s ratings evicted", len(users))
+        return len(users)
+
+    def _remove_categories(self, user_id, item, rating):
+        """
+        Undo _insert_categories for a rating of item, for the categories in info_used whose
+        values the user has rated. Entries reaching 0 ratings are dropped (inmemory testing)
+        :param item: item's information, e.g. {"author": "AA. VV.", ...}
+        """
+        user = self.user_ids.get(user_id)
+        if user is None:
+            return
+        for k in self.info_used:
+            store = self._category_store(k)
+            for value in self._category_values(item.get(k)):
+                if store.get(user, value)[1] > 0 and store.add(user, value, -int(rating), -1) == 0 \
+                        and self.incremental:  # no more ratings of the value by the user
+                    self._update_cooccurrence_counts(value, store.user_values(user)[0], step=-1, k=k)
+
+    def _expire_mongo(self, before, chunk_size=10000, max_chunks=None):
+        """
+        See expire_ratings. The ratings to evict are read from rating_times in chunks, and
+        removed with bulk operations, as in _insert_ratings_mongo
+        :param max_chunks: chunks evicted at most, None for all of them
+        """
+        try:
+            info_used = self.db['utils'].find_one({"_id": 1}, {'info_used': 1, "_id": 0}).get('info_used', [])
+        except:
+            info_used = []
+        n_evicted, n_chunks = 0, 0
+        while max_chunks is None or n_chunks < max_chunks:
+            events = list(self.db['rating_times'].find({'t': {'$lt': before}}).limit(chunk_size))
+            if not events:
+                break
+            n_chunks += 1
+            buffer = UpdateBuffer(self.db)
+            user_ids = list(set(e['u'] for e in events))
+
+            def documents(coll_name):
+                return dict((d.pop("_id"), d) for d in self.db[coll_name].find({"_id": {"$in": user_ids}}))
+
+            user_ratings = documents('user_ratings')
+            items = self._get_items(list(set(e['i'] for e in events)))
+            categories = dict((k, documents(self._coll_name(k, 'user'))) for k in info_used)
+            for e in events:
+                user_id, item_id = e['u'], e['i']
+                rated = user_ratings.get(user_id, {})
+                if item_id not in rated:
+                    continue
+                rating = rated.pop(item_id)
+                n_evicted += 1
+                buffer.unset('user_ratings', user_id, item_id)
+                buffer.unset('item_ratings', item_id, user_id)
+                self._update_popularity(item_id, -rating)
+                if self.incremental:
+                    self._update_cooccurrence_counts(item_id, rated.keys(), step=-1, buffer=buffer)
+                item = items.get(item_id) or {}
+                for k in info_used:
+                    counts = categories[k].get(user_id, {})
+                    users_coll_name = self._coll_name(k, 'user')
+                    for value in [v for v in self._category_values(item.get(k)) if counts.get(v, {}).get('n', 0) > 0]:
+                        counts[value]['n'] -= 1
+                        if counts[value]['n'] > 0:
+                            buffer.inc(users_coll_name, user_id, value + '.t', -rating)
+                            buffer.inc(users_coll_name, user_id, value + '.n', -1)
+                            continue
+                        # no more ratings of the value by the user
+                        buffer.unset(users_coll_name, user_id, value)
+                        if self.incremental:
+                            self._update_cooccurrence_counts(
+                                value, [w for w, c in counts.items() if c.get('n', 0) > 0], step=-1, k=k,
+                                buffer=buffer)
+            buffer.flush()
+            self.db['rating_times'].remove({"_id": {"$in": [e['_id'] for e in events]}})
+            self._invalidate_results(user_ids)
+        if n_evicted:
+            self.logger.debug("[expire_ratings] %s ratings evicted", n_evicted)
+        return n_evicted
 
-            self.db['item_ratings'].remove(
-                {"_id": item_id, user_id: {"$exists": True}})
+    def _info_values(self, v):
+        """
+        Some items' attributes are lists (e.g. tags: [])
+        or, worse, string which can represent lists...
+        :param v: value of an item's attribute
+        :return: list of values
+        """
+        try:
+            v = json.loads(v.replace("'", '"'))
+        except:
+            pass
+        if not hasattr(v, '__iter__'):
+            return [v]
+        return v
 
+    def _insert_categories(self, user_id, item, item_info, rating):
+        """
+        Add the rating to the categories (item_info) of item (inmemory testing)
+        :param user_id:
+        :param item: item's information, e.g. {"author": "AA. VV.", ...}
+        :param item_info: categories to be used, e.g. ['author']
+        :param rating:
+        :return: None
+        """
+        if len(item_info) > 0:
+            for k,v in item.items():
+                if k in item_info:
+                    values = self._info_values(v)
+                    self.info_used.add(k)
+                    # we cannot set the rating, because we want to keep the info
+                    # that a user has read N books of, say, the same author,
+                    # category etc.
+                    # We could sum all the ratings and count the a result as "big rating".
+                    # Reading N books of author A and rating them 5 would be the same as reading
+                    # 5*N books of author B and rating them 1.
+                    # Still:
+                    # 1) we don't want ratings for category to skyrocket, so we have to take the average
+                    # 2) if a user changes their idea on rating a book, it should not add up. Average
+                    #   is not perfect, but close enough. Take total number of ratings and total rating
+                    store = self._category_store(k)
+                    user = self.user_ids.intern(user_id)
+                    for value in values:
+                        if len(str(value)) > 0:
+                            if self.incremental and not store.get(user, value)[1]:
+                                self._update_cooccurrence_counts(value, store.user_values(user)[0], k=k)
+                            # one entry: the values x users view is derived from the store
+                            store.add(user, value, int(rating))
 
-    def insert_rating(self, user_id, item_id, rating=3, item_info=None, only_info=False):
+    @_writes
+    def insert_rating(self, user_id, item_id, rating=3, item_info=None, only_info=False, timestamp=None):
         """
         item is treated as item_id if it is not a dict, otherwise we look
         for a key called item_id_key if it is a dict.
@@ -352,10 +1506,12 @@ class Recommender(Singleton):
         :param rating: float parseable
         :param item_info: any info given with dict(item), e.g. ['author', 'category', 'subcategory']
         :param only_info: not used yet
+        :param timestamp: time of the rating (seconds, as time()), now if None. See rating_window
         :return: [recommended item_id_values]
         """
         if not item_info:
             item_info = []
+        t = time() if timestamp is None else float(timestamp)
         # If only_info==True, only the item_info's are put in the co-occurrence, not item_id.
         # This is necessary when we have for instance a "segmentation page" where we propose
         # well known items to get to know the user. If s/he select "Harry Potter" we only want
@@ -363,54 +1519,40 @@ class Recommender(Singleton):
 
         # Now fill the dicts or the Mongodb collections if available
         user_id = str(user_id).replace('.', '')
+        self._count_ratings()
+        self._invalidate_results([user_id])
         if not self.db:   # fill dicts and work only in memory
-            if self.items.get(item_id):
-                item = self.items.get(item_id)
+            if self._item_info(item_id):
+                item = self._item_info(item_id)
                 # Do categories only if the item is stored
-                if len(item_info) > 0:
-                    for k,v in item.items():
-                        if k in item_info:
-                            # Some items' attributes are lists (e.g. tags: [])
-                            # or, worse, string which can represent lists...
-                            try:
-                                v = json.loads(v.replace("'", '"'))
-                            except:
-                                pass
-                            if not hasattr(v, '__iter__'):
-                                values = [v]
-                            else:
-                                values = v
-                            self.info_used.add(k)
-                            # we cannot set the rating, because we want to keep the info
-                            # that a user has read N books of, say, the same author,
-                            # category etc.
-                            # We could sum all the ratings and count the a result as "big rating".
-                            # Reading N books of author A and rating them 5 would be the same as reading
-                            # 5*N books of author B and rating them 1.
-                            # Still:
-                            # 1) we don't want ratings for category to skyrocket, so we have to take the average
-                            # 2) if a user changes their idea on rating a book, it should not add up. Average
-                            #   is not perfect, but close enough. Take total number of ratings and total rating
-                            for value in values:
-                                if len(str(value)) > 0:
-                                    self.tot_categories_user_ratings[k][user_id][value] += int(rating)
-                                    self.n_categories_user_ratings[k][user_id][value] += 1
-                                    # for the co-occurrence matrix is not necessary to do the same for item, but better do it
-                                    # in case we want to compute similarities etc using categories
-                                    self.tot_categories_item_ratings[k][value][user_id] += int(rating)
-                                    self.n_categories_item_ratings[k][value][user_id] += 1
-
+                self._insert_categories(user_id, item, item_info, rating)
             else:
                 self.insert_item({"_id": item_id})
             # Do item always, at least is for categories profiling
             if not only_info:
-                self.user_ratings[user_id][item_id] = float(rating)
-                self.item_ratings[item_id][user_id] = float(rating)
+                user = self.user_ids.intern(user_id)
+                item = self._intern_item(item_id)
+                history = self.ratings.user_items(user)[0]
+                if self._popularity is not None:
+                    self._update_popularity(item_id, float(rating) - self.ratings.get(user, item, 0.))
+                if self.ratings.set(user, item, float(rating), t) and self.incremental:
+                    self._update_cooccurrence_counts(item, history.tolist())
+            self._expire_ratings()
+        # MongoDB, write-behind: keep the rating, written later by flush
+        elif self.write_behind:
+            if not self._pending_ratings:
+                self._pending_since = time()
+            self._pending_ratings.append((user_id, item_id, float(rating), t, tuple(item_info), only_info))
+            if len(self._pending_ratings) >= self.write_behind or \
+                    time() - self._pending_since >= self.write_behind_seconds:
+                self.flush()
+            else:  # written in time even if no other call comes
+                self._schedule_flush(self.write_behind_seconds)
         # MongoDB
         else:
             # If the item is not stored, we don't have its categories
             # Therefore do categories only if the item is found stored
-            item = self.db['items'].find_one({"_id": item_id})
+            item = self._get_items([item_id]).get(item_id)
             if item:
                 if len(item_info) > 0:
                     self.logger.debug('[insert_rating] Looking for the following info: %s', item_info)
@@ -420,58 +1562,389 @@ class Recommender(Singleton):
                                               k)
 
                             users_coll_name = self._coll_name(k, 'user')
-                            items_coll_name = self._coll_name(k, 'item')
 
                             self.db['utils'].update({"_id": 1},
                                                     {"$addToSet": {'info_used': k}},
                                                     upsert=True)
 
                             # Some items' attributes are lists (e.g. tags: [])
-                            try:
-                                v = json.loads(v.replace("'", '"'))
-                            except:
-                                pass
-                            if not hasattr(v, '__iter__'):
-                                values = [str(v)]
-                            else:
-                                values = [str(i) for i in v]  # It's going to be a key, no numbers
+                            values = [str(i) for i in self._info_values(v)]  # It's going to be a key, no numbers
 
                             # see comments above
+                            # see comments above: {_id: user_id, value: {'t': sum, 'n': number of ratings}}
                             for value in values:
                                 if len(value) > 0:
-                                    self.db['tot_' + users_coll_name].update({'_id': user_id},
-                                                                             {'$inc': {value: float(rating)}},
-                                                                              upsert=True)
-                                    self.db['n_' + users_coll_name].update({'_id': user_id},
-                                                   {'$inc': {value: 1}},
-                                                    upsert=True)
-                                    self.db['tot_' + items_coll_name].update({'_id': value},
-                                                   {'$inc': {user_id: float(rating)}},
-                                                    upsert=True)
-                                    self.db['n_' + items_coll_name].update({'_id': value},
-                                                   {'$inc': {user_id: 1}},
-                                                    upsert=True)
-                                    self.db['items'].update(
-                                        {"_id": item_id},
-                                        {"$set": {k: value}},
-                                        upsert=True
-                                    )
+                                    inc = {value + '.t': float(rating), value + '.n': 1}
+                                    if self.incremental:
+                                        previous = self.db[users_coll_name].find_and_modify(
+                                            {'_id': user_id}, {'$inc': inc}, upsert=True) or {}
+                                        if not previous.get(value, {}).get('n'):
+                                            self._update_cooccurrence_counts(
+                                                value,
+                                                [w for w, c in previous.items() if w != '_id' and c.get('n', 0) > 0],
+                                                k=k)
+                                    else:
+                                        self.db[users_coll_name].update({'_id': user_id},
+                                                                        {'$inc': inc},
+                                                                        upsert=True)
             else:
                 self.insert_item({"_id": item_id})  # Obviously there won't be categories...
 
             if not only_info:
-                self.db['user_ratings'].update(
-                    {"_id": user_id},
-                    {"$set": {item_id: float(rating)}},
-                    upsert=True
-                )
+                if self.incremental or self._popularity is not None:
+                    previous = self.db['user_ratings'].find_and_modify(
+                        {"_id": user_id}, {"$set": {item_id: float(rating)}}, upsert=True) or {}
+                    if self.incremental and item_id not in previous:
+                        self._update_cooccurrence_counts(item_id, [i for i in previous if i != "_id"])
+                    self._update_popularity(item_id, float(rating) - previous.get(item_id, 0.))
+                else:
+                    self.db['user_ratings'].update(
+                        {"_id": user_id},
+                        {"$set": {item_id: float(rating)}},
+                        upsert=True
+                    )
                 self.db['item_ratings'].update(
                     {"_id": item_id},
                     {"$set": {user_id: float(rating)}},
                     upsert=True
                 )
+                if self._retention() is not None:
+                    self.db['rating_times'].update(
+                        {"_id": json.dumps([user_id, item_id])},
+                        {"$set": {'u': user_id, 'i': item_id, 't': t}},
+                        upsert=True
+                    )
+            self._expire_ratings()
+
+
+    def _rating_record(self, record):
+        """
+        :param record: (user_id, item_id[, rating[, timestamp]]) or
+                       {'user_id': .., 'item_id': .., 'rating': .., 'timestamp': ..}
+        :return: user_id (no dots), item_id, rating (float), time (float, now if not given)
+        """
+        if isinstance(record, dict):
+            user_id, item_id = record['user_id'], record['item_id']
+            rating = record.get('rating')
+            timestamp = record.get('timestamp')
+        else:
+            user_id, item_id = record[0], record[1]
+            rating = record[2] if len(record) > 2 else None
+            timestamp = record[3] if len(record) > 3 else None
+        if rating is None or rating == '':
+            rating = self.default_rating
+        t = time() if timestamp is None or timestamp == '' else float(timestamp)
+        return str(user_id).replace('.', ''), item_id, float(rating), t
+
+    def insert_ratings_bulk(self, ratings, item_info=None, only_info=False, chunk_size=10000):
+        """
+        As insert_rating, for many ratings. ratings can be any iterable (e.g. a generator),
+        it is consumed in chunks of chunk_size ratings, so memory stays bounded.
+        Each chunk is applied at once: with MongoDB, updates on the same document are
+        coalesced and written with bulk operations.
+        :param ratings: iterable of (user_id, item_id[, rating[, timestamp]]) or
+                        {'user_id': .., 'item_id': .., 'rating': .., 'timestamp': ..}.
+                        Default rating is default_rating, default timestamp now
+        :param item_info: as in insert_rating, for all ratings
+        :param only_info: as in insert_rating, for all ratings
+        :param chunk_size: number of ratings applied together
+        :return: number of ratings inserted
+        """
+        self.flush()
+        if not item_info:
+            item_info = []
+        n_ratings = 0
+        for chunk in chunks(ratings, chunk_size):
+            records = [self._rating_record(r) for r in chunk]
+            with self._lock.write():
+                self._count_ratings(len(records))
+                self._invalidate_results(set(user_id for user_id, _, _, _ in records))
+                if not self.db:
+                    self._insert_ratings_memory(records, item_info, only_info)
+                else:
+                    self._insert_ratings_mongo(records, item_info, only_info)
+                self._expire_ratings()
+            n_ratings += len(records)
+            self.logger.debug("[insert_ratings_bulk] %s ratings inserted", n_ratings)
+        return n_ratings
+
+    def _insert_ratings_memory(self, records, item_info, only_info):
+        """
+        See insert_ratings_bulk
+        """
+        for user_id, item_id, rating, _ in records:
+            item = self._item_info(item_id)
+            if item:
+                self._insert_categories(user_id, item, item_info, rating)
+            else:
+                self.insert_item({"_id": item_id})
+        if only_info:
+            return
+        users = [self.user_ids.intern(user_id) for user_id, _, _, _ in records]
+        items = [self._intern_item(item_id) for _, item_id, _, _ in records]
+        if self.incremental:
+            histories = dict((user, self.ratings.user_items(user)[0].tolist()) for user in set(users))
+        if self._popularity is not None:
+            latest = {}  # {(user, item): rating}, ratings of this chunk
+            for user, item, (_, item_id, rating, _) in zip(users, items, records):
+                previous = latest[(user, item)] if (user, item) in latest else self.ratings.get(user, item, 0.)
+                self._update_popularity(item_id, rating - previous)
+                latest[(user, item)] = rating
+        new = self.ratings.set_many(users, items, [rating for _, _, rating, _ in records],
+                                    [t for _, _, _, t in records])
+        if self.incremental:
+            for user, item, is_new in zip(users, items, new):
+                if is_new:
+                    self._update_cooccurrence_counts(item, histories[user])
+                    histories[user].append(item)
+
+    def _insert_ratings_mongo(self, records, item_info, only_info):
+        """
+        See insert_ratings_bulk
+        """
+        buffer = UpdateBuffer(self.db)
+        user_ids = list(set(user_id for user_id, _, _, _ in records))
+        item_ids = list(set(item_id for _, item_id, _, _ in records))
+        items = self._get_items(item_ids)
+        histories = {}  # {k: {user_id: {item or value: rating or n}}}, if incremental (or popularity for items)
+
+        def history(k, user_id):
+            if k not in histories:
+                if k is None:
+                    docs = self.db['user_ratings'].find({"_id": {"$in": user_ids}})
+                    histories[k] = dict((d.pop("_id"), dict((w, n) for w, n in d.items() if n)) for d in docs)
+                else:
+                    docs = self.db[self._coll_name(k, 'user')].find({"_id": {"$in": user_ids}})
+                    histories[k] = dict((d.pop("_id"), dict((w, c['n']) for w, c in d.items() if c.get('n')))
+                                        for d in docs)
+            return histories[k].setdefault(user_id, {})
+
+        for user_id, item_id, rating, t in records:
+            item = items.get(item_id)
+            if item and len(item_info) > 0:
+                for k, v in item.items():
+                    if k in item_info and v is not None:
+                        users_coll_name = self._coll_name(k, 'user')
+                        buffer.add_to_set('utils', 1, 'info_used', k)
+                        for value in [str(i) for i in self._info_values(v)]:
+                            if len(value) > 0:
+                                if self.incremental:
+                                    values = history(k, user_id)
+                                    if value not in values:
+                                        self._update_cooccurrence_counts(value, values, k=k, buffer=buffer)
+                                        values[value] = 1
+                                buffer.inc(users_coll_name, user_id, value + '.t', rating)
+                                buffer.inc(users_coll_name, user_id, value + '.n', 1)
+            if not only_info:
+                if self.incremental or self._popularity is not None:
+                    rated = history(None, user_id)
+                    if self.incremental and item_id not in rated:
+                        self._update_cooccurrence_counts(item_id, rated, buffer=buffer)
+                    self._update_popularity(item_id, rating - rated.get(item_id, 0.))
+                    rated[item_id] = rating
+                buffer.set('user_ratings', user_id, item_id, rating)
+                buffer.set('item_ratings', item_id, user_id, rating)
+                if self._retention() is not None:
+                    _id = json.dumps([user_id, item_id])
+                    buffer.set('rating_times', _id, 'u', user_id)
+                    buffer.set('rating_times', _id, 'i', item_id)
+                    buffer.set('rating_times', _id, 't', t)
+        buffer.flush()
+
+    def insert_items_bulk(self, items, _id="_id", chunk_size=10000):
+        """
+        As insert_item, for many items. items can be any iterable (e.g. a generator),
+        consumed in chunks of chunk_size items. With MongoDB each chunk is written
+        with one bulk operation.
+        :param items: iterable of {_id: item_id, cat1: ...}
+        :param _id: key of the item id in the dicts
+        :param chunk_size: number of items written together
+        :return: number of items inserted
+        """
+        self.flush()
+        n_items = 0
+        for chunk in chunks(items, chunk_size):
+            if not self.db:
+                for item in chunk:
+                    self.insert_item(item, _id=_id)
+            else:
+                with self._lock.write():
+                    self.item_id_key = _id
+                    self._invalidate_results()
+                    buffer = UpdateBuffer(self.db)
+                    for item in chunk:
+                        for k, v in item.items():
+                            if k != "_id":
+                                buffer.set("items", item[_id], k, str(v))
+                                self._set_item_value(item[_id], k, str(v))
+                        self._update_popularity(item[_id])
+                    buffer.flush()
+            n_items += len(chunk)
+        return n_items
+
+    def flush(self):
+        """
+        Write the ratings kept by insert_rating in write_behind mode. Updates are coalesced
+        per document (e.g. $inc on the same user summed) and written with bulk operations.
+        Called on size/time threshold, before any other operation, and at exit.
+        :return: number of ratings written
+        """
+        if not self._pending_ratings or self._lock.reading():
+            # nothing to write, or already reading (then they were written before, see _reads)
+            return 0
+        with self._lock.write():
+            pending, self._pending_ratings = self._pending_ratings, []
+            n = 0
+            while n < len(pending):
+                # consecutive ratings with the same item_info/only_info go together
+                _, _, _, _, item_info, only_info = pending[n]
+                group = []
+                while n < len(pending) and pending[n][4:] == (item_info, only_info):
+                    group.append(pending[n][:4])
+                    n += 1
+                self._insert_ratings_mongo(group, list(item_info), only_info)
+            self._expire_ratings()
+        with self._flush_timer_lock:  # nothing left for it (e.g. flushed at exit), unless it is flushing
+            timer = self._flush_timer
+            if timer is threading.current_thread():
+                timer = None
+            else:
+                self._flush_timer = None
+        if timer is not None:
+            timer.cancel()
+        if pending:
+            self.logger.debug("[flush] %s ratings written", len(pending))
+        return len(pending)
+
+    def _schedule_flush(self, seconds):
+        """
+        Flush the pending ratings in seconds, from a timer thread, unless a timer is already waiting
+        """
+        with self._flush_timer_lock:
+            if self._flush_timer is not None:
+                return
+            self._flush_timer = threading.Timer(seconds, self._flush_when_due)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _flush_when_due(self):
+        """
+        Run by the timer of _schedule_flush: flush the pending ratings if the oldest one is
+        write_behind_seconds old. If they are newer (the ones it was set for were written
+        meanwhile), wait for them.
+        """
+        with self._flush_timer_lock:
+            wait = self._pending_since + self.write_behind_seconds - time() if self._pending_ratings else None
+            if wait is None or wait > 0:  # otherwise kept while flushing, so that _stop_write_behind waits
+                self._flush_timer = None
+        try:
+            if wait is not None and wait > 0:
+                self._schedule_flush(wait)
+            elif wait is not None:
+                self.flush()
+        except Exception, e:
+            self.logger.error("[_flush_when_due] Pending ratings not written")
+            logging.exception(e)
+        finally:
+            with self._flush_timer_lock:
+                if self._flush_timer is threading.current_thread():
+                    self._flush_timer = None
+            if self._pending_ratings:  # inserted while flushing, when no new timer could be set
+                self._schedule_flush(self.write_behind_seconds)
 
+    def _stop_write_behind(self):
+        """
+        At exit: stop the timer of _schedule_flush (waiting for it, if it is flushing), and
+        write the pending ratings
+        """
+        while True:
+            with self._flush_timer_lock:
+                timer, self._flush_timer = self._flush_timer, None
+            if timer is None:
+                break
+            timer.cancel()
+            timer.join()
+        self.flush()
 
+    def load_ratings(self, path, item_info=None, only_info=False, chunk_size=10000):
+        """
+        Stream ratings from a file into insert_ratings_bulk, with bounded memory.
+        :param path: .csv file with header user_id,item_id,rating or
+                     JSON lines {"user_id": .., "item_id": .., "rating": ..}
+        :return: number of ratings inserted
+        """
+        return self.insert_ratings_bulk(read_records(path), item_info=item_info,
+                                        only_info=only_info, chunk_size=chunk_size)
+
+    def load_items(self, path, _id="_id", chunk_size=10000):
+        """
+        Stream items from a file into insert_items_bulk, with bounded memory.
+        :param path: .csv file with a header (e.g. _id,author,tags) or JSON lines
+        :return: number of items inserted
+        """
+        return self.insert_items_bulk(read_records(path), _id=_id, chunk_size=chunk_size)
+
+    def _get_user_vectors(self, user_id):
+        """
+        Read only the ratings of user_id, instead of building the whole rating matrices
+        :param user_id:
+        :return: {item_id: rating}, {cat: {value: average rating}}, info_used
+        """
+        item_vecs, cat_vecs, info_used = self._get_users_vectors([user_id])
+        return item_vecs[0], cat_vecs[0], info_used
+
+    def _get_users_vectors(self, user_ids):
+        """
+        As _get_user_vectors for a list of users. With MongoDB there is one query
+        per collection, not one per user. With rating_half_life, ratings are weighed
+        0.5 ** (age / rating_half_life).
+        :param user_ids: list of user ids
+        :return: [{item_id: rating}, ...], [{cat: {value: average rating}}, ...], info_used
+        """
+        info_used = self._get_info_used()
+        now = time()
+        user_cat_vecs = [{} for _ in user_ids]
+        if not self.db:
+            user_item_vecs = []
+            for user_id in user_ids:
+                user = self.user_ids.get(user_id)
+                if user is None:
+                    user_item_vecs.append({})
+                    continue
+                items, ratings = self.ratings.user_items(user)
+                if self.rating_half_life is not None:
+                    ratings = ratings * 0.5 ** ((now - self.ratings.user_times(user)) / self.rating_half_life)
+                user_item_vecs.append(dict(zip(self.item_ids.ids(items), ratings.tolist())))
+            for i in info_used:
+                store = self._category_store(i)
+                for user_id, user_cat_vec in zip(user_ids, user_cat_vecs):
+                    user = self.user_ids.get(user_id)
+                    if user is None:
+                        continue
+                    values, tots, ns = store.user_values(user)
+                    if values:
+                        user_cat_vec[i] = dict(zip(values, (tots / ns).tolist()))
+        else:
+            def find(coll_name):
+                docs = self.db[coll_name].find({"_id": {"$in": list(user_ids)}})
+                return dict((d.pop("_id"), d) for d in docs)
+            user_ratings = find('user_ratings')
+            user_item_vecs = [user_ratings.get(user_id, {}) for user_id in user_ids]
+            if self.rating_half_life is not None and user_ratings:
+                for d in self.db['rating_times'].find({'u': {"$in": user_ratings.keys()}}):
+                    vec = user_ratings[d['u']]
+                    if d['i'] in vec:
+                        vec[d['i']] *= 0.5 ** ((now - d['t']) / self.rating_half_life)
+            for i in info_used:
+                all_counts = find(self._coll_name(i, 'user'))
+                for user_id, user_cat_vec in zip(user_ids, user_cat_vecs):
+                    counts = all_counts.get(user_id, {})
+                    vec = dict((v, float(c.get('t', 0)) / c['n']) for v, c in counts.items() if c.get('n', 0) > 0)
+                    if vec:
+                        user_cat_vec[i] = vec
+        return user_item_vecs, user_cat_vecs, info_used
+
+    @_reads
     def get_recommendations(self, user_id, max_recs=50, fast=False, algorithm='item_based'):
         """
         algorithm item_based:
@@ -482,157 +1955,433 @@ class Recommender(Singleton):
             are given as score[last recommended]*index[last recommended]/n
             where n is the position in the list.
             - Recommended items above receive a further score according to categories
+        algorithm llr:
+            - As item_based, with the log-likelihood ratio of the co-occurrences instead of
+            their counts, so that popular items do not dominate. Only the llr_neighbors most
+            significant items (and values) are kept for each one (see _llr_matrix)
         :param user_id: the user id as in the mongo collection 'users'
         :param max_recs: number of recommended items to be returned
         :param fast: Compute the co-occurrence matrix only if it is one hour old or
                      if matrix and user vector have different dimension
+                     (irrelevant if incremental: co-occurrence is always up to date)
+        :param algorithm: item_based or llr
         :return: list of recommended items
         """
+        if algorithm not in ('item_based', 'llr'):
+            raise ValueError("Unknown algorithm %s" % algorithm)
         user_id = str(user_id).replace('.', '')
-        df_tot_cat_user = {}
-        df_n_cat_user = {}
-        rec = pd.Series()
-        item_based = False  # has user rated some items?
-        info_based = []  # user has rated the category (e.g. the category "author" etc)
-        df_user = None
-        if not self.db:
-            if self.user_ratings.get(user_id):  # compute item-based rec only if user has rated smt
-                item_based = True
-                #Just take user_id for the user vector
-                df_user = pd.DataFrame(self.user_ratings).fillna(0).astype(int)[[user_id]]
-            info_used = self.info_used
-            if len(info_used) > 0:
-                for i in info_used:
-                    if self.tot_categories_user_ratings[i].get(user_id):
-                        info_based.append(i)
-                        df_tot_cat_user[i] = pd.DataFrame(self.tot_categories_user_ratings[i]).fillna(0).astype(int)[[user_id]]
-                        df_n_cat_user[i] = pd.DataFrame(self.n_categories_user_ratings[i]).fillna(0).astype(int)[[user_id]]
-        else:  # Mongodb
-            # Did the user rate anything?
-            if self.db['user_ratings'].find_one({"_id": user_id}):
-                item_based = True
-                try:
-                    df_user = pd.DataFrame.from_records(list(self.db['item_ratings'].find())).set_index('_id').fillna(0).astype(int)[[user_id]]
-                except:
-                    self.logger.warning("[get_recommendations] item and user ratings colls not synced")
-                    self._sync_user_item_ratings()
-                    df_user = pd.DataFrame.from_records(list(self.db['item_ratings'].find())).set_index('_id').fillna(0).astype(int)[[user_id]]
-            try:
-                info_used = self.db['utils'].find_one({"_id": 1}, {'info_used': 1, "_id": 0}).get('info_used', [])
-            except:
-                info_used = []
-            self.logger.debug("[get_recommendations] info_used: %s", info_used)
-            if len(info_used) > 0:
-                for i in info_used:
-                    item_coll_name = self._coll_name(i, 'item')
-                    user_coll_name = self._coll_name(i, 'user')
-                    if self.db['tot_' + user_coll_name].find_one({"_id": user_id}):
-                        try:
-                            info_based.append(i)
-                            self.logger.debug("[get_recommendations] pd.DataFrame.from_records(list(db['tot_' + '%s'].find())).set_index('_id').fillna(0).astype(int)[['%s']]", item_coll_name, user_id)
-                            df_tot_cat_user[i] = pd.DataFrame.from_records(list(self.db['tot_' + item_coll_name].find())).set_index('_id').fillna(0).astype(int)[[user_id]]
-                            df_n_cat_user[i] = pd.DataFrame.from_records(list(self.db['n_' + item_coll_name].find())).set_index('_id').fillna(0).astype(int)[[user_id]]
-                            self.logger.debug("[get_recommendations]. df_tot_cat_user[%s]:%s\n", i, df_tot_cat_user[i])
-                        except:
-                            self.logger.warning("[get_recommendations. item and user ratings colls not synced for %s", i)
-                            self._sync_user_item_ratings()
-                            info_based.append(i)
-                            self.logger.debug("[get_recommendations] pd.DataFrame.from_records(list(db['tot_' + '%s'].find())).set_index('_id').fillna(0).astype(int)[['%s']]", item_coll_name, user_id)
-                            df_tot_cat_user[i] = pd.DataFrame.from_records(list(self.db['tot_' + item_coll_name].find())).set_index('_id').fillna(0).astype(int)[[user_id]]
-                            df_n_cat_user[i] = pd.DataFrame.from_records(list(self.db['n_' + item_coll_name].find())).set_index('_id').fillna(0).astype(int)[[user_id]]
-                            self.logger.debug("[get_recommendations]. df_tot_cat_user[%s]:%s\n", i, df_tot_cat_user[i])
+        if not self._results_cacheable(fast):
+            return self._recommend(user_id, max_recs, fast, algorithm)
+        version = self._model.updated
+        recs = self._cached_recommendations(user_id, (max_recs, algorithm), version)
+        if recs is None:
+            recs = self._recommend(user_id, max_recs, fast, algorithm)
+            self._cache_recommendations(user_id, (max_recs, algorithm), version, recs)
+        return list(recs)
+
+    def _results_cacheable(self, fast):
+        """
+        :return: True if results of get_recommendations can be cached: the cache is on, and
+                 the model is not rebuilt by the call (fast, or refresher running).
+                 If incremental, scores change with any rating, results are never cached.
+        """
+        return self._results_cache.max_size > 0 and not self.incremental and \
+            (fast or self._refresher is not None or self._follower is not None)
+
+    def _cached_recommendations(self, user_id, key, version):
+        """
+        :param key: (max_recs, algorithm)
+        :param version: version (time of the build) of the current model
+        :return: recommendations cached for user_id, None if not there or computed with another model
+        """
+        with self._results_lock:
+            cached = self._results_cache.get(user_id)
+            if cached is not None and cached[0] == version and key in cached[1]:
+                self._results_hits += 1
+                return cached[1][key]
+            self._results_misses += 1
+
+    def _cache_recommendations(self, user_id, key, version, recs):
+        with self._results_lock:
+            cached = self._results_cache.pop(user_id)
+            if cached is None or cached[0] != version:
+                cached = (version, {})
+            cached[1][key] = recs
+            self._results_cache.put(user_id, cached)
+
+    def _invalidate_results(self, user_ids=None):
+        """
+        Drop the recommendations cached for user_ids, for all users if None.
+        Called by writers, with the lock for writing: results stored after it were scored
+        after the change (readers look up, score and store with the lock for reading)
+        """
+        with self._results_lock:
+            if user_ids is None:
+                self._results_cache.clear()
+            else:
+                for user_id in user_ids:
+                    self._results_cache.pop(user_id)
+
+    def get_cache_info(self):
+        """
+        :return: {'results': {'size': users cached, 'max_size': result_cache_size, 'hits': .., 'misses': ..},
+                  'items': {'size': .., 'max_size': item_cache_size, 'hits': .., 'misses': ..}}
+        """
+        return {'results': {'size': len(self._results_cache), 'max_size': self._results_cache.max_size,
+                            'hits': self._results_hits, 'misses': self._results_misses},
+                'items': {'size': len(self._items_cache), 'max_size': self._items_cache.max_size,
+                          'hits': self._items_cache.hits, 'misses': self._items_cache.misses}}
+
+    def get_metrics(self):
+        """
+        Counters (e.g. cooccurrence.rebuilds, mongo.calls) and histograms of the durations (ms)
+        of the public methods, of the stages of get_recommendations (get_recommendations.scores...),
+        of create_cooccurrence and of each kind of MongoDB call, and of the MongoDB calls per
+        method call (e.g. insert_rating.mongo.calls). To trace one call:
+            with engine.metrics.trace() as events:
+                engine.get_recommendations(user_id)
+        :return: {'counters': {name: n}, 'histograms': {name: {'count': .., 'sum': .., 'max': .., 'buckets': ..}}}
+        """
+        return self.metrics.summary()
+
+    def _recommend(self, user_id, max_recs, fast, algorithm):
+        """
+        See get_recommendations
+        """
+        lap = self.metrics.stages('get_recommendations')
+        # Only the user's history is read: scores are the sum of the co-occurrence
+        # rows of the items (and categories' values) the user has rated
+        user_item_vec, user_cat_vec, info_used = self._get_user_vectors(user_id)
+        lap('user_vectors')
+        self.logger.debug("[get_recommendations] info_used: %s", info_used)
+        item_based = len(user_item_vec) > 0  # has user rated some items?
+        info_based = user_cat_vec.keys()  # user has rated the category (e.g. the category "author" etc)
+        rated = set(item_id for item_id, rating in user_item_vec.items() if rating != 0)
 
         if item_based:
-            try:
-                # this might fail for fast in case a user has rated an item
-                # but the co-occurrence matrix has not been updated
-                # therefore the matrix and the user-vector have different
-                # dimension
-                if not fast or (time() - self.cooccurrence_updated > 1800):
-                    self._create_cooccurrence()
-                self.logger.debug("[get_recommendations] Trying cooccurrence dot df_user")
-                self.logger.debug("[get_recommendations] _items_cooccurrence: %s", self._items_cooccurrence)
-                self.logger.debug("[get_recommendations] df_user: %s", df_user)
-                rec = self._items_cooccurrence.T.dot(df_user[user_id])
-                self.logger.debug("[get_recommendations] Rec: %s", rec)
-            except:
-                self.logger.debug("[get_recommendations] 1st rec production failed, calling _create_cooccurrence.")
-                try:
-                    self._create_cooccurrence()
-                    rec = self._items_cooccurrence.T.dot(df_user[user_id])
-                    self.logger.debug("[get_recommendations] Rec: %s", rec)
-                except:
-                    self.logger.warning("[get_recommendations] user_ and item_ratings seem not synced")
-                    self._sync_user_item_ratings()
-                    self._create_cooccurrence()
-                    rec = self._items_cooccurrence.T.dot(df_user[user_id])
-                    self.logger.debug("[get_recommendations] Rec: %s", rec)
+            if self.incremental and algorithm != 'llr':
+                keys, scores = self._cooccurrence_scores(user_item_vec)
+            else:
+                # with fast, the matrix might not contain items the user has rated
+                # after it was computed: in this case compute it again
+                model = self._model_for(user_item_vec,
+                                        rebuild=not fast or (time() - self.cooccurrence_updated > 1800))
+                keys, scores = self._matrix_scores(user_item_vec, model=model, algorithm=algorithm)
+            self.logger.debug("[get_recommendations] Rec: %s", zip(keys, scores))
+            lap('scores')  # with the rebuild of the co-occurrence, if any
 
             # Add to rec items according to popularity
-            rec.sort(ascending=False)
-
-            if len(rec) < max_recs:
-                self.compute_items_by_popularity(fast=fast)
-                for v in self.items_by_popularity:
-                    if len(rec) == max_recs:
+            n_recs = len([i for i in keys if i not in rated])
+            if n_recs < max_recs:
+                scored = set(keys)
+                fill = []
+                n, last = len(keys), scores.min() if len(keys) > 0 else None
+                for v in self._popularity_ranking():
+                    if n_recs == max_recs:
                         break
-                    elif v not in rec.index:
-                        n = len(rec)
-                        rec.set_value(v, rec.values[n - 1]*n/(n+1.))  # supposing score goes down according to Zipf distribution
+                    elif v not in scored and v not in rated:
+                        # supposing score goes down according to Zipf distribution
+                        # (rec can be empty if the user's items are newer than the matrix, see start_refresher)
+                        last = last*n/(n+1.) if last is not None else self.max_rating
+                        fill.append(last)
+                        keys.append(v)
+                        n += 1
+                        n_recs += 1
+                scores = np.concatenate([scores, fill])
         else:
-            self.compute_items_by_popularity(fast=fast)
-            for i, v in enumerate(self.items_by_popularity):
-                if len(rec) == max_recs:
-                    break
-                rec.set_value(v, self.max_rating / (i+1.))  # As comment above, starting from max_rating
-        self.logger.debug("[get_recommendations] Rec after item_based or not: %s", rec)
+            keys = self._popularity_ranking().top(max_recs)
+            scores = self.max_rating / np.arange(1., len(keys) + 1)  # As comment above, starting from max_rating
+        self.logger.debug("[get_recommendations] Rec after item_based or not: %s", zip(keys, scores))
+        lap('popularity_fill')
 
         # Now, the worse case we have rec=popular with score starting from max_rating
         # and going down as 1/i (this is item_based == False)
 
-        global_rec = rec.copy()
+        total = scores.copy()
         if len(info_used) > 0:
-            cat_rec = {}
             for cat in info_based:
-                user_vec = df_tot_cat_user[cat][user_id] / df_n_cat_user[cat][user_id].replace(0, 1)
-                # print "DEBUG get_recommendations. user_vec:\n", user_vec
-                try:
-                    cat_rec[cat] = self._categories_cooccurrence[cat].T.dot(user_vec)
-                    cat_rec[cat].sort(ascending=False)
-                    #self.logger.debug("[get_recommendations] cat_rec (try):\n %s", cat_rec)
-                except:
-                    self._create_cooccurrence()
-                    cat_rec[cat] = self._categories_cooccurrence[cat].T.dot(user_vec)
-                    cat_rec[cat].sort(ascending=False)
-                    #self.logger.debug("[get_recommendations] cat_rec (except):\n %s", cat_rec)
-                for k, v in rec.iteritems():
-                    #self.logger.debug("[get_recommendations] rec_item_id: %s", k)
-                    try:
-                        if not self.db:
-                            item_info_value = self.items[k][cat]
-                        else:
-                            item_info_value = self.db['items'].find_one({"_id": k}, {"_id": 0, cat: 1}).get(cat)
-                        #self.logger.debug("DEBUG get_recommendations. item value for %s: %s", cat, item_info_value)
-                        # In case the info value is not in cat_rec (as it can obviously happen
-                        # because a rec'd item coming from most popular can have the value of
-                        # an info (author etc) which is not in the rec'd info
-                        if item_info_value:
-                            global_rec[k] = v + cat_rec.get(cat, []).get(item_info_value, 0)
-                    except Exception, e:
-                        self.logger.error("item %s, category %s", k, cat)
-                        logging.exception(e)
-        global_rec.sort(ascending=False)
-        self.logger.debug("[get_recommendations] global_rec:\n %s", global_rec)
+                if self.incremental and algorithm != 'llr':
+                    cat_rec = self._cooccurrence_scores(user_cat_vec[cat], k=cat)
+                else:
+                    model = self._model_for(user_cat_vec[cat], k=cat)
+                    cat_rec = self._matrix_scores(user_cat_vec[cat], k=cat, model=model, algorithm=algorithm)
+                # Items whose values are not in cat_rec (as it can obviously happen
+                # because a rec'd item coming from most popular can have the value of
+                # an info (author etc) which is not in the rec'd info) are not boosted
+                total += self._category_boost(cat, keys, cat_rec)
+        lap('category_boost')
 
-        if item_based:
-            # If the user has rated all items, return an empty list
-            rated = df_user[user_id] != 0
-            self.logger.debug("Rated: %s", rated)
-            return [i for i in global_rec.index if not rated.get(i, False)][:max_recs]
+        # If the user has rated all items, return an empty list.
+        # Equal totals are ranked by score before the boost, as in get_recommendations_batch
+        candidates = np.array([i not in rated for i in keys], dtype=bool)
+        top = _top_k(total, max_recs, candidates, ties=scores)
+        lap('sort')
+        return [keys[n] for n in top]
+
+
+    def _cooccurrence_view(self, k=None, model=None, copy=True):
+        """
+        Co-occurrence matrix (ndarray if dense, csr if sparse) with the labels of
+        its rows/columns, as used to score a block of users at once
+        :param k: None for items, otherwise the category
+        :param model: CooccurrenceModel, the current one if None
+        :param copy: False to get the labels as kept by the model, which can be the live
+                     registry, longer than the matrix (positions must be checked against its shape)
+        :return: matrix, IdRegistry of labels. None, IdRegistry() if there's no matrix
+        """
+        matrix, labels = self._cooccurrence_matrix(k, model)
+        if labels is None or not hasattr(matrix, 'shape') or hasattr(matrix, 'indptr') != self.sparse:
+            return None, IdRegistry()
+        if not copy:
+            return matrix, labels
+        return matrix, IdRegistry(labels.ids(range(matrix.shape[0])))
+
+    def _users_block(self, vecs, labels):
+        """
+        :param vecs: [{item_id: rating}, ...] (or {value: average rating} for categories)
+        :param labels: IdRegistry of the co-occurrence matrix
+        :return: users x labels matrix (csr if sparse, ndarray otherwise)
+        """
+        rows, cols, data = [], [], []
+        for r, vec in enumerate(vecs):
+            for c, rating in zip(labels.indices(vec), vec.values()):
+                if c is not None:
+                    rows.append(r)
+                    cols.append(c)
+                    data.append(rating)
+        if self.sparse:
+            from scipy import sparse
+            return sparse.csr_matrix((data, (rows, cols)), shape=(len(vecs), len(labels)))
+        block = np.zeros((len(vecs), len(labels)))
+        block[rows, cols] = data
+        return block
+
+    def _category_values(self, v):
+        """
+        :param v: value of an item's attribute, e.g. author, or tags (a list)
+        :return: list of values, as keys of the categories' ratings
+        """
+        if v is None:
+            return []
+        values = self._info_values(v)
+        if self.db:
+            values = [str(i) for i in values]
+        return [i for i in values if len(str(i)) > 0]
+
+    def _category_incidence(self, k):
+        """
+        :param k: category
+        :return: IncidenceMatrix of item_id x values of k, for the items which have it (any number
+                 of values, e.g. tags). Read from the items once, then kept up to date by insert_item
+        """
+        if k not in self._items_incidence:
+            from tools.IncidenceMatrix import IncidenceMatrix
+            incidence = IncidenceMatrix()
+            if not self.db:
+                for n, info in enumerate(self.items):
+                    if info.get(k) is not None:
+                        incidence.set_row(self.item_ids[n], self._category_values(info[k]))
+            else:
+                for d in self.db['items'].find({k: {"$exists": True}}, {k: 1}):
+                    incidence.set_row(d["_id"], self._category_values(d[k]))
+            self._items_incidence[k] = incidence
+        return self._items_incidence[k]
+
+    def _category_boost(self, k, item_ids, value_scores):
+        """
+        Boost of items: the sum of the scores of their values of k, with one sparse product
+        :param k: category
+        :param item_ids: items to boost
+        :param value_scores: values, ndarray of their scores
+        :return: ndarray, boost of each item of item_ids (0 if none of its values has a score)
+        """
+        incidence = self._category_incidence(k)
+        boost = np.zeros(len(item_ids))
+        rows = np.array([incidence.rows.get(i, -1) for i in item_ids], dtype=np.int64)
+        known = rows >= 0
+        values, scores = value_scores
+        if known.any() and len(values) > 0:
+            cols = np.array([incidence.cols.get(value, -1) for value in values], dtype=np.int64)
+            weights = np.zeros(len(incidence.cols))
+            weights[cols[cols >= 0]] = scores[cols >= 0]
+            boost[known] = incidence.matrix()[rows[known]].dot(weights)
+        return boost
+
+    def get_recommendations_batch(self, user_ids, max_recs=50, fast=False, algorithm='item_based', chunk_size=100):
+        """
+        As get_recommendations, for many users at once (e.g. nightly e-mail campaigns).
+        The co-occurrence matrix is computed once. Then, for each chunk of users, their
+        ratings are put in a block which is multiplied by the co-occurrence matrix in one go,
+        and category boosting and popularity are applied to the whole block.
+        If incremental (and not llr), the block is multiplied by the rows of the co-occurrence
+        counts of the items in the chunk's histories instead, and nothing is rebuilt.
+        Results are cached as by get_recommendations, and cached ones are not scored again.
+        :param user_ids: iterable of user ids
+        :param max_recs: number of recommended items per user
+        :param fast: as in get_recommendations
+        :param algorithm: as in get_recommendations
+        :param chunk_size: number of users scored together
+        :return: generator of {user_id: [recommended item_ids]}, up to chunk_size users each
+        """
+        if algorithm not in ('item_based', 'llr'):
+            raise ValueError("Unknown algorithm %s" % algorithm)
+        # If incremental, each block is scored by the co-occurrence counts, as in get_recommendations:
+        # the co-occurrence is never rebuilt
+        batch_model = None if self.incremental and algorithm != 'llr' else self._batch_model(fast, algorithm)
+        cacheable = self._results_cacheable(fast)
+        chunk = []
+        for user_id in user_ids:
+            chunk.append(str(user_id).replace('.', ''))
+            if len(chunk) == chunk_size:
+                yield self._recommend_chunk(chunk, max_recs, algorithm, batch_model, cacheable)
+                chunk = []
+        if chunk:
+            yield self._recommend_chunk(chunk, max_recs, algorithm, batch_model, cacheable)
+
+    def _recommend_chunk(self, user_ids, max_recs, algorithm, batch_model, cacheable):
+        """
+        _recommend_block for the users whose results are not in the cache (see get_recommendations).
+        Cached results are looked up, scored and stored holding the lock for reading, so that
+        no rating changes them in between, and keyed by the model they are scored with
+        :param cacheable: see _results_cacheable
+        :return: {user_id: [recommended item_ids]}
+        """
+        if not cacheable:
+            return self._recommend_block(user_ids, max_recs, batch_model)
+        version, key = batch_model[3], (max_recs, algorithm)
+        result, missing = {}, []
+        with self._lock.read():
+            for user_id in user_ids:
+                recs = self._cached_recommendations(user_id, key, version)
+                if recs is None:
+                    missing.append(user_id)
+                else:
+                    result[user_id] = list(recs)
+            if missing:
+                scored = self._recommend_block(missing, max_recs, batch_model)
+                for user_id, recs in scored.items():
+                    self._cache_recommendations(user_id, key, version, recs)
+                    result[user_id] = list(recs)
+        return result
+
+    @_reads
+    def _batch_model(self, fast, algorithm='item_based'):
+        """
+        See get_recommendations_batch
+        :return: item co-occurrence (or LLR), its labels, {cat: (matrix, labels, items x labels incidence,
+                 IdRegistry of the rows of the incidence, row of the incidence by item row)},
+                 version of the model (time of its build)
+        """
+        model = self._model_for(rebuild=not fast or (time() - self.cooccurrence_updated > 1800))
+        self.compute_items_by_popularity(fast=fast)
+
+        def view(k=None):
+            if algorithm != 'llr':
+                return self._cooccurrence_view(k, model)
+            matrix, labels = self._llr_matrix(k, model)
+            if matrix is not None and not self.sparse:  # blocks of users are dense
+                matrix = matrix.toarray()
+            return matrix, labels
+        item_matrix, item_labels = view()
+        categories = {}  # {cat: (matrix, labels, incidence, its rows, its row by item row)}
+        for cat in self._get_info_used():
+            cat_matrix, cat_labels = view(cat)
+            if cat_matrix is None:
+                continue
+            categories[cat] = (cat_matrix, cat_labels) + self._batch_incidence(cat, cat_labels, item_labels)
+        return item_matrix, item_labels, categories, model.updated
+
+    def _batch_incidence(self, k, labels, item_labels):
+        """
+        See get_recommendations_batch
+        :param k: category
+        :param labels: IdRegistry of the values scored
+        :param item_labels: IdRegistry of the items scored
+        :return: items x labels incidence, IdRegistry of its rows, its row by item of item_labels
+        """
+        incidence = self._category_incidence(k)
+        item_rows = np.array([incidence.rows.get(item_id, -1) for item_id in item_labels], dtype=np.int64)
+        return incidence.matrix(columns=labels), incidence.rows, item_rows
+
+    @_reads
+    def _recommend_block(self, user_ids, max_recs, batch_model=None):
+        """
+        See get_recommendations_batch
+        :param batch_model: see _batch_model, None to score by the co-occurrence counts (incremental)
+        :return: {user_id: [recommended item_ids]}
+        """
+        user_item_vecs, user_cat_vecs, _ = self._get_users_vectors(user_ids)
+        cat_scores = {}
+        if batch_model is None:
+            scores, item_labels = self._counts_scores(user_item_vecs)
+            categories = {}
+            for cat in self._get_info_used():
+                cat_scores[cat], cat_labels = self._counts_scores([v.get(cat, {}) for v in user_cat_vecs], k=cat)
+                categories[cat] = (None, cat_labels) + self._batch_incidence(cat, cat_labels, item_labels)
         else:
-            return list(global_rec.index)[:max_recs]
+            item_matrix, item_labels, categories, _ = batch_model
+            scores = None
+            if item_matrix is not None:
+                scores = self._users_block(user_item_vecs, item_labels).dot(item_matrix)
+                if self.sparse:
+                    scores.sort_indices()  # items in label order, as in get_recommendations (for ties)
+            for cat, (cat_matrix, cat_labels, _, _, _) in categories.items():
+                cat_block = self._users_block([v.get(cat, {}) for v in user_cat_vecs], cat_labels)
+                cat_scores[cat] = cat_block.dot(cat_matrix)
+                if self.sparse:
+                    cat_scores[cat] = cat_scores[cat].toarray()
+
+        result = {}
+        for r, user_id in enumerate(user_ids):
+            rated = set(item_id for item_id, rating in user_item_vecs[r].items() if rating != 0)
+            if user_item_vecs[r]:
+                if scores is None:
+                    rows = np.empty(0, dtype=np.int64)
+                    rec_scores = np.empty(0)
+                elif hasattr(scores, 'getrow'):
+                    row = scores.getrow(r)
+                    rows, rec_scores = row.indices, row.data
+                else:
+                    rows = np.flatnonzero(scores[r])
+                    rec_scores = scores[r][rows]
+                rec_items = item_labels.ids(rows)
+                # Add to rec items according to popularity, as in get_recommendations
+                in_rec = set(rec_items)
+                n_recs = len([i for i in rec_items if i not in rated])
+                fill = []
+                n, last = len(rec_items), rec_scores.min() if len(rec_items) > 0 else None
+                for v in self._popularity_ranking():
+                    if n_recs >= max_recs:
+                        break
+                    elif v not in in_rec and v not in rated:
+                        last = last*n/(n+1.) if last is not None else self.max_rating
+                        fill.append(last)
+                        rec_items.append(v)
+                        n += 1
+                        n_recs += 1
+                rec_scores = np.concatenate([rec_scores, fill])
+            else:
+                rows = np.empty(0, dtype=np.int64)
+                rec_items = self._popularity_ranking().top(max_recs)
+                rec_scores = self.max_rating / np.arange(1., len(rec_items) + 1)
+            base_scores = rec_scores.astype(np.float64)
+            rec_scores = base_scores.copy()
+
+            # categories: boost of each item is the sum of the scores of its values
+            for cat, (_, _, incidence, incidence_rows, item_rows) in categories.items():
+                if cat not in user_cat_vecs[r]:
+                    continue
+                positions = np.concatenate([item_rows[rows],
+                                            [incidence_rows.get(i, -1) for i in rec_items[len(rows):]]]).astype(np.int64)
+                boosted = positions >= 0
+                if boosted.any():
+                    rec_scores[boosted] += incidence[positions[boosted]].dot(cat_scores[cat][r])
 
+            candidates = np.array([i not in rated for i in rec_items], dtype=bool)
+            result[user_id] = [rec_items[n] for n in _top_k(rec_scores, max_recs, candidates, ties=base_scores)]
+        return result
 
+    @_reads
     def get_user_info(self, user_id):
         """
         Return user's rated items: {'item1': 3, 'item3': 1...}
@@ -643,9 +2392,14 @@ class Recommender(Singleton):
             r = self.db['user_ratings'].find_one({"_id": user_id}, {"_id": 0})
             return r if r else {}
         else:
-            return self.user_ratings[user_id]
+            user = self.user_ids.get(user_id)
+            if user is None:
+                return {}
+            items, ratings = self.ratings.user_items(user)
+            return dict(zip(self.item_ids.ids(items), ratings.tolist()))
 
 
+    @_reads
     def get_items(self, n=10):
         """
         Return n items
@@ -663,19 +2417,166 @@ class Recommender(Singleton):
 
         else:
             result = []
-            for k in self.items.keys():
-                result.append(self.items[k])
+            for item in self.items:
+                result.append(item)
                 if len(result) > n:
                     break
             return result
 
 
+    def _counts_triplets(self, k=None):
+        """
+        Incremental co-occurrence counts as arrays (inmemory testing)
+        :return: keys, rows, cols, counts
+        """
+        counts = self._items_cooccurrence_counts if k is None else self._categories_cooccurrence_counts[k]
+        keys = IdRegistry()
+        rows, cols, n_users = [], [], []
+        for key, row in counts.items():
+            for other, n in row.items():
+                rows.append(keys.intern(key))
+                cols.append(keys.intern(other))
+                n_users.append(n)
+        return keys.ids(), np.array(rows, dtype=np.int32), np.array(cols, dtype=np.int32), \
+            np.array(n_users, dtype=np.int32)
+
+    @_reads
+    def save_snapshot(self, path):
+        """
+        Save the model in the directory path: arrays (ids, ratings, co-occurrence matrices,
+        labels, popularity) as .npy files, which load_snapshot memory-maps, and the rest
+        (items' documents, categories' information) in one pickle.
+        With MongoDB only what is computed from the db is saved (co-occurrence, popularity).
+        :param path: directory, created if not there
+        :return: None
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        state = {'version': 2, 'created': time(), 'in_memory': not self.db,
+                 'cooccurrence_updated': self.cooccurrence_updated, 'matrices': {}, 'counts': {}}
+        state['n_users'] = self._model.n_users
+        model = self._model
+        for k in [None] + list(model.categories):
+            matrix, labels = self._cooccurrence_view(k, model)
+            if matrix is not None:
+                description = Snapshot.save_matrix(path, self._cooccurrence_coll_name(k), matrix)
+                state['matrices'][k] = (description, Snapshot.save_ids(path, description['name'] + '.labels',
+                                                                       labels.ids()))
+        if self._popularity is not None:
+            top = self._popularity.top()
+            state['popularity'] = Snapshot.save_ids(path, 'popularity.ids', top)
+            Snapshot.save_array(path, 'popularity', np.array([self._popularity.score(i) for i in top]))
+        if not self.db:
+            state['user_ids'] = Snapshot.save_ids(path, 'user_ids', self.user_ids.ids())
+            state['item_ids'] = Snapshot.save_ids(path, 'item_ids', self.item_ids.ids())
+            state['items'] = self.items
+            state['info_used'] = self.info_used
+            state['category_stores'] = {}
+            for n, (cat, store) in enumerate(self.categories.items()):
+                name = 'categories.%d' % n
+                for part, array in zip(('users', 'values', 'tot', 'n'), store.entries()):
+                    Snapshot.save_array(path, name + '.' + part, array)
+                state['category_stores'][cat] = (name, store.values.ids())
+            for name, array in zip(('ratings.users', 'ratings.items', 'ratings.values'), self.ratings.triplets()):
+                Snapshot.save_array(path, name, array)
+            Snapshot.save_array(path, 'ratings.times', self.ratings.times())
+            state['ratings_times'] = True
+            if self.incremental:
+                for k in [None] + list(self._categories_cooccurrence_counts):
+                    keys, rows, cols, n_users = self._counts_triplets(k)
+                    name = self._cooccurrence_coll_name(k) + '.counts'
+                    for part, array in (('rows', rows), ('cols', cols), ('n', n_users)):
+                        Snapshot.save_array(path, name + '.' + part, array)
+                    state['counts'][k] = (name, keys)
+        Snapshot.save_objects(path, state)
+        self.logger.debug("[save_snapshot] Snapshot saved in %s", path)
+
+    @_writes
+    def load_snapshot(self, path):
+        """
+        Replace the model with the one saved by save_snapshot. Arrays are memory-mapped
+        copy-on-write: loading is immediate, and processes loading the same snapshot
+        share its pages until they change them.
+        :param path: directory written by save_snapshot
+        :return: None
+        """
+        self.flush()
+        state = Snapshot.load_objects(path)
+        if state['in_memory'] != (not self.db):
+            raise ValueError("Snapshot %s was saved by a%s Recommender"
+                             % (path, "n in-memory" if state['in_memory'] else " MongoDB"))
+        self._items_cache.clear()
+        self._items_incidence = {}
+        self._invalidate_results()
+        self._neighbors_cache.clear()
+        model = CooccurrenceModel(updated=state['cooccurrence_updated'], n_ratings=self._n_ratings,
+                                  n_users=state.get('n_users'))
+        for k, (description, labels) in state['matrices'].items():
+            matrix = Snapshot.load_matrix(path, description)
+            if self.sparse and not hasattr(matrix, 'indptr'):
+                from scipy import sparse
+                matrix = sparse.csr_matrix(matrix)
+            elif not self.sparse and hasattr(matrix, 'indptr'):
+                matrix = matrix.toarray()
+            labels = Snapshot.load_ids(path, labels)
+            if k is None:
+                model.items, model.items_labels = matrix, labels
+            else:
+                model.categories[k], model.categories_labels[k] = matrix, labels
+        self._model = model
+        self._popularity = None
+        if 'popularity' in state:
+            self._popularity = PopularityRanking.from_saved(Snapshot.load_ids(path, state['popularity']),
+                                                            Snapshot.load_array(path, 'popularity'))
+        if not self.db:
+            self.user_ids = Snapshot.load_ids(path, state['user_ids'])
+            self.item_ids = Snapshot.load_ids(path, state['item_ids'])
+            self.items = state['items']
+            self.info_used = state['info_used']
+            self.categories = {}
+            for cat, (name, values) in state.get('category_stores', {}).items():
+                self.categories[cat] = CategoryStore.from_entries(
+                    values, *[Snapshot.load_array(path, name + '.' + part) for part in ('users', 'values', 'tot', 'n')])
+            if 'categories' in state:  # saved as nested dicts, before the category stores
+                for cat, tots in state['categories']['tot_categories_user_ratings'].items():
+                    store = self._category_store(cat)
+                    for user_id, values in tots.items():
+                        user = self.user_ids.intern(user_id)
+                        for value, tot in values.items():
+                            n = state['categories']['n_categories_user_ratings'][cat][user_id].get(value, 0)
+                            if n > 0:
+                                store.set(user, value, tot, n)
+            users, items, values = [Snapshot.load_array(path, name) for name in
+                                    ('ratings.users', 'ratings.items', 'ratings.values')]
+            if state.get('ratings_times'):
+                times = Snapshot.load_array(path, 'ratings.times')
+            else:  # saved before ratings had times
+                times = np.repeat(state['created'], len(users))
+            self.ratings = RatingStore.from_triplets(users, items, values, times,
+                                                     expiring=self._retention() is not None)
+            self._items_cooccurrence_counts = defaultdict(lambda: defaultdict(int))
+            self._categories_cooccurrence_counts = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+            for k, (name, keys) in state['counts'].items():
+                counts = self._items_cooccurrence_counts if k is None else self._categories_cooccurrence_counts[k]
+                rows, cols, n_users = [Snapshot.load_array(path, name + '.' + part).tolist()
+                                       for part in ('rows', 'cols', 'n')]
+                for r, c, n in zip(rows, cols, n_users):
+                    counts[keys[r]][keys[c]] = n
+        self.logger.debug("[load_snapshot] Snapshot loaded from %s", path)
+
+    @_writes
     def drop_db(self):
         """
         Drop the whole db, unsafe!
         Return list of collections
         :return:
         """
+        self._pending_ratings = []
+        self._items_cache.clear()
+        self._items_incidence = {}
+        self._invalidate_results()
+        self._neighbors_cache.clear()
+        self._popularity = None
         if self.db:
             self.mongo_client.drop_database(self.mongo_db_name)
             return self.db.collection_names()
@@ -0,0 +1,82 @@
+from collections import OrderedDict
+
+
+class UpdateBuffer(object):
+    """
+    Coalesce MongoDB upserts by (collection, _id) in memory: $inc on the same
+    field are summed, $set and $unset keep the last value (dropping the updates of
+    its subfields, e.g. author.n), $addToSet are merged.
+    flush() writes them with one ordered bulk operation per collection.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._updates = OrderedDict()  # {(collection, _id): {"$inc": {}, "$set": {}, ...}}
+        self._parents = {}  # {(collection, _id): fields with updates of their subfields}
+        self.n_operations = 0  # updates received since the last flush
+
+    def _update(self, coll, _id):
+        self.n_operations += 1
+        key = (coll, _id)
+        if key not in self._updates:
+            self._updates[key] = {}
+        return self._updates[key]
+
+    def inc(self, coll, _id, field, value):
+        update = self._update(coll, _id)
+        if "." in field:
+            self._parents.setdefault((coll, _id), set()).add(field.split(".", 1)[0])
+        if field in update.get("$set", {}):
+            update["$set"][field] += value
+        else:
+            inc = update.setdefault("$inc", {})
+            inc[field] = inc.get(field, 0) + value
+
+    def _replace(self, coll, _id, field):
+        # drop the updates of field, and of its subfields if any
+        update = self._update(coll, _id)
+        for op in ("$inc", "$set", "$unset"):
+            update.get(op, {}).pop(field, None)
+        if field in self._parents.get((coll, _id), ()):
+            for op in ("$inc", "$set", "$unset"):
+                fields = update.get(op, {})
+                for f in [f for f in fields if f.startswith(field + ".")]:
+                    fields.pop(f)
+        return update
+
+    def set(self, coll, _id, field, value):
+        update = self._replace(coll, _id, field)
+        update.setdefault("$set", {})[field] = value
+
+    def unset(self, coll, _id, field):
+        update = self._replace(coll, _id, field)
+        update.setdefault("$unset", {})[field] = ""
+
+    def add_to_set(self, coll, _id, field, value):
+        update = self._update(coll, _id)
+        values = update.setdefault("$addToSet", {}).setdefault(field, {"$each": []})["$each"]
+        if value not in values:
+            values.append(value)
+
+    def flush(self):
+        """
+        Write all the coalesced updates
+        :return: number of documents updated
+        """
+        by_coll = OrderedDict()
+        for (coll, _id), update in self._updates.items():
+            update = dict((op, fields) for op, fields in update.items() if fields)
+            if update:
+                by_coll.setdefault(coll, []).append((_id, update))
+        for coll, updates in by_coll.items():
+            bulk = self.db[coll].initialize_ordered_bulk_op()
+            for _id, update in updates:
+                bulk.find({"_id": _id}).upsert().update_one(update)
+            bulk.execute()
+        n_docs = len(self._updates)
+        self._updates = OrderedDict()
+        self._parents = {}
+        self.n_operations = 0
+        return n_docs
+
+    def __len__(self):
+        return len(self._updates)
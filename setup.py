@@ -5,8 +5,14 @@ setup(name='cold-start-recommender',
       author='Mario Alemi',
       author_email='mario.alemi@gmail.com',
       version='0.3.15',
-      py_modules=['csrec.Recommender', 'tools.Singleton'],
+      py_modules=['csrec.Recommender', 'csrec.RatingStore', 'csrec.CategoryStore', 'csrec.UpdateBuffer',
+                  'csrec.CooccurrenceModel',
+                  'tools.Singleton', 'tools.SparseMatrix', 'tools.IdRegistry', 'tools.Streams',
+                  'tools.LRUCache', 'tools.PopularityRanking', 'tools.Snapshot',
+                  'tools.RWLock', 'tools.Metrics', 'tools.Functions', 'tools.NeighborIndex',
+                  'tools.IncidenceMatrix'],
       url='https://github.com/elegans-io/cold-start-recommender',
       license='LICENSE.txt',
-      scripts=['bin/recommender_api.py'],
+      scripts=['bin/recommender_api.py', 'bin/recommender_async_api.py',
+               'bin/recommender_workers.py'],
       )
@@ -0,0 +1,119 @@
+"""
+Stress test of the Recommender shared by many threads, as in recommender_api.py:
+reader threads ask for recommendations while writer threads insert and remove
+ratings and the refresher rebuilds the co-occurrence in the background.
+
+Each writer owns a set of users, so at the end the ratings of each user
+must be exactly the ones its writer left. No exception must be raised or
+logged meanwhile.
+
+Usage:
+python stress-test.py [--seconds 10] [--readers 8] [--writers 2] [--incremental] [--sparse]
+                      [--result_cache_size 1000]
+                      [--mongo_host localhost:27017 --mongo_db_name csrec_stress]
+"""
+import argparse
+import logging
+import random
+import threading
+import time
+import traceback
+from csrec.Recommender import Recommender
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--seconds', type=float, default=10)
+parser.add_argument('--readers', type=int, default=8)
+parser.add_argument('--writers', type=int, default=2)
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--sparse', action='store_true')
+parser.add_argument('--result_cache_size', type=int, default=0)
+parser.add_argument('--mongo_host', default=None)
+parser.add_argument('--mongo_db_name', default='csrec_stress')
+args = parser.parse_args()
+
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.n = 0
+
+    def emit(self, record):
+        self.n += 1
+
+logged = ErrorCounter()
+logging.getLogger().addHandler(logged)
+
+engine = Recommender(mongo_host=args.mongo_host, mongo_db_name=args.mongo_db_name,
+                     incremental=args.incremental, sparse=args.sparse,
+                     result_cache_size=args.result_cache_size, log_level=logging.ERROR)
+engine.drop_db()
+
+n_books = 300
+authors = ['A' + str(i) for i in range(20)]
+publishers = ['P' + str(i) for i in range(5)]
+books = ['b' + str(b) for b in range(n_books)]
+for book in books:
+    engine.insert_item({'uid': book, 'author': random.choice(authors), 'publisher': random.choice(publishers)},
+                       _id='uid')
+
+users = [['w%d_u%d' % (w, u) for u in range(50)] for w in range(args.writers)]
+expected = [dict((u, {}) for u in writer_users) for writer_users in users]  # ratings left by each writer
+errors = []
+stop = threading.Event()
+counts = {'reads': 0, 'writes': 0}
+
+
+def writer(w):
+    rnd = random.Random(w)
+    try:
+        while not stop.is_set():
+            user = rnd.choice(users[w])
+            book = books[min(int(rnd.paretovariate(1.2)) - 1, n_books - 1)]
+            if expected[w][user] and rnd.random() < 0.2:
+                book = rnd.choice(list(expected[w][user]))
+                engine.remove_rating(user, book)
+                expected[w][user].pop(book)
+            else:
+                rating = rnd.randrange(1, 6)
+                engine.insert_rating(user, book, rating, item_info=['author', 'publisher'])
+                expected[w][user][book] = float(rating)
+            counts['writes'] += 1
+    except Exception:
+        errors.append(traceback.format_exc())
+
+
+def reader(r):
+    rnd = random.Random(1000 + r)
+    try:
+        while not stop.is_set():
+            w = rnd.randrange(args.writers)
+            if rnd.random() < 0.1:
+                for chunk in engine.get_recommendations_batch(rnd.sample(users[w], 10), max_recs=10, fast=True):
+                    pass
+            else:
+                engine.get_recommendations(rnd.choice(users[w]), max_recs=10, fast=rnd.random() < 0.5)
+            counts['reads'] += 1
+    except Exception:
+        errors.append(traceback.format_exc())
+
+engine.start_refresher(interval=0.5, n_ratings=200)
+threads = [threading.Thread(target=writer, args=(w,)) for w in range(args.writers)] + \
+          [threading.Thread(target=reader, args=(r,)) for r in range(args.readers)]
+for t in threads:
+    t.start()
+time.sleep(args.seconds)
+stop.set()
+for t in threads:
+    t.join()
+engine.stop_refresher()
+
+print "reads: %(reads)s, writes: %(writes)s" % counts
+print "model:", engine.get_model_info()
+for e in errors:
+    print e
+wrong = [u for w in range(args.writers) for u in users[w] if engine.get_user_info(u) != expected[w][u]]
+print "exceptions: %s, errors logged: %s, users with wrong ratings: %s" % (len(errors), logged.n, len(wrong))
+if args.incremental:
+    print "co-occurrence counts consistent:", engine.check_cooccurrence()
+assert not errors and not logged.n and not wrong
+print "OK"
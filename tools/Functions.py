@@ -2,6 +2,7 @@ __author__ = "Angelo Leto"
 __email__ = "angleto@gmail.com"
 
 import math
+import numpy as np
 
 def ShannonEntropy(pArray):
     """
@@ -33,3 +34,22 @@ def LogLikelihoodRatio(pKTable):
     return v
 
 
+def _XLogX(pX):
+    pX = np.asarray(pX, dtype=np.float64)
+    return pX * np.log(np.where(pX > 0, pX, 1))
+
+
+def LogLikelihoodRatios(pK11, pK12, pK21, pK22):
+    """
+    LogLikelihoodRatio of many 2x2 tables at once
+
+    :param pK11: array, for each table the count of A and B together
+    :param pK12: array, A without B
+    :param pK21: array, B without A
+    :param pK22: array, neither A nor B
+    :return: array of the log likelihood ratios
+    """
+    pK11, pK12, pK21, pK22 = [np.asarray(k, dtype=np.float64) for k in (pK11, pK12, pK21, pK22)]
+    v = 2 * (_XLogX(pK11) + _XLogX(pK12) + _XLogX(pK21) + _XLogX(pK22) + _XLogX(pK11 + pK12 + pK21 + pK22)
+             - _XLogX(pK11 + pK12) - _XLogX(pK21 + pK22) - _XLogX(pK11 + pK21) - _XLogX(pK12 + pK22))
+    return np.maximum(v, 0)  # not negative, but for rounding
@@ -0,0 +1,136 @@
+import numpy as np
+
+
+class IdRegistry(object):
+    """
+    Map external ids (user_id, item_id...) to dense integer indices 0, 1, 2...
+    and back. Indices are never reused, so arrays indexed by them stay aligned.
+
+    Behaves like a list (registry[index] -> external id) and, through get,
+    like a dict (registry.get(external id) -> index).
+    """
+    def __init__(self, ids=None):
+        self._ids = []  # external id of each index
+        self._index = {}  # {external id: index}
+        if ids is not None:
+            for external_id in ids:
+                self.intern(external_id)
+
+    def intern(self, external_id):
+        """
+        :param external_id:
+        :return: index of external_id, which is added if not yet there
+        """
+        index = self._index.get(external_id)
+        if index is None:
+            index = len(self._ids)
+            self._index[external_id] = index
+            self._ids.append(external_id)
+        return index
+
+    def get(self, external_id, default=None):
+        """
+        :param external_id:
+        :return: index of external_id, default if not there
+        """
+        return self._index.get(external_id, default)
+
+    def indices(self, external_ids):
+        """
+        :param external_ids: iterable of external ids
+        :return: list of their indices, None for the ones not there
+        """
+        return [self._index.get(external_id) for external_id in external_ids]
+
+    def ids(self, indices=None):
+        """
+        :param indices: iterable of indices, None for all
+        :return: list of external ids
+        """
+        if indices is None:
+            return list(self._ids)
+        return [self._ids[i] for i in indices]
+
+    def __getitem__(self, index):
+        return self._ids[index]
+
+    def __contains__(self, external_id):
+        return external_id in self._index
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class MappedIdRegistry(IdRegistry):
+    """
+    IdRegistry whose first ids are an array (e.g. memory-mapped from a snapshot, see
+    tools.Snapshot.load_ids), so that processes mapping it share its pages: they are
+    found by binary search in their sorted order instead of a dict. Ids interned
+    later are kept as by IdRegistry, after them.
+    """
+    def __init__(self, ids, order):
+        """
+        :param ids: array of external ids (str or unicode), by index
+        :param order: array of the indices which sort ids
+        """
+        IdRegistry.__init__(self)
+        self._mapped = ids
+        self._order = order
+
+    def intern(self, external_id):
+        index = self.get(external_id)
+        if index is None:
+            index = len(self)
+            self._index[external_id] = index
+            self._ids.append(external_id)
+        return index
+
+    def get(self, external_id, default=None):
+        try:
+            position = np.searchsorted(self._mapped, external_id, sorter=self._order)
+        except (TypeError, ValueError, UnicodeError):  # not comparable with the ids, e.g. a number
+            position = len(self._order)
+        if position < len(self._order):
+            index = self._order[position]
+            if self._mapped[index] == external_id:
+                return int(index)
+        return self._index.get(external_id, default)
+
+    def indices(self, external_ids):
+        external_ids = list(external_ids)
+        if not external_ids:
+            return []
+        try:  # one search for all of them
+            positions = np.searchsorted(self._mapped, external_ids, sorter=self._order)
+        except (TypeError, ValueError, UnicodeError):
+            return [self.get(external_id) for external_id in external_ids]
+        found = self._order[np.minimum(positions, len(self._order) - 1)]
+        return [index if mapped == external_id else self._index.get(external_id)
+                for external_id, index, mapped in zip(external_ids, found.tolist(), self._mapped[found].tolist())]
+
+    def ids(self, indices=None):
+        if indices is None:
+            return self._mapped.tolist() + self._ids
+        indices = np.asarray(indices if hasattr(indices, '__len__') else list(indices), dtype=np.int64)
+        if not len(indices) or indices.max() < len(self._mapped):
+            return self._mapped[indices].tolist()
+        return [self[i] for i in indices.tolist()]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < len(self._mapped):
+            return self._mapped[index].item()
+        return self._ids[index - len(self._mapped)]
+
+    def __contains__(self, external_id):
+        return self.get(external_id) is not None
+
+    def __iter__(self):
+        return iter(self.ids())
+
+    def __len__(self):
+        return len(self._mapped) + len(self._ids)
@@ -0,0 +1,86 @@
+from array import array
+import threading
+import numpy as np
+from scipy import sparse
+from tools.IdRegistry import IdRegistry
+
+
+class IncidenceMatrix(object):
+    """
+    0/1 (rows x columns) sparse matrix, e.g. items x values of a category (1 if the item
+    has the value, more than one per item for attributes such as tags), changed a row at
+    a time. Entries are kept in growable typed arrays, the csr matrix is built from them
+    when first needed after a change.
+    Many threads can call matrix() at once (e.g. readers of the Recommender): the build is
+    guarded by a lock. set_row must not run meanwhile (e.g. it is called by writers).
+    """
+    def __init__(self):
+        self.rows = IdRegistry()  # e.g. item_id of each row
+        self.cols = IdRegistry()  # e.g. value of each column
+        self._rows = array('i')
+        self._cols = array('i')
+        self._live = array('b')  # 0 for entries replaced by set_row
+        self._positions = {}  # {row: [positions of its entries in the arrays]}
+        self._n_replaced = 0
+        self._csr = None
+        self._csr_lock = threading.Lock()  # one thread builds the csr matrix (and compacts)
+
+    def set_row(self, row_id, col_ids):
+        """
+        Replace the columns of row_id (e.g. the values of an item)
+        :param row_id: e.g. item_id
+        :param col_ids: iterable of column ids, e.g. values
+        """
+        r = self.rows.intern(row_id)
+        for p in self._positions.pop(r, ()):
+            self._live[p] = 0
+            self._n_replaced += 1
+        cols = sorted(set(self.cols.intern(c) for c in col_ids))
+        self._positions[r] = range(len(self._rows), len(self._rows) + len(cols))
+        self._rows.extend([r] * len(cols))
+        self._cols.extend(cols)
+        self._live.extend([1] * len(cols))
+        self._csr = None
+
+    def _compact(self):
+        rows, cols = array('i'), array('i')
+        for r in sorted(self._positions):
+            positions = self._positions[r]
+            self._positions[r] = range(len(rows), len(rows) + len(positions))
+            rows.extend([r] * len(positions))
+            cols.extend(self._cols[p] for p in positions)
+        self._rows, self._cols, self._live = rows, cols, array('b', [1] * len(rows))
+        self._n_replaced = 0
+
+    def matrix(self, columns=None):
+        """
+        :param columns: IdRegistry: if given, the matrix has its columns instead (e.g. the
+                        labels of a co-occurrence matrix), and the others are dropped
+        :return: (rows x columns) csr matrix of float64
+        """
+        csr = self._csr
+        if csr is None:
+            with self._csr_lock:
+                if self._csr is None:
+                    if self._n_replaced > len(self._rows) // 2:
+                        self._compact()
+                    live = np.array(self._live, dtype=bool)
+                    rows = np.array(self._rows, dtype=np.int32)[live]
+                    cols = np.array(self._cols, dtype=np.int32)[live]
+                    self._csr = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                                                  shape=(len(self.rows), len(self.cols)))
+                csr = self._csr
+        if columns is None:
+            return csr
+        positions = np.array([columns.get(c, -1) for c in self.cols], dtype=np.int64)
+        coo = csr.tocoo()
+        if len(positions):
+            cols = positions[coo.col]
+        else:
+            cols = np.empty(0, dtype=np.int64)
+        kept = cols >= 0
+        return sparse.csr_matrix((coo.data[kept], (coo.row[kept], cols[kept])),
+                                 shape=(len(self.rows), len(columns)))
+
+    def __len__(self):
+        return len(self.rows)
@@ -0,0 +1,43 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    dict-like cache holding at most max_size keys: when full, the least
+    recently used key (read or written) is evicted.
+    """
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._data = OrderedDict()  # least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """
+        :return: value of key, default if not cached
+        """
+        if key not in self._data:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value = self._data.pop(key)
+        self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
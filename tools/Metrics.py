@@ -0,0 +1,193 @@
+import bisect
+import threading
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+# Upper bounds (ms) of the buckets of the histograms of durations
+BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.
+        self.max = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def as_dict(self):
+        """
+        :return: {'count': .., 'sum': .., 'max': .., 'buckets': [[upper bound, cumulative count], ...]}
+        """
+        cumulative, buckets = 0, []
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            buckets.append([bound if bound != float('inf') else '+Inf', cumulative])
+        return {'count': self.count, 'sum': self.sum, 'max': self.max, 'buckets': buckets}
+
+
+class Metrics(object):
+    """
+    Counters, and histograms of durations (ms) or other values, shared by all threads.
+    A thread can also trace what it does, e.g. for one request (see trace).
+    If not enabled, nothing is recorded.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._local = threading.local()  # per thread: counts, events of the trace
+
+    def _thread(self):
+        if not hasattr(self._local, 'counts'):
+            self._local.counts = {}
+            self._local.events = None
+            self._local.start = 0.
+        return self._local
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        local = self._thread()
+        local.counts[name] = local.counts.get(name, 0) + n
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        if not self.enabled:
+            return
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram()
+            self._histograms[name].observe(value)
+
+    @contextmanager
+    def timer(self, name, per_call=None):
+        """
+        Observe the duration (ms) of the block as name, and add it to the trace if tracing
+        :param per_call: counter (e.g. 'mongo.calls'): its increments during the block are
+                         observed as name.per_call
+        """
+        if not self.enabled:
+            yield
+            return
+        local = self._thread()
+        counted = local.counts.get(per_call, 0) if per_call else 0
+        start = timer()
+        try:
+            yield
+        finally:
+            self._record(name, start, timer())
+            if per_call:
+                self.observe(name + '.' + per_call, local.counts.get(per_call, 0) - counted)
+
+    def stages(self, prefix):
+        """
+        Time consecutive stages of a computation, without nesting timers, e.g.:
+            lap = metrics.stages('get_recommendations')
+            ...
+            lap('user_vectors')  # time since stages was called
+            ...
+            lap('scores')  # time since the previous lap
+        :return: function lap(stage), observing the time since the previous lap as prefix.stage
+        """
+        last = [timer()]
+
+        def lap(stage):
+            if self.enabled:
+                now = timer()
+                self._record(prefix + '.' + stage, last[0], now)
+                last[0] = now
+        return lap
+
+    def _record(self, name, start, end):
+        ms = 1000 * (end - start)
+        self.observe(name, ms)
+        local = self._thread()
+        if local.events is not None:
+            local.events.append({'stage': name, 'start_ms': 1000 * (start - local.start), 'ms': ms})
+
+    @contextmanager
+    def trace(self):
+        """
+        Record the timers of the current thread during the block, e.g.:
+            with metrics.trace() as events:
+                ...
+        events is then [{'stage': name, 'start_ms': .., 'ms': ..}, ...], in order of completion
+        """
+        local = self._thread()
+        previous = local.events, local.start
+        local.events, local.start = [], timer()
+        try:
+            yield local.events
+        finally:
+            local.events, local.start = previous
+
+    def summary(self):
+        """
+        :return: {'counters': {name: n}, 'histograms': {name: histogram (see Histogram.as_dict)}}
+        """
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'histograms': dict((name, h.as_dict()) for name, h in self._histograms.items())}
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+
+
+class InstrumentedDatabase(object):
+    """
+    pymongo Database whose collections count (as mongo.calls, and mongo.<method>) and time
+    their calls: each call is a round trip to MongoDB, apart from cursors (find), timed
+    when created, whose results are then read in batches.
+    """
+    def __init__(self, db, metrics):
+        self._db = db
+        self._metrics = metrics
+
+    def __getitem__(self, name):
+        return InstrumentedCollection(self._db[name], self._metrics)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+class InstrumentedCollection(object):
+    def __init__(self, collection, metrics):
+        self._collection = collection
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+        if name.startswith('initialize_'):  # bulk operations: the round trip is execute
+            return lambda *args, **kwargs: InstrumentedBulk(attr(*args, **kwargs), self._metrics)
+        return _instrumented(attr, 'mongo.' + name, self._metrics)
+
+
+class InstrumentedBulk(object):
+    def __init__(self, bulk, metrics):
+        self._bulk = bulk
+        self.execute = _instrumented(bulk.execute, 'mongo.bulk_execute', metrics)
+
+    def __getattr__(self, name):
+        return getattr(self._bulk, name)
+
+
+def _instrumented(method, name, metrics):
+    def call(*args, **kwargs):
+        metrics.count('mongo.calls')
+        metrics.count(name)
+        with metrics.timer(name):
+            return method(*args, **kwargs)
+    return call
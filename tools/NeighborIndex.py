@@ -0,0 +1,58 @@
+import numpy as np
+
+
+class NeighborIndex(object):
+    """
+    The k highest scores of each row of a (items x items) matrix, e.g. the co-occurrence:
+    for each item, its k nearest neighbors, highest scores first. The diagonal (the item
+    itself) and scores <= 0 are left out.
+
+    Built once from the matrix, then the neighbors of an item are read in O(k).
+    """
+    def __init__(self, matrix, labels, k=20):
+        """
+        :param matrix: (items x items) ndarray, or scipy sparse matrix
+        :param labels: IdRegistry of the item_id of each row/column
+        :param k: neighbors kept for each item
+        """
+        self.labels = labels
+        self.k = k
+        n = matrix.shape[0]
+        if hasattr(matrix, 'tocoo'):
+            coo = matrix.tocoo()
+            rows, cols, scores = coo.row, coo.col, coo.data
+        elif n and k:
+            # candidates: the k + 1 highest of each row, as the diagonal can be one of them
+            c = min(k + 1, n)
+            cols = np.argpartition(matrix, n - c, axis=1)[:, n - c:]
+            rows = np.repeat(np.arange(n), c)
+            cols = cols.ravel()
+            scores = matrix[rows, cols]
+        else:
+            rows = cols = scores = np.array([], dtype=np.int32)
+        keep = (rows != cols) & (scores > 0)
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+        order = np.lexsort((cols, -scores, rows))  # by row, highest scores first
+        rows, cols, scores = rows[order], cols[order], scores[order]
+        top = np.arange(len(rows)) - np.searchsorted(rows, rows) < k  # position within the row
+        rows, cols, scores = rows[top], cols[top], scores[top]
+        self._ptr = np.searchsorted(rows, np.arange(n + 1))  # neighbors of row i: _ptr[i]:_ptr[i + 1]
+        self._cols = cols.astype(np.int32)
+        self._scores = scores.astype(np.float64)
+
+    def __len__(self):
+        return len(self._ptr) - 1
+
+    def neighbors(self, key, n=None):
+        """
+        :param key: item_id
+        :param n: max number of neighbors, all the k kept if None
+        :return: [(item_id, score), ...], highest scores first. [] if key is not in the matrix
+        """
+        i = self.labels.get(key)
+        if i is None or i >= len(self):
+            return []
+        start, end = self._ptr[i], self._ptr[i + 1]
+        if n is not None:
+            end = min(end, start + n)
+        return zip(self.labels.ids(self._cols[start:end]), self._scores[start:end].tolist())
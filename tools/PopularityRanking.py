@@ -0,0 +1,94 @@
+from bisect import bisect_left, insort
+
+
+class PopularityRanking(object):
+    """
+    Items ordered by a score (e.g. sum of their ratings), kept sorted while
+    scores change: add is O(log n) plus a shift of the list, top(n) is O(n).
+    Ties are ranked by order of insertion.
+    """
+    def __init__(self, scores=()):
+        """
+        :param scores: iterable of (item_id, score), in the order used for ties
+        """
+        self._saved = None  # (IdRegistry, scores) read until the first change, see from_saved
+        self._scores = {}  # {item_id: score}
+        self._seq = {}  # {item_id: order of insertion}
+        for item_id, score in scores:
+            self._seq.setdefault(item_id, len(self._seq))
+            self._scores[item_id] = self._scores.get(item_id, 0.) + score
+        self._ranking = sorted((-score, self._seq[item_id], item_id) for item_id, score in self._scores.items())
+
+    @classmethod
+    def from_saved(cls, ids, scores):
+        """
+        Ranking as saved (e.g. memory-mapped from a snapshot): it is read from ids and scores,
+        shared by the processes mapping them, until it first changes, when it is built as by
+        __init__
+        :param ids: IdRegistry of the items, most popular first
+        :param scores: array of their scores
+        """
+        ranking = cls()
+        ranking._saved = (ids, scores)
+        return ranking
+
+    def _build(self):
+        """
+        Build the ranking from the saved one, if it is still read from there
+        """
+        if self._saved is not None:
+            ids, scores = self._saved
+            self.__init__(zip(ids, scores.tolist()))
+
+    def add(self, item_id, delta=0.):
+        """
+        Add delta to the score of item_id, which is inserted if new (with delta=0 as well)
+        """
+        self._build()
+        if item_id in self._scores:
+            if not delta:
+                return
+            score = self._scores[item_id]
+            del self._ranking[bisect_left(self._ranking, (-score, self._seq[item_id]))]
+        else:
+            score = 0.
+            self._seq[item_id] = len(self._seq)
+        score += delta
+        self._scores[item_id] = score
+        insort(self._ranking, (-score, self._seq[item_id], item_id))
+
+    def score(self, item_id, default=0.):
+        if self._saved is not None:
+            index = self._saved[0].get(item_id)
+            return default if index is None else float(self._saved[1][index])
+        return self._scores.get(item_id, default)
+
+    def top(self, n=None):
+        """
+        :return: list of the n items with the highest score, highest first (all if n is None)
+        """
+        if self._saved is not None:
+            ids = self._saved[0]
+            return ids.ids() if n is None else ids.ids(range(min(n, len(ids))))
+        return [item_id for _, _, item_id in self._ranking[:n]]
+
+    def __iter__(self):
+        """
+        Items from the most popular, without copying the ranking
+        """
+        if self._saved is not None:
+            for item_id in self._saved[0]:
+                yield item_id
+            return
+        for _, _, item_id in self._ranking:
+            yield item_id
+
+    def __contains__(self, item_id):
+        if self._saved is not None:
+            return item_id in self._saved[0]
+        return item_id in self._scores
+
+    def __len__(self):
+        if self._saved is not None:
+            return len(self._saved[0])
+        return len(self._ranking)
@@ -0,0 +1,97 @@
+import threading
+from contextlib import contextmanager
+
+
+class RWLock(object):
+    """
+    Reader-writer lock: many threads can hold it for reading at the same time,
+    one thread only for writing. Writers waiting have precedence over new readers,
+    so that a continuous flow of readers does not starve them.
+
+    It is reentrant: a thread holding it (for reading or writing) can acquire it
+    again for reading, a thread holding it for writing also for writing.
+    A thread holding it only for reading cannot acquire it for writing.
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0  # threads holding it for reading
+        self._writer = None  # thread holding it for writing
+        self._writers_waiting = 0
+        self._local = threading.local()  # per thread: reads, writes held
+
+    def _held(self):
+        if not hasattr(self._local, 'reads'):
+            self._local.reads = 0
+            self._local.writes = 0
+        return self._local
+
+    def reading(self):
+        """
+        :return: True if the current thread holds the lock only for reading
+        """
+        held = self._held()
+        return held.reads > 0 and held.writes == 0
+
+    def acquire_read(self):
+        held = self._held()
+        if held.reads or held.writes:
+            held.reads += 1
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        held.reads += 1
+
+    def release_read(self):
+        held = self._held()
+        held.reads -= 1
+        if held.reads or held.writes:
+            return
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        held = self._held()
+        if held.writes:
+            held.writes += 1
+            return
+        if held.reads:
+            raise RuntimeError("Lock held for reading cannot be acquired for writing")
+        me = threading.current_thread()
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+        held.writes += 1
+
+    def release_write(self):
+        held = self._held()
+        held.writes -= 1
+        if held.writes:
+            return
+        with self._cond:
+            self._writer = None
+            self._cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
@@ -0,0 +1,141 @@
+import os
+import shutil
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import numpy as np
+from tools.IdRegistry import IdRegistry, MappedIdRegistry
+
+# A snapshot is a directory with one .npy file per array, which are loaded
+# memory-mapped (copy-on-write), plus snapshot.pkl for everything else (e.g. items'
+# documents). Processes loading the same snapshot share the pages of the arrays.
+
+OBJECTS_FILE = 'snapshot.pkl'
+
+
+def save_array(path, name, array):
+    np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(array))
+
+
+def load_array(path, name):
+    """
+    :return: the array, memory-mapped. Writes are private to the process (copy-on-write)
+    """
+    return np.load(os.path.join(path, name + '.npy'), mmap_mode='c')
+
+
+def save_matrix(path, name, matrix):
+    """
+    :param matrix: ndarray or scipy CSR matrix
+    :return: description of the matrix, to be given to load_matrix
+    """
+    if hasattr(matrix, 'indptr'):
+        for part in ('data', 'indices', 'indptr'):
+            save_array(path, name + '.' + part, getattr(matrix, part))
+        return {'name': name, 'format': 'csr', 'shape': matrix.shape}
+    save_array(path, name, matrix)
+    return {'name': name, 'format': 'dense', 'shape': matrix.shape}
+
+
+def load_matrix(path, description):
+    """
+    :param description: as returned by save_matrix
+    :return: ndarray or scipy CSR matrix, memory-mapped
+    """
+    name = description['name']
+    if description['format'] == 'csr':
+        from scipy import sparse
+        return sparse.csr_matrix((load_array(path, name + '.data'),
+                                  load_array(path, name + '.indices'),
+                                  load_array(path, name + '.indptr')),
+                                 shape=description['shape'], copy=False)
+    return load_array(path, name)
+
+
+def save_ids(path, name, ids):
+    """
+    Save ids (e.g. of an IdRegistry) as an array, with their sorted order for lookups,
+    if they are all str or all unicode. Otherwise (e.g. numbers) they are kept in the
+    description, to be pickled.
+    :return: description of the ids, to be given to load_ids
+    """
+    ids = list(ids)
+    kinds = set(type(i) for i in ids)
+    if kinds == set([str]) or kinds == set([unicode]):
+        array = np.array(ids)
+        if array.tolist() == ids:  # no trailing \0 lost
+            save_array(path, name, array)
+            save_array(path, name + '.order', np.argsort(array, kind='mergesort'))
+            return {'name': name, 'format': 'array'}
+    return {'name': name, 'format': 'list', 'ids': ids}
+
+
+def load_ids(path, description):
+    """
+    :param description: as returned by save_ids, or the list of ids (snapshots saved before save_ids)
+    :return: IdRegistry of the ids, memory-mapped if saved as an array
+    """
+    if isinstance(description, list):
+        return IdRegistry(description)
+    if description['format'] == 'array':
+        name = description['name']
+        return MappedIdRegistry(load_array(path, name), load_array(path, name + '.order'))
+    return IdRegistry(description['ids'])
+
+
+def save_objects(path, objects):
+    with open(os.path.join(path, OBJECTS_FILE), 'wb') as f:
+        pickle.dump(objects, f, pickle.HIGHEST_PROTOCOL)
+
+
+def load_objects(path):
+    with open(os.path.join(path, OBJECTS_FILE), 'rb') as f:
+        return pickle.load(f)
+
+
+# Published snapshots are versions (directories 1, 2, ...) of one directory, where
+# the file CURRENT names the last complete one. It is replaced atomically, so
+# processes following the snapshots never read a version being written.
+
+CURRENT_FILE = 'CURRENT'
+
+
+def versions(path):
+    """
+    :return: versions of the snapshot in path, oldest first
+    """
+    if not os.path.isdir(path):
+        return []
+    return sorted(int(name) for name in os.listdir(path) if name.isdigit())
+
+
+def current_version(path):
+    """
+    :return: directory of the current version in path, None if none was published
+    """
+    try:
+        with open(os.path.join(path, CURRENT_FILE)) as f:
+            return os.path.join(path, f.read().strip())
+    except IOError:
+        return None
+
+
+def new_version(path):
+    """
+    :return: directory for a new version in path (not created)
+    """
+    published = versions(path)
+    return os.path.join(path, str(published[-1] + 1 if published else 1))
+
+
+def set_current_version(path, version_path, keep=2):
+    """
+    Make version_path the current version, and delete all but the last keep versions
+    """
+    tmp = os.path.join(path, CURRENT_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(os.path.basename(version_path))
+    os.rename(tmp, os.path.join(path, CURRENT_FILE))
+    for version in versions(path)[:-keep]:
+        shutil.rmtree(os.path.join(path, str(version)), ignore_errors=True)
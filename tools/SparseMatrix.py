@@ -0,0 +1,53 @@
+import numpy as np
+from scipy import sparse
+
+
+def binarize(matrix, dtype=np.int8):
+    """
+    :return: copy of matrix with 1 where matrix is not zero
+    """
+    binary = matrix.tocsr(copy=True)
+    binary.eliminate_zeros()
+    binary = binary.astype(dtype)
+    binary.data[:] = 1
+    return binary
+
+
+def cooccurrence(binary, dtype=np.int32):
+    """
+    :param binary: (users x items) binarized matrix
+    :return: (items x items) co-occurrence matrix, binary.T dot binary
+    """
+    binary = binary.astype(dtype)  # int8 would overflow
+    return binary.T.dot(binary).tocsr()
+
+
+def llr(cooccurrence, n_users, min_llr=3.84, max_per_row=None):
+    """
+    Log-likelihood ratio of each pair of items co-occurring more than expected
+    (see tools.Functions.LogLikelihoodRatio), pruned to the significant ones.
+
+    :param cooccurrence: (items x items) co-occurrence of binarized ratings (ndarray or sparse),
+                         whose diagonal is the number of users of each item
+    :param n_users: number of users (with at least a rating)
+    :param min_llr: pairs with a lower ratio are dropped (3.84: 95% significance)
+    :param max_per_row: if given, only the max_per_row highest ratios of each row are kept
+    :return: (items x items) csr matrix of the ratios, 0 on the diagonal
+    """
+    from tools.Functions import LogLikelihoodRatios
+    coo = sparse.coo_matrix(cooccurrence)
+    n = np.asarray(cooccurrence.diagonal(), dtype=np.float64).ravel()
+    rows, cols, k11 = coo.row, coo.col, coo.data.astype(np.float64)
+    positive = (rows != cols) & (k11 > 0) & (k11 * n_users > n[rows] * n[cols])
+    rows, cols, k11 = rows[positive], cols[positive], k11[positive]
+    k12 = n[rows] - k11
+    k21 = n[cols] - k11
+    ratios = LogLikelihoodRatios(k11, k12, k21, np.maximum(n_users - k11 - k12 - k21, 0))
+    significant = ratios >= min_llr
+    rows, cols, ratios = rows[significant], cols[significant], ratios[significant]
+    if max_per_row:
+        order = np.lexsort((-ratios, rows))  # by row, highest ratios first
+        rows, cols, ratios = rows[order], cols[order], ratios[order]
+        rank = np.arange(len(rows)) - np.searchsorted(rows, rows)  # position within the row
+        rows, cols, ratios = rows[rank < max_per_row], cols[rank < max_per_row], ratios[rank < max_per_row]
+    return sparse.csr_matrix((ratios.astype(np.float32), (rows, cols)), shape=coo.shape)
@@ -0,0 +1,36 @@
+import csv
+import json
+from itertools import islice
+
+
+def chunks(iterable, size):
+    """
+    :param iterable: any iterable, e.g. a generator
+    :param size: length of the chunks
+    :return: generator of lists of (at most) size elements
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_records(path):
+    """
+    Stream the records of a file, one at a time, without loading it in memory.
+    .csv files need a header (e.g. user_id,item_id,rating), any other
+    file is read as JSON lines (one JSON object per line).
+    :param path: path of the file
+    :return: generator of dicts
+    """
+    with open(path) as f:
+        if path.lower().endswith('.csv'):
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)